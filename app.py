@@ -1,23 +1,71 @@
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for, flash, send_file
+from flask import Flask, render_template, request, jsonify, session, redirect, url_for, flash, send_file, Response
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime, timedelta
 import sqlite3
+import base64
+import json
 import os
 import re
 from functools import wraps
+from io import BytesIO
 
+import metrics
 from models import Database, Validator, PaymentRules
-from invoice_generator import InvoiceGenerator
+from card_cache import CardCache
+from card_validation import clean_card_number, detect_brand, validate_cards
+from sql_trace import SQLTracer
+from invoice_cache import InvoiceCache
+from invoice_numbers import InvoiceNumberAllocator
+from invoice_export import stream_invoice_zip
+from invoice_jobs import InvoiceJobQueue, QueueFullError
 from email_sender import EmailSender
+from email_outbox import EmailOutbox
 
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', 'dev-secret-key-change-in-production')
 
 db = Database()
+db.statement_observers.append(metrics.observe_sql)
+# Rastreo de consultas lentas con sus planes (ver sql_trace.py)
+sql_tracer = SQLTracer(db).install() if os.environ.get('SQL_TRACE') == '1' else None
 validator = Validator()
-payment_rules = PaymentRules(db)
-invoice_generator = InvoiceGenerator()
-email_sender = EmailSender()
+# Caché de tarjetas compartido entre workers (ver card_cache.py)
+card_cache = CardCache() if os.environ.get('CARD_CACHE', '1') == '1' else None
+payment_rules = PaymentRules(db, card_cache=card_cache)
+# Folios de factura reservados por bloques en cada worker (ver invoice_numbers.py)
+invoice_numbers = InvoiceNumberAllocator(db)
+invoice_jobs = InvoiceJobQueue(cache=InvoiceCache())
+email_outbox = EmailOutbox(db)
+email_sender = EmailSender(outbox=email_outbox)
+email_outbox.start(email_sender.deliver)
+
+# Paginación del historial
+TRANSACTIONS_PAGE_SIZE = int(os.environ.get('TRANSACTIONS_PAGE_SIZE', 25))
+TRANSACTIONS_MAX_PAGE_SIZE = 100
+
+# Máximo de pagos por lote en /api/process-payments/batch
+BATCH_MAX_PAYMENTS = int(os.environ.get('BATCH_MAX_PAYMENTS', 500))
+
+# Máximo de tarjetas por petición en /api/validate-cards
+VALIDATE_CARDS_MAX = int(os.environ.get('VALIDATE_CARDS_MAX', 10000))
+# Tamaño máximo del cuerpo de /api/validate-cards (por defecto 1 MB)
+VALIDATE_CARDS_MAX_BYTES = int(os.environ.get('VALIDATE_CARDS_MAX_BYTES', 1024 * 1024))
+
+# Generar la factura en segundo plano en cuanto se autoriza un pago
+INVOICE_PREWARM = os.environ.get('INVOICE_PREWARM', '1') == '1'
+
+# Transacciones leídas por consulta al exportar facturas
+INVOICE_EXPORT_BATCH_SIZE = int(os.environ.get('INVOICE_EXPORT_BATCH_SIZE', 200))
+
+@app.before_request
+def start_request_metrics():
+    metrics.start_request()
+
+@app.after_request
+def record_request_metrics(response):
+    # Las respuestas en streaming (exportación ZIP) se miden hasta enviar los encabezados
+    metrics.finish_request(request.endpoint, request.method, response.status_code)
+    return response
 
 # Decorador para requerir login
 def login_required(f):
@@ -46,12 +94,9 @@ def login():
             flash('Por favor completa todos los campos', 'error')
             return render_template('login.html')
         
-        conn = sqlite3.connect(db.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('SELECT * FROM users WHERE username = ? OR email = ?', (username, username))
-        user = cursor.fetchone()
-        conn.close()
+        with db.connection() as conn:
+            cursor = conn.execute('SELECT * FROM users WHERE username = ? OR email = ?', (username, username))
+            user = cursor.fetchone()
         
         if user and check_password_hash(user[3], password):
             session['user_id'] = user[0]
@@ -99,21 +144,16 @@ def register():
         
         password_hash = generate_password_hash(password)
         
-        conn = sqlite3.connect(db.db_path)
-        cursor = conn.cursor()
-        
         try:
-            cursor.execute('''
-                INSERT INTO users (username, email, password_hash)
-                VALUES (?, ?, ?)
-            ''', (username, email, password_hash))
-            conn.commit()
-            conn.close()
+            with db.transaction() as conn:
+                conn.execute('''
+                    INSERT INTO users (username, email, password_hash)
+                    VALUES (?, ?, ?)
+                ''', (username, email, password_hash))
             
             flash('Usuario registrado exitosamente. Por favor inicia sesión.', 'success')
             return redirect(url_for('login'))
         except sqlite3.IntegrityError:
-            conn.close()
             flash('El usuario o email ya existe', 'error')
             return render_template('login.html')
     
@@ -129,29 +169,22 @@ def logout():
 @app.route('/dashboard')
 @login_required
 def dashboard():
-    conn = sqlite3.connect(db.db_path)
-    cursor = conn.cursor()
-    
-    # Estadísticas del usuario
-    cursor.execute('''
-        SELECT COUNT(*), COALESCE(SUM(amount), 0)
-        FROM transactions 
-        WHERE user_id = ? AND status = 'autorizado'
-    ''', (session['user_id'],))
-    stats = cursor.fetchone()
-    
-    # Últimas transacciones
-    cursor.execute('''
-        SELECT t.*, c.card_number, c.cardholder_name
-        FROM transactions t
-        LEFT JOIN cards c ON t.card_id = c.id
-        WHERE t.user_id = ?
-        ORDER BY t.timestamp DESC
-        LIMIT 10
-    ''', (session['user_id'],))
-    transactions = cursor.fetchall()
-    
-    conn.close()
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        
+        # Estadísticas del usuario (resumen mantenido en cada pago)
+        stats = db.get_user_stats(conn, session['user_id'])
+        
+        # Últimas transacciones
+        cursor.execute('''
+            SELECT t.*, c.card_number, c.cardholder_name
+            FROM transactions t
+            LEFT JOIN cards c ON t.card_id = c.id
+            WHERE t.user_id = ?
+            ORDER BY t.timestamp DESC
+            LIMIT 10
+        ''', (session['user_id'],))
+        transactions = cursor.fetchall()
     
     return render_template('dashboard.html', 
                          stats=stats, 
@@ -166,21 +199,136 @@ def payment():
 @app.route('/history')
 @login_required
 def history():
-    conn = sqlite3.connect(db.db_path)
-    cursor = conn.cursor()
+    # Solo se renderiza la primera página; el resto se carga desde /api/transactions
+    with db.connection() as conn:
+        transactions, next_cursor = fetch_transactions_page(conn, session['user_id'])
+    
+    return render_template('history.html',
+                         transactions=transactions,
+                         next_cursor=next_cursor,
+                         page_size=TRANSACTIONS_PAGE_SIZE,
+                         username=session['username'])
+
+@app.route('/api/transactions')
+@login_required
+def api_transactions():
+    """API paginada por cursor del historial de transacciones"""
+    try:
+        limit = int(request.args.get('limit', TRANSACTIONS_PAGE_SIZE))
+    except ValueError:
+        return jsonify({'error': 'El parámetro limit debe ser numérico'}), 400
+    limit = max(1, min(limit, TRANSACTIONS_MAX_PAGE_SIZE))
+    
+    status = request.args.get('status') or None
+    if status not in (None, 'autorizado', 'rechazado'):
+        return jsonify({'error': 'Estado inválido'}), 400
+    
+    try:
+        with db.connection() as conn:
+            transactions, next_cursor = fetch_transactions_page(
+                conn, session['user_id'],
+                cursor=request.args.get('cursor') or None,
+                limit=limit,
+                status=status,
+                date_from=request.args.get('from') or None,
+                date_to=request.args.get('to') or None
+            )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    return jsonify({
+        'transactions': [serialize_transaction(t) for t in transactions],
+        'next_cursor': next_cursor
+    })
+
+def encode_cursor(timestamp, transaction_id):
+    """Codifica la posición (timestamp, id) de la última fila como cursor opaco"""
+    raw = json.dumps([timestamp, transaction_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    """Decodifica un cursor de encode_cursor. Lanza ValueError si es inválido"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        timestamp, transaction_id = json.loads(raw)
+        if not isinstance(timestamp, str) or not isinstance(transaction_id, int):
+            raise TypeError
+        return timestamp, transaction_id
+    except (ValueError, TypeError):
+        raise ValueError('Cursor inválido')
+
+def fetch_transactions_page(conn, user_id, cursor=None, limit=TRANSACTIONS_PAGE_SIZE,
+                            status=None, date_from=None, date_to=None):
+    """
+    Lee una página del historial ordenada por (timestamp, id) descendente
+    
+    Usa paginación por cursor (keyset): la página siguiente empieza después
+    de la última fila entregada, así que cada página es una búsqueda en
+    idx_transactions_user_timestamp_id sin OFFSET y nunca se cargan más de
+    limit + 1 filas en memoria.
+    
+    Args:
+        conn: Conexión a la base de datos
+        user_id: Usuario dueño de las transacciones
+        cursor: Cursor de la página anterior (None para la primera)
+        limit: Tamaño de página
+        status: Filtrar por 'autorizado' o 'rechazado' (opcional)
+        date_from: Fecha inicial YYYY-MM-DD inclusive (opcional)
+        date_to: Fecha final YYYY-MM-DD inclusive (opcional)
+    
+    Returns:
+        tuple: (filas, cursor de la página siguiente o None)
+    """
+    where = ['t.user_id = ?']
+    params = [user_id]
+    
+    if cursor:
+        where.append('(t.timestamp, t.id) < (?, ?)')
+        params.extend(decode_cursor(cursor))
+    if status:
+        where.append('t.status = ?')
+        params.append(status)
+    try:
+        if date_from:
+            where.append('t.timestamp >= ?')
+            params.append(datetime.strptime(date_from, '%Y-%m-%d').strftime('%Y-%m-%d'))
+        if date_to:
+            where.append('t.timestamp < ?')
+            day_after = datetime.strptime(date_to, '%Y-%m-%d') + timedelta(days=1)
+            params.append(day_after.strftime('%Y-%m-%d'))
+    except ValueError:
+        raise ValueError('Fecha inválida. Usa el formato YYYY-MM-DD')
     
-    cursor.execute('''
+    cursor_db = conn.execute(f'''
         SELECT t.*, c.card_number, c.cardholder_name
         FROM transactions t
         LEFT JOIN cards c ON t.card_id = c.id
-        WHERE t.user_id = ?
-        ORDER BY t.timestamp DESC
-    ''', (session['user_id'],))
-    transactions = cursor.fetchall()
+        WHERE {' AND '.join(where)}
+        ORDER BY t.timestamp DESC, t.id DESC
+        LIMIT ?
+    ''', params + [limit + 1])
+    rows = cursor_db.fetchall()
     
-    conn.close()
-    
-    return render_template('history.html', transactions=transactions, username=session['username'])
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1][4], rows[-1][0])
+    return rows, next_cursor
+
+def serialize_transaction(transaction):
+    """Convierte una fila de transacción (t.*, card_number, cardholder_name) a dict"""
+    return {
+        'id': transaction[0],
+        'amount': float(transaction[1]),
+        'status': transaction[2],
+        'rejection_reason': transaction[3],
+        'timestamp': transaction[4],
+        'rfc': transaction[7],
+        'full_name': transaction[8],
+        'invoice_number': transaction[9],
+        'card_last4': transaction[10][-4:] if transaction[10] else None,
+        'cardholder_name': transaction[11]
+    }
 
 # API endpoints
 @app.route('/api/validate-card', methods=['POST'])
@@ -191,27 +339,152 @@ def validate_card():
     
     is_valid = validator.validate_card_number(card_number)
     
-    # Detectar tipo de tarjeta
-    card_type = 'unknown'
-    if card_number.startswith('4'):
-        card_type = 'visa'
-    elif card_number.startswith('5'):
-        card_type = 'mastercard'
-    elif card_number.startswith('3'):
-        card_type = 'amex'
-    elif card_number.startswith('6'):
-        card_type = 'discover'
+    # Detectar tipo de tarjeta por su BIN
+    card_type = detect_brand(card_number)
     
     return jsonify({
         'valid': is_valid,
         'card_type': card_type,
-        'masked': '**** **** **** ' + card_number[-4:] if len(card_number) >= 4 else card_number
+        'masked': mask_card_number(card_number)
+    })
+
+def mask_card_number(card_number):
+    return '**** **** **** ' + card_number[-4:] if len(card_number) >= 4 else card_number
+
+@app.route('/api/validate-cards', methods=['POST'])
+@login_required
+def validate_cards_bulk():
+    """
+    Valida una lista de números de tarjeta en una sola petición
+    
+    Luhn, longitud y marca se calculan para todo el lote a la vez (ver
+    card_validation.validate_cards). El resultado de cada tarjeta se reporta
+    en la misma posición de la lista. El tamaño del cuerpo se revisa antes
+    de leerlo y las entradas de más de MAX_INPUT_LENGTH caracteres se
+    reportan inválidas, así que la memoria de la petición está acotada.
+    """
+    if request.content_length is None:
+        return jsonify({'success': False, 'errors': ['La petición debe indicar Content-Length']}), 411
+    if request.content_length > VALIDATE_CARDS_MAX_BYTES:
+        return jsonify({
+            'success': False,
+            'errors': [f'La petición excede el máximo de {VALIDATE_CARDS_MAX_BYTES} bytes']
+        }), 413
+    
+    data = request.get_json(silent=True) or {}
+    card_numbers = data.get('card_numbers') if isinstance(data, dict) else None
+    
+    if not isinstance(card_numbers, list) or not card_numbers:
+        return jsonify({'success': False, 'errors': ['Se requiere una lista de tarjetas en "card_numbers"']}), 400
+    if len(card_numbers) > VALIDATE_CARDS_MAX:
+        return jsonify({
+            'success': False,
+            'errors': [f'La lista excede el máximo de {VALIDATE_CARDS_MAX} tarjetas']
+        }), 400
+    if not all(isinstance(number, (str, int)) and not isinstance(number, bool) for number in card_numbers):
+        return jsonify({'success': False, 'errors': ['Cada tarjeta debe ser una cadena de dígitos']}), 400
+    
+    checks = validate_cards(card_numbers)
+    columns = zip(checks['valid'].tolist(), checks['luhn_valid'].tolist(),
+                  checks['length_valid'].tolist(), checks['brand'].tolist())
+    results = []
+    valid = 0
+    for index, (number, (is_valid, luhn_valid, length_valid, card_type)) in enumerate(zip(card_numbers, columns)):
+        valid += is_valid
+        results.append({
+            'index': index,
+            'valid': is_valid,
+            'luhn_valid': luhn_valid,
+            'length_valid': length_valid,
+            'card_type': card_type,
+            'masked': mask_card_number(clean_card_number(number))
+        })
+    
+    return jsonify({
+        'success': True,
+        'total': len(results),
+        'valid': valid,
+        'invalid': len(results) - valid,
+        'results': results
     })
 
 @app.route('/api/process-payment', methods=['POST'])
 @login_required
 def process_payment():
-    data = request.get_json()
+    payment, errors = validate_payment_data(request.get_json())
+    
+    if errors:
+        return jsonify({
+            'success': False,
+            'errors': errors
+        }), 400
+    
+    # Manejo de excepciones para guardado de datos
+    try:
+        # Tomar el folio antes de abrir la transacción: si se agota el bloque
+        # del worker, la reserva del siguiente usa su propia transacción
+        invoice_num = invoice_numbers.next()
+        
+        # Lectura de la tarjeta, reglas, cargo y registro en una sola transacción
+        with db.transaction(immediate=True) as conn:
+            card = get_or_create_card(conn, payment['card_number'], payment['full_name'],
+                                      payment['expiry_date'], payment['cvv'])
+            result = apply_payment(conn, card, payment, invoice_num)
+        
+        metrics.record_payment(result)
+        if result['authorized']:
+            if INVOICE_PREWARM:
+                prewarm_invoice(result['transaction_id'])
+            return jsonify({
+                'success': True,
+                'message': 'Pago autorizado exitosamente',
+                'transaction_id': result['transaction_id'],
+                'invoice_number': result['invoice_number']
+            })
+        else:
+            return jsonify({
+                'success': False,
+                'errors': [result['reason']],
+                'transaction_id': result['transaction_id']
+            }), 400
+    
+    except sqlite3.Error as e:
+        # Manejo de errores de base de datos (la transacción ya fue revertida)
+        return jsonify({
+            'success': False,
+            'errors': [f'Error al procesar la transacción: {str(e)}']
+        }), 500
+    except Exception as e:
+        # Manejo de cualquier otro error
+        return jsonify({
+            'success': False,
+            'errors': [f'Error inesperado: {str(e)}']
+        }), 500
+
+PAYMENT_TEXT_FIELDS = ('full_name', 'rfc', 'card_number', 'expiry_date', 'cvv')
+
+def validate_payment_data(data):
+    """
+    Extrae y valida los datos de un pago recibido por la API
+    
+    Args:
+        data: dict con full_name, rfc, card_number, expiry_date, cvv y amount
+    
+    Returns:
+        tuple: (dict con los datos normalizados, lista de errores)
+    """
+    if not isinstance(data, dict):
+        return None, ['Los datos del pago deben ser un objeto JSON']
+    
+    # Tipos de los campos: un número o una lista donde se espera texto no debe
+    # llegar a .strip() (el monto puede ser número o texto numérico)
+    errors = [f'El campo {name} debe ser texto'
+              for name in PAYMENT_TEXT_FIELDS if not isinstance(data.get(name, ''), str)]
+    amount = data.get('amount', 0)
+    if isinstance(amount, bool) or not isinstance(amount, (int, float, str)):
+        errors.append('El monto debe ser un número')
+    if errors:
+        return None, errors
     
     # Extraer datos
     full_name = data.get('full_name', '').strip()
@@ -219,11 +492,8 @@ def process_payment():
     card_number = data.get('card_number', '').replace(' ', '')
     expiry_date = data.get('expiry_date', '').strip()
     cvv = data.get('cvv', '').strip()
-    amount = data.get('amount', 0)
     
     # Validaciones básicas
-    errors = []
-    
     # Validar que el nombre no esté vacío y tenga al menos 2 palabras (nombre y apellido)
     if not full_name:
         errors.append('El nombre completo es requerido')
@@ -259,165 +529,165 @@ def process_payment():
     elif not validator.validate_amount(amount):
         errors.append('Monto inválido. Debe ser mayor a 0 y menor a $10,000')
     
-    if errors:
+    payment = {
+        'full_name': full_name,
+        'rfc': rfc,
+        'card_number': card_number,
+        'expiry_date': expiry_date,
+        'cvv': cvv,
+        'amount': amount
+    }
+    return payment, errors
+
+@app.route('/api/process-payments/batch', methods=['POST'])
+@login_required
+def process_payments_batch():
+    """
+    Procesa un lote de pagos en una sola transacción de escritura
+    
+    Todos los pagos se validan primero; los válidos se agrupan por tarjeta
+    para leer cada tarjeta una sola vez y se aplican con las mismas reglas
+    que /api/process-payment, en el orden de llegada dentro de cada tarjeta.
+    El resultado de cada pago se reporta en la misma posición del lote.
+    
+    Cada pago se aplica dentro de un SAVEPOINT: si uno falla solo se
+    revierte ese pago y se reporta su error; el resto del lote continúa.
+    """
+    data = request.get_json(silent=True) or {}
+    payments = data.get('payments') if isinstance(data, dict) else None
+    
+    if not isinstance(payments, list) or not payments:
+        return jsonify({'success': False, 'errors': ['Se requiere una lista de pagos en "payments"']}), 400
+    if len(payments) > BATCH_MAX_PAYMENTS:
         return jsonify({
             'success': False,
-            'errors': errors
+            'errors': [f'El lote excede el máximo de {BATCH_MAX_PAYMENTS} pagos']
         }), 400
     
-    # Manejo de excepciones para guardado de datos
-    try:
-        # Buscar o crear la tarjeta
-        card = get_or_create_card(card_number, full_name, expiry_date, cvv)
-        
-        # Abrir conexión a la base de datos
-        conn = sqlite3.connect(db.db_path)
-        cursor = conn.cursor()
-        
-        if card and card[0]:  # Si la tarjeta existe en BD con ID
-            # Verificar reglas de autorización
-            auth_result = payment_rules.check_authorization(card_number, expiry_date, cvv, amount, rfc)
+    results = [None] * len(payments)
+    outcomes = []
+    
+    # Validar todo el lote y agrupar por tarjeta
+    by_card = {}
+    for index, item in enumerate(payments):
+        try:
+            payment, errors = validate_payment_data(item)
+        except Exception as e:
+            app.logger.warning(f'Pago {index} del lote con datos inválidos: {e}')
+            payment, errors = None, ['Datos del pago inválidos']
+        if errors:
+            results[index] = {'index': index, 'success': False, 'errors': errors}
         else:
-            # Para tarjetas nuevas/inventadas, autorizar automáticamente
-            auth_result = {'authorized': True, 'reason': None}
+            by_card.setdefault(payment['card_number'], []).append((index, payment))
+    
+    try:
+        # Un folio por pago válido, tomados antes de abrir la transacción
+        invoice_nums = iter(invoice_numbers.take(sum(len(items) for items in by_card.values())))
         
-        if auth_result['authorized']:
-            # Generar número de factura antes de insertar
-            invoice_num = generate_invoice_number()
-            
-            # Procesar pago exitoso
-            cursor.execute('''
-                INSERT INTO transactions (amount, status, card_id, user_id, rfc, full_name, invoice_number)
-                VALUES (?, 'autorizado', ?, ?, ?, ?, ?)
-            ''', (
-                float(amount),
-                card[0] if card else None,
-                session['user_id'],
-                rfc,
-                full_name,
-                invoice_num
-            ))
-            
-            # Obtener el ID de la transacción ANTES de cerrar la conexión
-            transaction_id = cursor.lastrowid
-            
-            # Actualizar balance de la tarjeta si existe en BD
-            if card and card[0]:
-                new_balance = card[5] - float(amount)
-                cursor.execute('UPDATE cards SET balance = ?, attempts_count = 0 WHERE id = ?', 
-                             (new_balance, card[0]))
-            
-            conn.commit()
-            conn.close()
-            
-            return jsonify({
-                'success': True,
-                'message': 'Pago autorizado exitosamente',
-                'transaction_id': transaction_id,
-                'invoice_number': invoice_num
-            })
-        else:
-            # Registrar transacción fallida
-            cursor.execute('''
-                INSERT INTO transactions (amount, status, rejection_reason, card_id, user_id, rfc, full_name)
-                VALUES (?, 'rechazado', ?, ?, ?, ?, ?)
-            ''', (
-                float(amount),
-                auth_result['reason'],
-                card[0] if card else None,
-                session['user_id'],
-                rfc,
-                full_name
-            ))
-            
-            # Obtener el ID de la transacción ANTES de cerrar la conexión
-            transaction_id = cursor.lastrowid
-            
-            conn.commit()
-            conn.close()
-            
-            return jsonify({
-                'success': False,
-                'errors': [auth_result['reason']],
-                'transaction_id': transaction_id
-            }), 400
+        with db.transaction(immediate=True) as conn:
+            for card_number, items in by_card.items():
+                first = items[0][1]
+                card = get_or_create_card(conn, card_number, first['full_name'],
+                                          first['expiry_date'], first['cvv'])
+                
+                for index, payment in items:
+                    conn.execute('SAVEPOINT pago')
+                    try:
+                        # PaymentRules.process_payment actualiza card en sitio (balance, intentos)
+                        result = apply_payment(conn, card, payment, next(invoice_nums))
+                    except Exception as e:
+                        app.logger.warning(f'Error en el pago {index} del lote: {e}')
+                        conn.execute('ROLLBACK TO pago')
+                        conn.execute('RELEASE pago')
+                        if card:
+                            # card pudo quedar con cambios revertidos (versión, intentos)
+                            card.update(db.get_card(conn, card_number) or {})
+                        results[index] = {
+                            'index': index,
+                            'success': False,
+                            'errors': [f'Error al procesar el pago: {str(e)}']
+                        }
+                        continue
+                    conn.execute('RELEASE pago')
+                    outcomes.append(result)
+                    if result['authorized']:
+                        results[index] = {
+                            'index': index,
+                            'success': True,
+                            'transaction_id': result['transaction_id'],
+                            'invoice_number': result['invoice_number']
+                        }
+                    else:
+                        results[index] = {
+                            'index': index,
+                            'success': False,
+                            'errors': [result['reason']],
+                            'transaction_id': result['transaction_id']
+                        }
+    
+        # Solo se cuentan una vez confirmado el lote
+        for result in outcomes:
+            metrics.record_payment(result)
     
     except sqlite3.Error as e:
-        # Manejo de errores de base de datos
-        if 'conn' in locals():
-            conn.rollback()
-            conn.close()
+        # Ningún pago del lote quedó registrado
         return jsonify({
             'success': False,
-            'errors': [f'Error al procesar la transacción: {str(e)}']
+            'errors': [f'Error al procesar el lote: {str(e)}']
         }), 500
+    
+    authorized = sum(1 for result in results if result['success'])
+    return jsonify({
+        'success': True,
+        'authorized': authorized,
+        'rejected': len(results) - authorized,
+        'results': results
+    })
+
+def prewarm_invoice(transaction_id):
+    """Genera en segundo plano la factura de un pago recién autorizado"""
+    try:
+        transaction_data = get_invoice_data(transaction_id, session['user_id'])
+        if transaction_data:
+            invoice_jobs.prewarm(transaction_data)
     except Exception as e:
-        # Manejo de cualquier otro error
-        if 'conn' in locals() and conn:
-            conn.rollback()
-            conn.close()
-        return jsonify({
-            'success': False,
-            'errors': [f'Error inesperado: {str(e)}']
-        }), 500
+        # El pago ya quedó registrado: la factura se generará al descargarla
+        app.logger.warning(f'No se pudo pregenerar la factura {transaction_id}: {e}')
 
-def get_or_create_card(card_number, cardholder_name, expiry_date, cvv):
+def apply_payment(conn, card, payment, invoice_number):
+    """Aplica un pago validado (ver validate_payment_data) dentro de la transacción abierta"""
+    return payment_rules.process_payment(
+        conn, card, session['user_id'], payment['full_name'], payment['rfc'],
+        payment['expiry_date'], payment['cvv'], payment['amount'], invoice_number
+    )
+
+def get_or_create_card(conn, card_number, cardholder_name, expiry_date, cvv):
     """
     Busca una tarjeta en la base de datos. Si no existe, crea una temporal/virtual.
     Esto permite usar tarjetas inventadas para pruebas.
     
     Args:
+        conn: Conexión con la transacción del pago en curso
         card_number: Número de tarjeta
         cardholder_name: Nombre del titular
         expiry_date: Fecha de expiración
         cvv: Código CVV
     
     Returns:
-        tuple: Datos de la tarjeta (como una fila de base de datos) o None para tarjeta virtual
+        dict: Datos de la tarjeta (ver Database.get_card) o None para tarjeta virtual
     """
-    try:
-        conn = sqlite3.connect(db.db_path)
-        cursor = conn.cursor()
-        
-        # Buscar tarjeta existente
-        cursor.execute('SELECT * FROM cards WHERE card_number = ?', (card_number,))
-        card = cursor.fetchone()
-        conn.close()
-        
-        if card:
-            # Tarjeta encontrada en BD
-            return card
-        else:
-            # Tarjeta no existe - retornar None para indicar que es virtual
-            # El flujo de pago autorizar automáticamente sin validar balance
-            return None
-            
-    except Exception as e:
-        print(f"Error al buscar tarjeta: {e}")
-        return None
-
-def generate_invoice_number():
-    """Genera un número de factura único"""
-    timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
-    return f'F{timestamp}{session["user_id"]}'
+    # Si la tarjeta no existe se retorna None para indicar que es virtual:
+    # el flujo de pago la autoriza automáticamente sin validar balance.
+    # Los errores de base de datos se propagan para revertir la transacción.
+    return payment_rules.load_card(conn, card_number)
 
 @app.route('/api/cards/search')
 @login_required
 def search_cards():
     query = request.args.get('q', '')
     
-    conn = sqlite3.connect(db.db_path)
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        SELECT card_number, cardholder_name, expiry_date, balance, is_verified, is_blocked
-        FROM cards
-        WHERE cardholder_name LIKE ? OR card_number LIKE ?
-        LIMIT 10
-    ''', (f'%{query}%', f'%{query}%'))
-    
-    cards = cursor.fetchall()
-    conn.close()
+    with db.connection() as conn:
+        cards = db.search_cards(conn, query, limit=10)
     
     result = []
     for card in cards:
@@ -433,21 +703,30 @@ def search_cards():
     
     return jsonify(result)
 
+@app.route('/api/rules/stats')
+@login_required
+def rules_stats():
+    """Métricas por regla de autorización de este worker"""
+    return jsonify(payment_rules.engine.stats())
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Métricas de todos los workers en formato Prometheus (restringir en el proxy)"""
+    content, content_type = metrics.render()
+    return Response(content, content_type=content_type)
+
 @app.route('/invoice/<int:transaction_id>')
 @login_required
 def invoice(transaction_id):
-    conn = sqlite3.connect(db.db_path)
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        SELECT t.*, c.card_number, c.cardholder_name
-        FROM transactions t
-        LEFT JOIN cards c ON t.card_id = c.id
-        WHERE t.id = ? AND t.user_id = ?
-    ''', (transaction_id, session['user_id']))
-    
-    transaction = cursor.fetchone()
-    conn.close()
+    with db.connection() as conn:
+        cursor = conn.execute('''
+            SELECT t.*, c.card_number, c.cardholder_name
+            FROM transactions t
+            LEFT JOIN cards c ON t.card_id = c.id
+            WHERE t.id = ? AND t.user_id = ?
+        ''', (transaction_id, session['user_id']))
+        
+        transaction = cursor.fetchone()
     
     if not transaction:
         flash('Transacción no encontrada', 'error')
@@ -464,18 +743,15 @@ def invoice(transaction_id):
 @login_required
 def api_invoice(transaction_id):
     """API endpoint para obtener datos de factura en JSON"""
-    conn = sqlite3.connect(db.db_path)
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        SELECT t.*, c.card_number, c.cardholder_name
-        FROM transactions t
-        LEFT JOIN cards c ON t.card_id = c.id
-        WHERE t.id = ? AND t.user_id = ?
-    ''', (transaction_id, session['user_id']))
-    
-    transaction = cursor.fetchone()
-    conn.close()
+    with db.connection() as conn:
+        cursor = conn.execute('''
+            SELECT t.*, c.card_number, c.cardholder_name
+            FROM transactions t
+            LEFT JOIN cards c ON t.card_id = c.id
+            WHERE t.id = ? AND t.user_id = ?
+        ''', (transaction_id, session['user_id']))
+        
+        transaction = cursor.fetchone()
     
     if not transaction or transaction[2] != 'autorizado':
         return jsonify({'error': 'Transacción no encontrada o no autorizada'}), 404
@@ -494,6 +770,48 @@ def api_invoice(transaction_id):
         'total': float(transaction[1]) * 1.029
     })
 
+def get_invoice_data(transaction_id, user_id):
+    """
+    Lee una transacción autorizada del usuario y arma los datos de su factura
+    
+    Returns:
+        dict: Datos para InvoiceGenerator.generate_invoice_pdf o None si no existe
+    """
+    with db.connection() as conn:
+        cursor = conn.execute('''
+            SELECT t.*, c.card_number, c.cardholder_name
+            FROM transactions t
+            LEFT JOIN cards c ON t.card_id = c.id
+            WHERE t.id = ? AND t.user_id = ? AND t.status = 'autorizado'
+        ''', (transaction_id, user_id))
+        
+        transaction = cursor.fetchone()
+    
+    if not transaction:
+        return None
+    
+    return invoice_data_from_row(transaction)
+
+def invoice_data_from_row(transaction):
+    """Arma los datos de la factura de una fila (t.*, card_number, cardholder_name)"""
+    timestamp = transaction[4]
+    date_part = timestamp[:10] if timestamp else 'N/A'
+    time_part = timestamp[11:19] if timestamp else 'N/A'
+    
+    return {
+        'id': transaction[0],
+        'amount': float(transaction[1]),
+        'status': 'Autorizado',
+        'timestamp': timestamp,
+        'date': date_part,
+        'time': time_part,
+        'card_last4': transaction[10][-4:] if transaction[10] else 'N/A',
+        'cardholder_name': transaction[11] or 'N/A',
+        'rfc': transaction[7] or 'N/A',
+        'full_name': transaction[8] or 'N/A',
+        'invoice_number': transaction[9] or 'N/A'
+    }
+
 @app.route('/api/invoice/<int:transaction_id>/email', methods=['POST'])
 @login_required
 def email_invoice(transaction_id):
@@ -508,133 +826,212 @@ def email_invoice(transaction_id):
     if not validator.validate_email(email):
         return jsonify({'error': 'Email inválido. Por favor verifica el formato'}), 400
     
-    try:
-        conn = sqlite3.connect(db.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT t.*, c.card_number, c.cardholder_name
-            FROM transactions t
-            LEFT JOIN cards c ON t.card_id = c.id
-            WHERE t.id = ? AND t.user_id = ? AND t.status = 'autorizado'
-        ''', (transaction_id, session['user_id']))
-        
-        transaction = cursor.fetchone()
-        conn.close()
-        
-        if not transaction:
-            return jsonify({'error': 'Transacción no encontrada'}), 404
-        
-        # Preparar datos de la transacción
-        timestamp = transaction[4]
-        date_part = timestamp[:10] if timestamp else 'N/A'
-        time_part = timestamp[11:19] if timestamp else 'N/A'
-        
-        transaction_data = {
-            'id': transaction[0],
-            'amount': float(transaction[1]),
-            'status': 'Autorizado',
-            'timestamp': timestamp,
-            'date': date_part,
-            'time': time_part,
-            'card_last4': transaction[10][-4:] if transaction[10] else 'N/A',
-            'cardholder_name': transaction[11] or 'N/A',
-            'rfc': transaction[6] or 'N/A',
-            'full_name': transaction[7] or 'N/A',
-            'invoice_number': transaction[9] or 'N/A'
-        }
-        
-        # Generar PDF
-        pdf_buffer = invoice_generator.generate_invoice_pdf(transaction_data)
-        pdf_buffer.seek(0)
-        
-        # Enviar email
+    user_id = session['user_id']
+    transaction_data = get_invoice_data(transaction_id, user_id)
+    
+    if not transaction_data:
+        return jsonify({'error': 'Transacción no encontrada'}), 404
+    
+    def send(pdf_path):
+        """Arma el email cuando el pool termina el PDF (fuera de la petición)"""
+        with open(pdf_path, 'rb') as f:
+            pdf_buffer = BytesIO(f.read())
         result = email_sender.send_invoice_email(
             to_email=email,
             invoice_number=transaction_data['invoice_number'],
             pdf_buffer=pdf_buffer,
-            transaction_data=transaction_data
+            transaction_data=transaction_data,
+            user_id=user_id
         )
-        
-        if result['success']:
-            return jsonify(result)
-        else:
-            return jsonify({'error': result['message']}), 500
-            
-    except Exception as e:
-        return jsonify({'error': f'Error al enviar factura: {str(e)}'}), 500
+        if not result['success']:
+            raise RuntimeError(result['message'])
+        return {'email_id': result.get('email_id')}
+    
+    # El PDF se genera en el pool y el email se encola al terminar: no se espera aquí
+    try:
+        job_id = invoice_jobs.submit(transaction_data, owner_id=user_id, on_done=send)
+    except QueueFullError as e:
+        return jsonify({'error': str(e)}), 503
+    
+    return jsonify({
+        'success': True,
+        'queued': True,
+        'job_id': job_id,
+        'message': f'La factura se enviará a {email} en unos momentos',
+        'status_url': url_for('invoice_job_status', job_id=job_id)
+    }), 202
 
-@app.route('/api/invoice/<int:transaction_id>/download')
+@app.route('/api/emails/<int:email_id>')
 @login_required
-def download_invoice(transaction_id):
-    """Endpoint para descargar factura en PDF"""
+def email_status(email_id):
+    """Estado de entrega de un email de la bandeja de salida"""
+    status = email_outbox.status(email_id, user_id=session['user_id'])
+    
+    if not status:
+        return jsonify({'error': 'Email no encontrado'}), 404
+    
+    return jsonify(status)
+
+@app.route('/api/invoice/<int:transaction_id>/render', methods=['POST'])
+@login_required
+def render_invoice(transaction_id):
+    """Encola la generación del PDF de una factura y retorna el id del trabajo"""
+    transaction_data = get_invoice_data(transaction_id, session['user_id'])
+    
+    if not transaction_data:
+        return jsonify({'error': 'Transacción no encontrada'}), 404
+    
+    try:
+        job_id = invoice_jobs.submit(transaction_data, owner_id=session['user_id'])
+    except QueueFullError as e:
+        return jsonify({'error': str(e)}), 503
+    
+    return jsonify({
+        'job_id': job_id,
+        'status': 'pending',
+        'status_url': url_for('invoice_job_status', job_id=job_id)
+    }), 202
+
+@app.route('/api/invoice-jobs/<job_id>')
+@login_required
+def invoice_job_status(job_id):
+    """Estado de un trabajo de generación de factura"""
+    status = invoice_jobs.status(job_id, owner_id=session['user_id'])
+    
+    if not status:
+        return jsonify({'error': 'Trabajo no encontrado'}), 404
+    
+    response = {
+        'job_id': job_id,
+        'status': status['status'],
+        'transaction_id': status['transaction_id']
+    }
+    if status['status'] == 'done':
+        response['result_url'] = url_for('invoice_job_result', job_id=job_id)
+        if status.get('email_id'):
+            response['email_status_url'] = url_for('email_status', email_id=status['email_id'])
+    elif status['status'] == 'failed':
+        response['error'] = status.get('error')
+    return jsonify(response)
+
+@app.route('/api/invoice-jobs/<job_id>/result')
+@login_required
+def invoice_job_result(job_id):
+    """Descarga el PDF generado por un trabajo terminado"""
+    status = invoice_jobs.status(job_id, owner_id=session['user_id'])
+    
+    if not status:
+        return jsonify({'error': 'Trabajo no encontrado'}), 404
+    if status['status'] != 'done':
+        return jsonify({'error': 'La factura aún no está lista', 'status': status['status']}), 409
+    
     try:
-        conn = sqlite3.connect(db.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT t.*, c.card_number, c.cardholder_name
-            FROM transactions t
-            LEFT JOIN cards c ON t.card_id = c.id
-            WHERE t.id = ? AND t.user_id = ? AND t.status = 'autorizado'
-        ''', (transaction_id, session['user_id']))
-        
-        transaction = cursor.fetchone()
-        conn.close()
-        
-        if not transaction:
-            return jsonify({'error': 'Transacción no encontrada'}), 404
-        
-        # Preparar datos de la transacción
-        timestamp = transaction[4]
-        date_part = timestamp[:10] if timestamp else 'N/A'
-        time_part = timestamp[11:19] if timestamp else 'N/A'
-        
-        transaction_data = {
-            'id': transaction[0],
-            'amount': float(transaction[1]),
-            'status': 'Autorizado',
-            'timestamp': timestamp,
-            'date': date_part,
-            'time': time_part,
-            'card_last4': transaction[10][-4:] if transaction[10] else 'N/A',
-            'cardholder_name': transaction[11] or 'N/A',
-            'rfc': transaction[6] or 'N/A',
-            'full_name': transaction[7] or 'N/A',
-            'invoice_number': transaction[9] or 'N/A'
-        }
-        
-        # Generar PDF
-        pdf_buffer = invoice_generator.generate_invoice_pdf(transaction_data)
-        pdf_buffer.seek(0)
-        
-        # Enviar el archivo PDF
         return send_file(
-            pdf_buffer,
+            os.path.abspath(status['path']),
             mimetype='application/pdf',
             as_attachment=True,
-            download_name=f'factura-{transaction_data["invoice_number"]}.pdf'
+            download_name=f'factura-{status["invoice_number"]}.pdf'
         )
-        
-    except Exception as e:
-        return jsonify({'error': f'Error al generar PDF: {str(e)}'}), 500
+    except FileNotFoundError:
+        # El PDF salió del caché entre el aviso de terminado y la descarga
+        return jsonify({'error': 'La factura expiró. Solicítala de nuevo'}), 410
+
+@app.route('/api/invoices/export')
+@login_required
+def export_invoices():
+    """Descarga en un ZIP las facturas de los pagos autorizados del periodo"""
+    user_id = session['user_id']
+    date_from = request.args.get('from') or None
+    date_to = request.args.get('to') or None
+    
+    # La primera página se lee aquí para validar las fechas antes de empezar a enviar
+    try:
+        with db.connection() as conn:
+            first_page = fetch_transactions_page(
+                conn, user_id, limit=INVOICE_EXPORT_BATCH_SIZE, status='autorizado',
+                date_from=date_from, date_to=date_to
+            )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    if not first_page[0]:
+        return jsonify({'error': 'No hay facturas en el periodo'}), 404
+    
+    def invoices():
+        rows, cursor = first_page
+        while True:
+            for row in rows:
+                yield invoice_data_from_row(row)
+            if not cursor:
+                return
+            # Una conexión por lote: no se retiene una conexión del pool mientras se envía
+            with db.connection() as conn:
+                rows, cursor = fetch_transactions_page(
+                    conn, user_id, cursor=cursor, limit=INVOICE_EXPORT_BATCH_SIZE,
+                    status='autorizado', date_from=date_from, date_to=date_to
+                )
+    
+    period = '-'.join(part for part in (date_from, date_to) if part) or 'todas'
+    return Response(
+        stream_invoice_zip(invoice_jobs.render_many(invoices()), invoice_jobs.render),
+        mimetype='application/zip',
+        headers={'Content-Disposition': f'attachment; filename=facturas-{period}.zip'}
+    )
+
+@app.route('/api/invoice/<int:transaction_id>/download')
+@login_required
+def download_invoice(transaction_id):
+    """
+    Endpoint para descargar factura en PDF
+
+    Si la factura ya está en el caché se envía de inmediato; si no, se encola
+    su generación y se responde 202 con la URL del trabajo (ver invoice_job_status).
+    """
+    transaction_data = get_invoice_data(transaction_id, session['user_id'])
+    
+    if not transaction_data:
+        return jsonify({'error': 'Transacción no encontrada'}), 404
+    
+    pdf_path = invoice_jobs.cached(transaction_data)
+    if pdf_path:
+        try:
+            # Enviar el archivo PDF desde disco (sendfile, sin cargarlo en memoria)
+            return send_file(
+                os.path.abspath(pdf_path),
+                mimetype='application/pdf',
+                as_attachment=True,
+                download_name=f'factura-{transaction_data["invoice_number"]}.pdf'
+            )
+        except FileNotFoundError:
+            # Salió del caché entre la consulta y el envío: se genera de nuevo
+            pass
+    
+    try:
+        job_id = invoice_jobs.submit(transaction_data, owner_id=session['user_id'])
+    except QueueFullError as e:
+        return jsonify({'error': str(e)}), 503
+    
+    return jsonify({
+        'job_id': job_id,
+        'status': 'pending',
+        'status_url': url_for('invoice_job_status', job_id=job_id)
+    }), 202
 
 
 # Crear usuario de demo al iniciar
 if __name__ == '__main__':
-    # Verificar si existe usuario demo
-    conn = sqlite3.connect(db.db_path)
-    cursor = conn.cursor()
+    # El caché de tarjetas pudo quedar de otra copia de la base de datos
+    if card_cache:
+        card_cache.clear()
     
-    cursor.execute('SELECT * FROM users WHERE username = ?', ('demo',))
-    if not cursor.fetchone():
-        password_hash = generate_password_hash('demo123')
-        cursor.execute('''
-            INSERT INTO users (username, email, password_hash)
-            VALUES (?, ?, ?)
-        ''', ('demo', 'demo@example.com', password_hash))
-        conn.commit()
-    
-    conn.close()
+    # Verificar si existe usuario demo
+    with db.transaction(immediate=True) as conn:
+        cursor = conn.execute('SELECT * FROM users WHERE username = ?', ('demo',))
+        if not cursor.fetchone():
+            password_hash = generate_password_hash('demo123')
+            conn.execute('''
+                INSERT INTO users (username, email, password_hash)
+                VALUES (?, ?, ?)
+            ''', ('demo', 'demo@example.com', password_hash))
     
     app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Benchmark de validación de tarjetas en lote
+Compara la validación una por una (Validator.validate_card_number y
+detect_brand en un ciclo de Python) contra card_validation.validate_cards,
+que valida todo el lote con NumPy, y verifica que den el mismo resultado
+
+Uso:
+    python benchmarks/card_validation.py
+    python benchmarks/card_validation.py --sizes 1000,100000 --repeat 5
+"""
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from card_validation import MAX_LENGTH, MIN_LENGTH, detect_brand, validate_cards
+from models import Validator
+
+PREFIXES = ('4', '51', '55', '2221', '34', '37', '6011', '65', '3528', '36', '9')
+
+# Longitudes inválidas y entradas sin dígitos: la marca debe coincidir con detect_brand
+EDGE_CASES = ('', '4', '4111', '34-12', '6011 00', '5' * 12, '4' * 20, '3528' + '0' * 30,
+              'abc', '4111-abcd', ' - ', None, 4111, '4' * 32, '4111-' * 7, '4' * 5000)
+
+
+def random_card():
+    """Número con prefijo de alguna marca y longitud de 13 a 19; la mitad pasa Luhn"""
+    prefix = random.choice(PREFIXES)
+    length = random.randint(MIN_LENGTH, MAX_LENGTH)
+    digits = [int(d) for d in prefix] + [random.randint(0, 9) for _ in range(length - len(prefix) - 1)]
+    total = sum(d if i % 2 else (2 * d if d < 5 else 2 * d - 9) for i, d in enumerate(reversed(digits)))
+    check = (10 - total % 10) % 10
+    if random.random() < 0.5:
+        check = (check + random.randint(1, 9)) % 10
+    return ''.join(map(str, digits)) + str(check)
+
+
+def scalar(card_numbers):
+    validator = Validator()
+    return [(validator.validate_card_number(number), detect_brand(number)) for number in card_numbers]
+
+
+def bulk(card_numbers):
+    checks = validate_cards(card_numbers)
+    return list(zip(checks['luhn_valid'].tolist(), checks['brand'].tolist()))
+
+
+def best_of(fn, card_numbers, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(card_numbers)
+        timings.append(time.perf_counter() - start)
+    return result, min(timings), statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Validación de tarjetas: ciclo de Python vs. NumPy')
+    parser.add_argument('--sizes', default='1000,10000,100000,1000000', help='tamaños de lote separados por coma')
+    parser.add_argument('--repeat', type=int, default=3, help='repeticiones por medición (se toma la mejor)')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    sizes = [int(size) for size in args.sizes.split(',') if size.strip()]
+    cards = [random_card() for _ in range(max(sizes))]
+
+    print("=" * 78)
+    print(f"VALIDACIÓN DE TARJETAS EN LOTE (semilla {args.seed}, mejor de {args.repeat})")
+    print("=" * 78)
+    print(f"  {'tarjetas':>10} {'escalar ms':>12} {'lote ms':>10} {'escalar/s':>12} {'lote/s':>12} {'mejora':>8}")
+
+    for size in sizes:
+        sample = cards[:size]
+        expected, scalar_best, _ = best_of(scalar, sample, args.repeat)
+        result, bulk_best, _ = best_of(bulk, sample, args.repeat)
+        if result != expected:
+            mismatches = sum(1 for a, b in zip(result, expected) if a != b)
+            print(f"❌ {mismatches} resultados distintos entre el ciclo y el lote con {size} tarjetas")
+            sys.exit(1)
+        print(f"  {size:>10,} {scalar_best * 1000:>12.1f} {bulk_best * 1000:>10.1f} "
+              f"{size / scalar_best:>12,.0f} {size / bulk_best:>12,.0f} {scalar_best / bulk_best:>7.1f}x")
+
+    edge_brands = validate_cards(EDGE_CASES)['brand'].tolist()
+    expected_brands = [detect_brand(number) for number in EDGE_CASES]
+    if edge_brands != expected_brands:
+        for number, got, expected in zip(EDGE_CASES, edge_brands, expected_brands):
+            if got != expected:
+                print(f"❌ Marca distinta para {number!r}: lote {got}, detect_brand {expected}")
+        sys.exit(1)
+
+    print("=" * 78)
+    print("✅ Ambos caminos coinciden en Luhn y marca para todas las tarjetas")
+
+
+if __name__ == '__main__':
+    main()
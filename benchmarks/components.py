@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks por componente
+Mide por separado las validaciones, las reglas de autorización, la
+generación de facturas y el armado de emails: operaciones por segundo,
+memoria asignada por operación (tracemalloc) y cómo escala cada uno al
+crecer los datos
+
+Uso:
+    python benchmarks/components.py
+    python benchmarks/components.py --only validator,rules --quick
+    python benchmarks/components.py --output componentes.json
+"""
+
+import argparse
+import gc
+import json
+import os
+import random
+import shutil
+import string
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from io import BytesIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from email_sender import EmailSender
+from invoice_generator import InvoiceGenerator
+from models import Database, PaymentRules, Validator
+from sample_data import SAMPLE_TRANSACTION
+
+
+def measure(fn, args_list, warmup=None, memory_samples=200):
+    """
+    Mide fn sobre cada tupla de args_list
+
+    Los argumentos se generan antes de medir para que su costo no cuente.
+    La memoria se mide en una segunda pasada (tracemalloc hace más lenta
+    cada asignación y alteraría los tiempos).
+
+    Returns:
+        dict: ops_per_sec, us_per_op, peak_kb_per_op, retained_b_per_op
+    """
+    warmup = warmup if warmup is not None else max(1, len(args_list) // 10)
+    for args in args_list[:warmup]:
+        fn(*args)
+
+    gc.collect()
+    start = time.perf_counter()
+    for args in args_list:
+        fn(*args)
+    elapsed = time.perf_counter() - start
+
+    # Memoria: pico por llamada y bytes que siguen vivos al terminar
+    sample = args_list[:memory_samples]
+    gc.collect()
+    tracemalloc.start()
+    peaks = []
+    baseline = tracemalloc.get_traced_memory()[0]
+    for args in sample:
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        fn(*args)
+        peaks.append(tracemalloc.get_traced_memory()[1] - before)
+    gc.collect()
+    retained = tracemalloc.get_traced_memory()[0] - baseline
+    tracemalloc.stop()
+
+    return {
+        'iterations': len(args_list),
+        'ops_per_sec': len(args_list) / elapsed,
+        'us_per_op': elapsed / len(args_list) * 1e6,
+        'peak_kb_per_op': sum(peaks) / len(peaks) / 1024,
+        'retained_b_per_op': retained / len(sample),
+    }
+
+
+def report(name, result):
+    print(f"  {name:<34} {result['ops_per_sec']:>11,.0f} ops/s {result['us_per_op']:>10.1f} µs "
+          f"{result['peak_kb_per_op']:>9.1f} KB {result['retained_b_per_op']:>9.0f} B")
+
+
+def report_scaling(label, rows):
+    """Imprime una curva tamaño -> ops/s relativa al tamaño más chico"""
+    first = rows[0][1]['us_per_op']
+    print(f"  {label:<22} {'ops/s':>11} {'µs/op':>10} {'vs. menor':>10}")
+    for size, result in rows:
+        print(f"  {size:<22,} {result['ops_per_sec']:>11,.0f} {result['us_per_op']:>10.1f} "
+              f"{result['us_per_op'] / first:>9.2f}x")
+
+
+def header(title):
+    print(f"\n{title}")
+    print(f"  {'':<34} {'':>17} {'tiempo':>13} {'pico':>12} {'retenido':>11}")
+
+
+def random_card():
+    digits = [random.randint(0, 9) for _ in range(15)]
+    total = sum(d if i % 2 else (2 * d if d < 5 else 2 * d - 9) for i, d in enumerate(reversed(digits)))
+    return ''.join(map(str, digits)) + str((10 - total % 10) % 10)
+
+
+def random_rfc():
+    return (''.join(random.choices(string.ascii_uppercase, k=4)) +
+            f'{random.randint(700101, 991231)}' + ''.join(random.choices(string.ascii_uppercase + string.digits, k=3)))
+
+
+def bench_validator(iterations, quick):
+    validator = Validator()
+    header(f"VALIDATOR ({iterations} llamadas)")
+    results = {
+        'luhn': measure(validator.validate_card_number, [(random_card(),) for _ in range(iterations)]),
+        'rfc': measure(validator.validate_rfc, [(random_rfc(),) for _ in range(iterations)]),
+        'email': measure(validator.validate_email,
+                         [(f'usuario{random.randint(0, 10**6)}@dominio{random.randint(0, 99)}.com',)
+                          for _ in range(iterations)]),
+        'nombre': measure(validator.validate_name, [(random.choice(['Juan Pérez García', 'María López',
+                                                                    'Ana Sofía Núñez-Ortega']),)
+                                                     for _ in range(iterations)]),
+    }
+    for name, result in results.items():
+        report(name, result)
+
+    # Las expresiones regulares deben escalar linealmente con la longitud de la entrada
+    scaling = {}
+    lengths = [16, 256, 4096] if quick else [16, 256, 4096, 65536]
+    for name, make in (('email', lambda n: 'a' * n + '@dominio.com'),
+                       ('nombre', lambda n: 'Juan ' * (n // 5)),
+                       ('email_invalido', lambda n: 'a.' * (n // 2) + '@')):
+        fn = validator.validate_name if name == 'nombre' else validator.validate_email
+        rows = [(n, measure(fn, [(make(n),)] * max(20, iterations // (n // 16)), memory_samples=20))
+                for n in lengths]
+        print()
+        report_scaling(f'{name} (chars)', rows)
+        scaling[name] = rows
+    results['scaling'] = {name: [dict(size=size, **r) for size, r in rows] for name, rows in scaling.items()}
+    return results
+
+
+def build_rules_db(path, cards):
+    """Base de datos con cards tarjetas y contadores de velocidad de la última hora"""
+    db = Database(path)
+    expiry = f'12/{(datetime.now().year + 3) % 100:02d}'
+    bucket = int(time.time()) // 60
+    with db.transaction(immediate=True) as conn:
+        conn.executemany(
+            'INSERT INTO cards (card_number, cardholder_name, expiry_date, cvv, balance) VALUES (?, ?, ?, ?, ?)',
+            ((f'4{i:015d}', 'Titular Prueba', expiry, '123', 50000.0) for i in range(cards))
+        )
+        for offset in (5, 30):
+            conn.execute('INSERT OR REPLACE INTO card_velocity (card_id, bucket, count) '
+                         'SELECT id, ?, 1 FROM cards', (bucket - offset,))
+    return db
+
+
+def bench_rules(iterations, quick, workdir):
+    sizes = [1_000, 10_000] if quick else [1_000, 10_000, 100_000]
+    header(f"PaymentRules.check_authorization ({iterations} llamadas, todas las reglas)")
+    rows = []
+    for size in sizes:
+        db = build_rules_db(os.path.join(workdir, f'reglas-{size}.db'), size)
+        rules = PaymentRules(db)
+        with db.connection() as conn:
+            cards = [db.get_card(conn, f'4{random.randrange(size):015d}') for _ in range(iterations)]
+            conn.execute('BEGIN')
+            result = measure(lambda card: rules.check_authorization(conn, card, card['expiry_date'],
+                                                                     card['cvv'], 100.0),
+                             [(card,) for card in cards])
+            # connection() revierte la transacción abierta al devolver la conexión
+        db.close_all()
+        report(f'{size:,} tarjetas', result)
+        rows.append((size, result))
+    print()
+    report_scaling('tarjetas', rows)
+    return {'scaling': [dict(size=size, **r) for size, r in rows]}
+
+
+def bench_invoice(iterations, quick):
+    generator = InvoiceGenerator()
+    generator.generate_invoice_pdf(SAMPLE_TRANSACTION)
+    iterations = max(20, iterations // 50)
+    header(f"InvoiceGenerator ({iterations} llamadas)")
+    results = {
+        'generate_invoice_pdf': measure(generator.generate_invoice_pdf,
+                                        [(dict(SAMPLE_TRANSACTION, id=100000 + i),) for i in range(iterations)],
+                                        memory_samples=20),
+        'generate_qr_code': measure(lambda data: generator.generate_qr_code(data, memoize=False),
+                                    [(f'MU-F{i:015d}-{i}',) for i in range(iterations)], memory_samples=20),
+        'generate_qr_code (memoizado)': measure(generator.generate_qr_code,
+                                                [(f'MU-F{i % 10:015d}-{i % 10}',) for i in range(iterations)],
+                                                memory_samples=20),
+    }
+    for name, result in results.items():
+        report(name, result)
+
+    # El QR crece de versión con el contenido: más módulos que calcular y dibujar
+    lengths = [32, 128, 512] if quick else [32, 128, 512, 1024]
+    rows = [(n, measure(lambda data: generator.generate_qr_code(data, memoize=False),
+                        [(f'{i:08d}' + 'x' * (n - 8),) for i in range(iterations)], memory_samples=10))
+            for n in lengths]
+    print()
+    report_scaling('QR (chars)', rows)
+    results['qr_scaling'] = [dict(size=size, **r) for size, r in rows]
+    return results
+
+
+def bench_email(iterations, quick):
+    sender = EmailSender(simulate=True, pool_size=0)
+    pdf = InvoiceGenerator().generate_invoice_pdf(SAMPLE_TRANSACTION).getvalue()
+    header(f"EmailSender ({iterations} llamadas)")
+
+    def build(invoice_number, data):
+        message = sender.build_invoice_message('cliente@example.com', invoice_number, BytesIO(pdf), data)
+        return sender.message_bytes(message)
+
+    results = {
+        '_create_email_body': measure(sender._create_email_body,
+                                      [(f'F{i:015d}', dict(SAMPLE_TRANSACTION, id=i)) for i in range(iterations)]),
+        'mensaje MIME completo': measure(build, [(f'F{i:015d}', dict(SAMPLE_TRANSACTION, id=i))
+                                                 for i in range(max(20, iterations // 10))], memory_samples=50),
+    }
+    for name, result in results.items():
+        report(name, result)
+    return results
+
+
+BENCHMARKS = ('validator', 'rules', 'invoice', 'email')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Micro-benchmarks de componentes de MU')
+    parser.add_argument('--iterations', type=int, default=5000, help='llamadas por medición')
+    parser.add_argument('--only', default=','.join(BENCHMARKS), help='componentes separados por coma')
+    parser.add_argument('--quick', action='store_true', help='menos tamaños en las curvas de escala')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='guardar los resultados en este archivo JSON')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    selected = [name.strip() for name in args.only.split(',') if name.strip()]
+    unknown = set(selected) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f'componentes desconocidos: {", ".join(sorted(unknown))}')
+
+    print("=" * 86)
+    print(f"MICRO-BENCHMARKS (semilla {args.seed}, {args.iterations} iteraciones)")
+    print("=" * 86)
+
+    workdir = tempfile.mkdtemp(prefix='mu-bench-')
+    results = {'started_at': datetime.now().isoformat(timespec='seconds'), 'config': vars(args)}
+    try:
+        for name in selected:
+            if name == 'validator':
+                results[name] = bench_validator(args.iterations, args.quick)
+            elif name == 'rules':
+                results[name] = bench_rules(args.iterations, args.quick, workdir)
+            elif name == 'invoice':
+                results[name] = bench_invoice(args.iterations, args.quick)
+            elif name == 'email':
+                results[name] = bench_email(args.iterations, args.quick)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print("=" * 86)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+        print(f"💾 Resultados guardados en {args.output}")
+
+
+if __name__ == '__main__':
+    main()
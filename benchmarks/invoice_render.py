@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Benchmark de generación de facturas PDF
+Compara el armado completo con platypus contra la plantilla compilada
+"""
+
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from invoice_generator import InvoiceGenerator
+from sample_data import SAMPLE_TRANSACTION
+
+
+def measure(render, iterations, first_id=1):
+    """
+    Ejecuta render iterations veces y retorna los tiempos en milisegundos
+
+    Cada llamada usa un id distinto a partir de first_id para que el QR
+    memoizado de una medición no favorezca a otra.
+    """
+    timings = []
+    for i in range(iterations):
+        data = dict(SAMPLE_TRANSACTION, id=first_id + i)
+        start = time.perf_counter()
+        render(data)
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def report(name, timings):
+    timings = sorted(timings)
+    p95 = timings[int(len(timings) * 0.95) - 1]
+    print(f"{name:<22} media {statistics.mean(timings):7.2f} ms   "
+          f"p50 {statistics.median(timings):7.2f} ms   p95 {p95:7.2f} ms")
+
+
+def main(iterations=200):
+    generator = InvoiceGenerator()
+
+    # Calentamiento: compila la plantilla y carga fuentes
+    generator.generate_invoice_pdf(SAMPLE_TRANSACTION)
+    generator.generate_invoice_pdf_platypus(SAMPLE_TRANSACTION)
+
+    print("=" * 72)
+    print(f"BENCHMARK DE FACTURAS PDF ({iterations} facturas por método)")
+    print("=" * 72)
+
+    platypus = measure(generator.generate_invoice_pdf_platypus, iterations, first_id=100000)
+    compiled = measure(generator.generate_invoice_pdf, iterations, first_id=200000)
+    repeated = measure(generator.generate_invoice_pdf, iterations, first_id=200000)
+
+    def qr(memoize):
+        return lambda data: generator.generate_qr_code(
+            f"MU-{data['invoice_number']}-{data['id']}", memoize=memoize)
+
+    qr_cold = measure(qr(False), iterations, first_id=300000)
+    qr_cached = measure(qr(True), iterations, first_id=200000)
+
+    report('platypus', platypus)
+    report('plantilla compilada', compiled)
+    report('  (folios repetidos)', repeated)
+    report('código QR', qr_cold)
+    report('  (memoizado)', qr_cached)
+
+    speedup = statistics.mean(platypus) / statistics.mean(compiled)
+    print("-" * 72)
+    print(f"⚡ Aceleración por factura: {speedup:.2f}x")
+    print("=" * 72)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
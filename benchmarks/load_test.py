@@ -0,0 +1,477 @@
+#!/usr/bin/env python3
+"""
+Prueba de carga HTTP de extremo a extremo
+Levanta la aplicación con gunicorn sobre una base de datos temporal, la
+llena con datos realistas y mide throughput y latencias por endpoint
+
+Uso:
+    python benchmarks/load_test.py --duration 30 --concurrency 16
+    python benchmarks/load_test.py --output benchmarks/baseline.json
+    python benchmarks/load_test.py --baseline benchmarks/baseline.json
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+import requests
+from werkzeug.security import generate_password_hash
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from ledger import Ledger
+from models import Database
+
+PASSWORD = 'carga123'
+
+# Peso de cada acción en la mezcla de tráfico
+WORKLOAD = {
+    'login': 5,
+    'payment': 30,
+    'history': 20,
+    'dashboard': 30,
+    'invoice': 15,
+}
+
+# Mezcla de pagos: la mayoría se autoriza y el resto se rechaza por distintas reglas
+PAYMENT_MIX = {
+    'valid': 80,
+    'wrong_cvv': 8,
+    'insufficient_funds': 7,
+    'invalid_data': 5,
+}
+
+# Códigos HTTP esperados por endpoint (cualquier otro cuenta como error)
+EXPECTED_STATUS = {
+    'POST /login': {302},
+    'POST /api/process-payment': {200, 400},
+    'GET /history': {200},
+    'GET /dashboard': {200},
+    'GET /api/invoice/<id>/download': {200},
+}
+
+FIRST_NAMES = ['Juan', 'María', 'Carlos', 'Ana', 'Pedro', 'Lucía', 'Jorge', 'Sofía', 'Luis', 'Elena']
+LAST_NAMES = ['Pérez', 'López', 'García', 'Hernández', 'Martínez', 'Sánchez', 'Ramírez', 'Torres']
+
+
+def luhn_complete(prefix, length=16):
+    """Completa prefix con dígitos aleatorios y el dígito verificador de Luhn"""
+    digits = prefix + ''.join(random.choice('0123456789') for _ in range(length - len(prefix) - 1))
+    total = 0
+    for i, digit in enumerate(reversed(digits)):
+        value = int(digit)
+        if i % 2 == 0:
+            value *= 2
+            if value > 9:
+                value -= 9
+        total += value
+    return digits + str((10 - total % 10) % 10)
+
+
+def random_rfc():
+    letters = ''.join(random.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ') for _ in range(4))
+    return f'{letters}{random.randint(700101, 991231):06d}{random.randint(100, 999)}'
+
+
+def seed(db_path, users, cards, history):
+    """
+    Crea la base de datos temporal con usuarios, tarjetas e historial
+
+    Returns:
+        dict: usuarios (con sus transacciones autorizadas) y tarjetas para la prueba
+    """
+    db = Database(db_path)
+    ledger = Ledger()
+    password_hash = generate_password_hash(PASSWORD)
+    expiry = f'12/{(datetime.now().year + 3) % 100:02d}'
+    now = datetime.now()
+
+    with db.transaction(immediate=True) as conn:
+        seeded_cards = []
+        for i in range(cards):
+            # Una de cada 20 tarjetas tiene saldo bajo para provocar rechazos por fondos
+            balance = 100.0 if i % 20 == 0 else round(random.uniform(20000, 80000), 2)
+            card = {
+                'card_number': luhn_complete(random.choice(['4', '51', '52', '55'])),
+                'cardholder_name': f'{random.choice(FIRST_NAMES)} {random.choice(LAST_NAMES)}',
+                'expiry_date': expiry,
+                'cvv': f'{random.randint(100, 999)}',
+                'balance': balance,
+            }
+            cursor = conn.execute('''
+                INSERT INTO cards (card_number, cardholder_name, expiry_date, cvv, balance)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (card['card_number'], card['cardholder_name'], card['expiry_date'], card['cvv'], balance))
+            card['id'] = cursor.lastrowid
+            seeded_cards.append(card)
+
+        seeded_users = []
+        for i in range(users):
+            user = {
+                'username': f'carga{i:04d}',
+                'full_name': f'{random.choice(FIRST_NAMES)} {random.choice(LAST_NAMES)} {random.choice(LAST_NAMES)}',
+                'rfc': random_rfc(),
+                'transactions': [],
+            }
+            cursor = conn.execute('INSERT INTO users (username, email, password_hash) VALUES (?, ?, ?)',
+                                  (user['username'], f'{user["username"]}@example.com', password_hash))
+            user['id'] = cursor.lastrowid
+
+            for j in range(history):
+                card = random.choice(seeded_cards)
+                timestamp = (now - timedelta(minutes=random.randint(60 * 24, 60 * 24 * 365))).strftime('%Y-%m-%d %H:%M:%S')
+                authorized = random.random() < 0.85
+                amount = round(random.uniform(50, 3000), 2)
+                cursor = conn.execute('''
+                    INSERT INTO transactions (amount, status, rejection_reason, card_id, user_id, rfc,
+                                              full_name, invoice_number, timestamp)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', (
+                    amount,
+                    'autorizado' if authorized else 'rechazado',
+                    None if authorized else 'Fondos insuficientes',
+                    card['id'], user['id'], user['rfc'], user['full_name'],
+                    f'FH{user["id"]:05d}{j:06d}' if authorized else None,
+                    timestamp
+                ))
+                if authorized:
+                    user['transactions'].append(cursor.lastrowid)
+                    # El cargo en el libro de saldos, como lo registra PaymentRules
+                    ledger.record(conn, card['id'], 'cargo', -amount, cursor.lastrowid)
+            seeded_users.append(user)
+
+    db.rebuild_user_stats()
+    db.close_all()
+    return {'users': seeded_users, 'cards': seeded_cards}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(workdir, port, workers, threads, log_path):
+    """Arranca gunicorn con gunicorn_config.py apuntando a los datos temporales"""
+    env = dict(
+        os.environ,
+        DATABASE_PATH=os.path.join(workdir, 'payments.db'),
+        INVOICE_JOB_DIR=os.path.join(workdir, 'invoice_jobs'),
+        INVOICE_CACHE_DIR=os.path.join(workdir, 'invoice_cache'),
+        PROMETHEUS_MULTIPROC_DIR=os.path.join(workdir, 'metrics'),
+        CARD_CACHE_PATH=os.path.join(workdir, 'card_cache.bin'),
+        SMTP_SIMULATE='1',
+        GUNICORN_WORKERS=str(workers),
+        GUNICORN_THREADS=str(threads),
+    )
+    env.pop('DB_POOL_SIZE', None)
+    log = open(log_path, 'w')
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '--config', 'gunicorn_config.py',
+         '--bind', f'127.0.0.1:{port}', '--error-logfile', '-', '--access-logfile', '/dev/null',
+         'app:app'],
+        cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT
+    )
+
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'gunicorn terminó al arrancar (ver {log_path})')
+        try:
+            requests.get(f'http://127.0.0.1:{port}/login', timeout=1)
+            return process
+        except (requests.ConnectionError, requests.Timeout):
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f'gunicorn no respondió en 30 s (ver {log_path})')
+
+
+class VirtualUser:
+    """Usuario simulado con su propia sesión (cookies y conexión keep-alive)"""
+
+    def __init__(self, base_url, user, cards, rng):
+        self.base_url = base_url
+        self.user = user
+        self.cards = cards
+        self.low_balance_cards = [card for card in cards if card['balance'] < 1000]
+        self.rng = rng
+        self.session = requests.Session()
+        self.transactions = list(user['transactions'])
+
+    def login(self):
+        response = self.session.post(f'{self.base_url}/login', allow_redirects=False,
+                                     data={'username': self.user['username'], 'password': PASSWORD})
+        return 'POST /login', response
+
+    def payment(self):
+        kind = self.rng.choices(list(PAYMENT_MIX), weights=list(PAYMENT_MIX.values()))[0]
+        card = self.rng.choice(self.low_balance_cards if kind == 'insufficient_funds' else self.cards)
+        payment = {
+            'full_name': self.user['full_name'],
+            'rfc': self.user['rfc'],
+            'card_number': card['card_number'],
+            'expiry_date': card['expiry_date'],
+            'cvv': card['cvv'],
+            'amount': round(self.rng.uniform(500, 900) if kind == 'insufficient_funds'
+                            else self.rng.lognormvariate(6, 0.8), 2),
+        }
+        payment['amount'] = min(payment['amount'], 9999)
+        if kind == 'wrong_cvv':
+            payment['cvv'] = f'{(int(card["cvv"]) + 1) % 900 + 100}'
+        elif kind == 'invalid_data':
+            payment['expiry_date'] = '01/20'
+
+        response = self.session.post(f'{self.base_url}/api/process-payment', json=payment)
+        if response.status_code == 200:
+            self.transactions.append(response.json()['transaction_id'])
+        return 'POST /api/process-payment', response
+
+    def history(self):
+        return 'GET /history', self.session.get(f'{self.base_url}/history')
+
+    def dashboard(self):
+        return 'GET /dashboard', self.session.get(f'{self.base_url}/dashboard')
+
+    def invoice(self):
+        if not self.transactions:
+            return self.dashboard()
+        transaction_id = self.rng.choice(self.transactions)
+        response = self.session.get(f'{self.base_url}/api/invoice/{transaction_id}/download')
+        return 'GET /api/invoice/<id>/download', response
+
+
+def percentile(sorted_values, q):
+    """Percentil por rango más cercano"""
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, int(round(q / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def run_load(base_url, seeded, concurrency, duration, warmup, think_time, seed_value):
+    """
+    Ejecuta la mezcla de tráfico con concurrency usuarios durante duration segundos
+
+    Returns:
+        dict: endpoint -> {'latencies': [...], 'statuses': {...}, 'errors': int}
+    """
+    samples = {}
+    lock = threading.Lock()
+    start = time.monotonic()
+    record_from = start + warmup
+    stop_at = record_from + duration
+
+    def worker(index):
+        rng = random.Random(seed_value + index)
+        user = VirtualUser(base_url, seeded['users'][index % len(seeded['users'])], seeded['cards'], rng)
+        user.login()
+        actions = list(WORKLOAD)
+        weights = list(WORKLOAD.values())
+        local = {}
+
+        while True:
+            now = time.monotonic()
+            if now >= stop_at:
+                break
+            action = getattr(user, rng.choices(actions, weights=weights)[0])
+            began = time.perf_counter()
+            try:
+                endpoint, response = action()
+                status = response.status_code
+            except requests.RequestException as e:
+                endpoint, status = action.__name__, type(e).__name__
+            elapsed = time.perf_counter() - began
+
+            if now >= record_from:
+                stats = local.setdefault(endpoint, {'latencies': [], 'statuses': {}, 'errors': 0})
+                stats['latencies'].append(elapsed * 1000)
+                stats['statuses'][str(status)] = stats['statuses'].get(str(status), 0) + 1
+                if status not in EXPECTED_STATUS.get(endpoint, ()):
+                    stats['errors'] += 1
+            if think_time:
+                time.sleep(rng.expovariate(1 / think_time))
+
+        with lock:
+            for endpoint, stats in local.items():
+                total = samples.setdefault(endpoint, {'latencies': [], 'statuses': {}, 'errors': 0})
+                total['latencies'].extend(stats['latencies'])
+                total['errors'] += stats['errors']
+                for status, count in stats['statuses'].items():
+                    total['statuses'][status] = total['statuses'].get(status, 0) + count
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples
+
+
+def summarize(samples, duration):
+    """Throughput y percentiles por endpoint y en total"""
+    def stats(latencies, errors, statuses):
+        latencies = sorted(latencies)
+        return {
+            'requests': len(latencies),
+            'errors': errors,
+            'throughput': len(latencies) / duration,
+            'mean_ms': sum(latencies) / len(latencies) if latencies else 0.0,
+            'p50_ms': percentile(latencies, 50),
+            'p95_ms': percentile(latencies, 95),
+            'p99_ms': percentile(latencies, 99),
+            'max_ms': latencies[-1] if latencies else 0.0,
+            'statuses': statuses,
+        }
+
+    endpoints = {endpoint: stats(s['latencies'], s['errors'], s['statuses'])
+                 for endpoint, s in sorted(samples.items())}
+    all_latencies = [latency for s in samples.values() for latency in s['latencies']]
+    total = stats(all_latencies, sum(s['errors'] for s in samples.values()), {})
+    del total['statuses']
+    return endpoints, total
+
+
+def report(endpoints, total):
+    print(f"{'endpoint':<32} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errores':>8}")
+    print("-" * 78)
+    for endpoint, s in list(endpoints.items()) + [('TOTAL', total)]:
+        print(f"{endpoint:<32} {s['throughput']:8.1f} {s['p50_ms']:8.1f} {s['p95_ms']:8.1f} "
+              f"{s['p99_ms']:8.1f} {s['errors']:8d}")
+
+    payments = endpoints.get('POST /api/process-payment')
+    if payments:
+        authorized = payments['statuses'].get('200', 0)
+        print(f"\n💳 Pagos autorizados: {authorized}/{payments['requests']} "
+              f"({authorized / max(payments['requests'], 1):.0%})")
+
+
+def compare(results, baseline, threshold):
+    """
+    Compara contra una corrida guardada
+
+    Es regresión si el p95 sube o el throughput baja más de threshold
+    (fracción), o si aparecen errores donde no los había.
+
+    Returns:
+        list: Descripción de cada regresión
+    """
+    regressions = []
+    print(f"\n📐 Comparación contra la línea base ({baseline.get('started_at', '?')})")
+    print(f"{'endpoint':<32} {'req/s':>16} {'p95 ms':>18}")
+    print("-" * 78)
+    current_endpoints = dict(results['endpoints'], TOTAL=results['total'])
+    base_endpoints = dict(baseline['endpoints'], TOTAL=baseline['total'])
+
+    for endpoint, current in current_endpoints.items():
+        base = base_endpoints.get(endpoint)
+        if not base:
+            continue
+        throughput_change = current['throughput'] / base['throughput'] - 1 if base['throughput'] else 0.0
+        p95_change = current['p95_ms'] / base['p95_ms'] - 1 if base['p95_ms'] else 0.0
+        flags = []
+        if throughput_change < -threshold:
+            flags.append(f'throughput {throughput_change:+.0%}')
+        if p95_change > threshold:
+            flags.append(f'p95 {p95_change:+.0%}')
+        if current['errors'] and not base['errors']:
+            flags.append(f'{current["errors"]} errores nuevos')
+
+        print(f"{endpoint:<32} {current['throughput']:8.1f} ({throughput_change:+5.0%}) "
+              f"{current['p95_ms']:9.1f} ({p95_change:+5.0%})" + ('  ⚠️' if flags else ''))
+        if flags:
+            regressions.append(f'{endpoint}: {", ".join(flags)}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Prueba de carga HTTP de MU')
+    parser.add_argument('--duration', type=float, default=30, help='segundos medidos')
+    parser.add_argument('--warmup', type=float, default=5, help='segundos de calentamiento sin medir')
+    parser.add_argument('--concurrency', type=int, default=16, help='usuarios simultáneos')
+    parser.add_argument('--think-time', type=float, default=0.0, help='pausa media entre peticiones (s)')
+    parser.add_argument('--users', type=int, default=50, help='usuarios en la base de datos')
+    parser.add_argument('--cards', type=int, default=2000, help='tarjetas en la base de datos')
+    parser.add_argument('--history', type=int, default=200, help='transacciones previas por usuario')
+    parser.add_argument('--workers', type=int, default=2, help='workers de gunicorn')
+    parser.add_argument('--threads', type=int, default=8, help='hilos por worker de gunicorn')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='guardar los resultados en este archivo JSON')
+    parser.add_argument('--baseline', help='JSON de una corrida anterior para detectar regresiones')
+    parser.add_argument('--threshold', type=float, default=0.2, help='tolerancia de regresión (0.2 = 20%%)')
+    parser.add_argument('--keep', action='store_true', help='conservar el directorio temporal')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    workdir = tempfile.mkdtemp(prefix='mu-carga-')
+    log_path = os.path.join(workdir, 'gunicorn.log')
+    port = free_port()
+    server = None
+
+    print("=" * 78)
+    print(f"PRUEBA DE CARGA ({args.concurrency} usuarios, {args.duration:.0f} s, "
+          f"gunicorn {args.workers}x{args.threads})")
+    print("=" * 78)
+
+    try:
+        print(f"🌱 Creando datos: {args.users} usuarios, {args.cards} tarjetas, "
+              f"{args.users * args.history} transacciones en {workdir}")
+        seeded = seed(os.path.join(workdir, 'payments.db'), args.users, args.cards, args.history)
+
+        server = start_server(workdir, port, args.workers, args.threads, log_path)
+        print(f"🚀 Servidor en http://127.0.0.1:{port} (calentamiento {args.warmup:.0f} s)\n")
+
+        started_at = datetime.now().isoformat(timespec='seconds')
+        samples = run_load(f'http://127.0.0.1:{port}', seeded, args.concurrency, args.duration,
+                           args.warmup, args.think_time, args.seed)
+        endpoints, total = summarize(samples, args.duration)
+        report(endpoints, total)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait(timeout=30)
+        if args.keep:
+            print(f"\n📁 Datos y log en {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    results = {
+        'started_at': started_at,
+        'config': {key: value for key, value in vars(args).items()
+                   if key not in ('output', 'baseline', 'keep')},
+        'workload': WORKLOAD,
+        'payment_mix': PAYMENT_MIX,
+        'endpoints': endpoints,
+        'total': total,
+    }
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+        print(f"\n💾 Resultados guardados en {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        print("=" * 78)
+        if regressions:
+            print("❌ Regresiones detectadas:")
+            for regression in regressions:
+                print(f"   • {regression}")
+            sys.exit(1)
+        print("✅ Sin regresiones")
+    print("=" * 78)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,18 @@
+"""
+Datos de ejemplo compartidos por los benchmarks
+"""
+
+# Factura de ejemplo (ver InvoiceGenerator.generate_invoice_pdf)
+SAMPLE_TRANSACTION = {
+    'id': 1234,
+    'amount': 1500.0,
+    'status': 'Autorizado',
+    'timestamp': '2025-01-15 10:30:00',
+    'date': '2025-01-15',
+    'time': '10:30:00',
+    'card_last4': '0366',
+    'cardholder_name': 'Juan Pérez',
+    'rfc': 'PEGJ800101AB1',
+    'full_name': 'Juan Pérez García',
+    'invoice_number': 'F202501151030001',
+}
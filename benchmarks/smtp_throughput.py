@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Benchmark de envío de emails de facturas
+Compara una conexión SMTP por mensaje contra el pool de conexiones y el
+envío masivo concurrente, usando aiosmtpd como servidor SMTP local
+
+Requiere: pip install aiosmtpd
+"""
+
+import asyncio
+import os
+import sys
+import time
+from io import BytesIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    from aiosmtpd.controller import Controller
+except ImportError:
+    print("❌ Este benchmark necesita aiosmtpd: pip install aiosmtpd")
+    sys.exit(1)
+
+from email_sender import EmailSender
+from invoice_generator import InvoiceGenerator
+from sample_data import SAMPLE_TRANSACTION
+
+HOST = '127.0.0.1'
+PORT = 8025
+
+
+class SlowHandshakeHandler:
+    """
+    Servidor que simula las latencias de un servidor SMTP real
+
+    aiosmtpd local no tiene TLS ni autenticación; el costo de STARTTLS + AUTH
+    se simula retrasando la respuesta a EHLO y el de aceptar el mensaje
+    retrasando la respuesta a DATA.
+    """
+
+    def __init__(self, handshake_latency, data_latency):
+        self.handshake_latency = handshake_latency
+        self.data_latency = data_latency
+        self.received = 0
+
+    async def handle_EHLO(self, server, session, envelope, hostname, responses):
+        await asyncio.sleep(self.handshake_latency)
+        session.host_name = hostname
+        return responses
+
+    async def handle_DATA(self, server, session, envelope):
+        await asyncio.sleep(self.data_latency)
+        self.received += 1
+        return '250 OK'
+
+
+def run(name, sender, messages, bulk):
+    start = time.perf_counter()
+    if bulk:
+        results = sender.send_bulk(messages)
+        failed = sum(1 for result in results if not result['success'])
+    else:
+        failed = 0
+        for to_email, message in messages:
+            sender.deliver(to_email, message)
+    elapsed = time.perf_counter() - start
+    if sender.pool:
+        sender.pool.close_all()
+
+    print(f"{name:<34} {elapsed:7.2f} s   {len(messages) / elapsed:8.1f} emails/s"
+          + (f"   ❌ {failed} fallidos" if failed else ''))
+    return elapsed
+
+
+def main(count=500, handshake_latency=0.02, data_latency=0.005):
+    handler = SlowHandshakeHandler(handshake_latency, data_latency)
+    controller = Controller(handler, hostname=HOST, port=PORT)
+    controller.start()
+
+    try:
+        options = dict(smtp_host=HOST, smtp_port=PORT, use_tls=False, simulate=False)
+        template = EmailSender(**options, pool_size=0)
+        pdf = InvoiceGenerator().generate_invoice_pdf(SAMPLE_TRANSACTION).getvalue()
+        message = template.message_bytes(template.build_invoice_message(
+            'cliente@example.com', SAMPLE_TRANSACTION['invoice_number'], BytesIO(pdf), SAMPLE_TRANSACTION))
+        messages = [(f'cliente{i}@example.com', message) for i in range(count)]
+
+        print("=" * 72)
+        print(f"BENCHMARK SMTP ({count} emails de {len(message) / 1024:.1f} KB, "
+              f"handshake {handshake_latency * 1000:.0f} ms, DATA {data_latency * 1000:.0f} ms)")
+        print("=" * 72)
+
+        baseline = run('conexión por mensaje', EmailSender(**options, pool_size=0), messages, bulk=False)
+        pooled = run('pool (1 hilo)', EmailSender(**options, pool_size=1), messages, bulk=False)
+        bulk = run('envío masivo (pool de 4)', EmailSender(**options, pool_size=4), messages, bulk=True)
+
+        print("-" * 72)
+        print(f"⚡ Pool vs conexión por mensaje: {baseline / pooled:.2f}x")
+        print(f"⚡ Envío masivo vs conexión por mensaje: {baseline / bulk:.2f}x")
+        print(f"📬 Mensajes recibidos por el servidor: {handler.received}")
+        print("=" * 72)
+    finally:
+        controller.stop()
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    handshake_ms = float(sys.argv[2]) if len(sys.argv) > 2 else 20
+    data_ms = float(sys.argv[3]) if len(sys.argv) > 3 else 5
+    main(count, handshake_ms / 1000, data_ms / 1000)
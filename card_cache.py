@@ -0,0 +1,207 @@
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+import metrics
+
+
+class CardCache:
+    """
+    Caché de tarjetas compartido por todos los workers
+
+    Las entradas viven en un archivo mapeado en memoria (CARD_CACHE_PATH)
+    con una ranura fija por tarjeta, elegida por hash del número: los
+    workers de gunicorn leen la misma memoria sin pasar por SQLite y una
+    tarjeta nueva que cae en una ranura ocupada reemplaza a la anterior.
+
+    Cada entrada guarda la fila completa de la tarjeta (ver
+    Database.CARD_COLUMNS) con su columna version. El caché nunca decide
+    por sí solo: PaymentRules escribe el cargo o el intento fallido con
+    "AND version = ?", así que una entrada vieja solo provoca que la
+    tarjeta se vuelva a leer de la base de datos (ver
+    PaymentRules.process_payment). Las entradas se escriben después del
+    commit, de modo que el caché solo contiene estados confirmados.
+
+    Lecturas sin candado: cada ranura lleva un contador de secuencia (impar
+    mientras se escribe) y un CRC del contenido; una lectura que se cruza
+    con una escritura se descarta como fallo. Las escrituras se serializan
+    con flock entre procesos.
+    """
+
+    MAGIC = b'MUCC'
+    LAYOUT = 2
+    HEADER = struct.Struct('<4sIII')
+    HEADER_SIZE = 64
+    # seq, crc | id, version, ledger_snapshot_id, balance, attempts_count, is_verified,
+    # is_blocked, card_number, expiry_date, cvv, last_attempt, cardholder_name
+    PREFIX = struct.Struct('<II')
+    ENTRY = struct.Struct('<qqqdiBB24s8s8s20s96s')
+    SLOT_SIZE = PREFIX.size + ENTRY.size
+
+    def __init__(self, path=None, slots=None):
+        """
+        Args:
+            path: Archivo del caché (CARD_CACHE_PATH, por defecto database/card_cache.bin)
+            slots: Número de ranuras (CARD_CACHE_SLOTS, por defecto 65536)
+        """
+        self.path = path or os.environ.get('CARD_CACHE_PATH', 'database/card_cache.bin')
+        self.slots = slots or int(os.environ.get('CARD_CACHE_SLOTS', 65536))
+        self._map = None
+        self._fd = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _mapped(self):
+        """
+        Retorna el mapa del proceso actual
+
+        Se abre de nuevo después de un fork: flock se comparte entre procesos
+        que heredan el mismo descriptor y no los excluiría entre sí.
+        """
+        pid = os.getpid()
+        if self._pid == pid:
+            return self._map
+        with self._lock:
+            if self._pid != pid:
+                self._open()
+                self._pid = pid
+        return self._map
+
+    def _open(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Contiene CVV y balances: solo legible por el usuario del servicio
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        size = self.HEADER_SIZE + self.slots * self.SLOT_SIZE
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            header = os.pread(fd, self.HEADER.size, 0)
+            expected = self.HEADER.pack(self.MAGIC, self.LAYOUT, self.SLOT_SIZE, self.slots)
+            if header != expected or os.fstat(fd).st_size != size:
+                # Archivo nuevo o de otra versión/tamaño: se empieza vacío
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+                os.pwrite(fd, expected, 0)
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        self._map = mmap.mmap(fd, size)
+        self._fd = fd
+
+    def _offset(self, card_number):
+        return self.HEADER_SIZE + (zlib.crc32(card_number.encode('utf-8')) % self.slots) * self.SLOT_SIZE
+
+    def _read(self, card_number):
+        """Entrada de la tarjeta o None si la ranura es de otra tarjeta, está vacía o se está escribiendo"""
+        data = self._mapped()
+        offset = self._offset(card_number)
+        seq, crc = self.PREFIX.unpack_from(data, offset)
+        payload = data[offset + self.PREFIX.size:offset + self.SLOT_SIZE]
+        if seq % 2 or self.PREFIX.unpack_from(data, offset)[0] != seq or zlib.crc32(payload) != crc:
+            return None
+        (card_id, version, ledger_snapshot_id, balance, attempts_count, is_verified, is_blocked,
+         number, expiry_date, cvv, last_attempt, cardholder_name) = self.ENTRY.unpack(payload)
+        if card_id == 0 or number.rstrip(b'\0').decode('utf-8') != card_number:
+            return None
+        return {
+            'id': card_id,
+            'card_number': card_number,
+            'cardholder_name': cardholder_name.rstrip(b'\0').decode('utf-8'),
+            'expiry_date': expiry_date.rstrip(b'\0').decode('utf-8'),
+            'cvv': cvv.rstrip(b'\0').decode('utf-8'),
+            'balance': balance,
+            'is_verified': is_verified,
+            'attempts_count': attempts_count,
+            'last_attempt': last_attempt.rstrip(b'\0').decode('utf-8') or None,
+            'is_blocked': is_blocked,
+            'version': version,
+            'ledger_snapshot_id': ledger_snapshot_id,
+        }
+
+    def get(self, card_number):
+        """
+        Busca una tarjeta en el caché
+
+        Returns:
+            dict como Database.get_card o None si no está
+        """
+        card = self._read(card_number)
+        metrics.CARD_CACHE.labels('hit' if card else 'miss').inc()
+        return card
+
+    def _pack(self, card):
+        """Contenido de la ranura o None si la tarjeta no cabe en el formato fijo"""
+        try:
+            text = {}
+            for name, size in (('card_number', 24), ('expiry_date', 8), ('cvv', 8),
+                               ('last_attempt', 20), ('cardholder_name', 96)):
+                value = (card[name] or '').encode('utf-8')
+                if len(value) > size or b'\0' in value:
+                    return None
+                text[name] = value
+            return self.ENTRY.pack(
+                card['id'], card['version'], card['ledger_snapshot_id'], card['balance'],
+                card['attempts_count'], card['is_verified'], card['is_blocked'], text['card_number'],
+                text['expiry_date'], text['cvv'], text['last_attempt'], text['cardholder_name'])
+        except (struct.error, TypeError, AttributeError):
+            # Valores NULL o de otro tipo: la tarjeta se lee siempre de la base de datos
+            return None
+
+    def put(self, card):
+        """
+        Guarda el estado confirmado de una tarjeta
+
+        Se llama después del commit (ver TimedConnection.after_commit). Un
+        error al escribir el caché no afecta al pago: la entrada solo se omite.
+
+        Returns:
+            bool: True si la entrada quedó escrita o ya estaba al día
+        """
+        try:
+            cached = self._read(card['card_number'])
+            if cached is not None and cached['version'] == card['version'] and cached['id'] == card['id']:
+                return True
+            payload = self._pack(card)
+            if payload is None:
+                return False
+            self._write(card['card_number'], payload)
+            return True
+        except (OSError, ValueError) as e:
+            print(f"[CACHE] No se pudo guardar la tarjeta {card.get('id')} en el caché: {e}")
+            return False
+
+    def mark_stale(self, card_number):
+        """Descarta la entrada de una tarjeta que resultó desactualizada"""
+        metrics.CARD_CACHE.labels('stale').inc()
+        try:
+            if self._read(card_number) is not None:
+                self._write(card_number, bytes(self.ENTRY.size))
+        except (OSError, ValueError) as e:
+            print(f"[CACHE] No se pudo descartar la tarjeta del caché: {e}")
+
+    def _write(self, card_number, payload):
+        data = self._mapped()
+        offset = self._offset(card_number)
+        with self._lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                seq = self.PREFIX.unpack_from(data, offset)[0]
+                # Impar mientras se escribe: los lectores descartan la ranura
+                self.PREFIX.pack_into(data, offset, seq | 1, 0)
+                data[offset + self.PREFIX.size:offset + self.SLOT_SIZE] = payload
+                self.PREFIX.pack_into(data, offset, ((seq | 1) + 1) & 0xFFFFFFFF, zlib.crc32(payload))
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def clear(self):
+        """Vacía el caché (p. ej. después de restaurar la base de datos)"""
+        data = self._mapped()
+        with self._lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                data[self.HEADER_SIZE:] = bytes(len(data) - self.HEADER_SIZE)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
@@ -0,0 +1,137 @@
+import numpy as np
+
+
+# Marcas por rangos de BIN: (marca, [(desde, hasta) sobre los primeros 6 dígitos], longitudes válidas).
+# El orden importa: se asigna la primera marca cuyo rango contiene el BIN.
+BRANDS = (
+    ('amex', [(340000, 349999), (370000, 379999)], (15,)),
+    ('diners', [(300000, 305999), (360000, 369999), (380000, 399999)], (14, 15, 16, 17, 18, 19)),
+    ('jcb', [(352800, 358999)], (16, 17, 18, 19)),
+    ('visa', [(400000, 499999)], (13, 16, 19)),
+    ('mastercard', [(510000, 559999), (222100, 272099)], (16,)),
+    ('discover', [(601100, 601199), (622126, 622925), (644000, 659999)], (16, 17, 18, 19)),
+)
+
+MIN_LENGTH = 13
+MAX_LENGTH = 19
+# Caracteres máximos de una entrada, con espacios y guiones (19 dígitos + separadores)
+MAX_INPUT_LENGTH = 32
+
+
+def clean_card_number(card_number):
+    """Quita espacios y guiones de un número de tarjeta"""
+    return str(card_number if card_number is not None else '').replace(' ', '').replace('-', '')
+
+
+def detect_brand(card_number):
+    """
+    Marca de una tarjeta según su BIN (primeros 6 dígitos)
+
+    Returns:
+        str: visa, mastercard, amex, discover, diners, jcb o unknown
+    """
+    card_number = str(card_number if card_number is not None else '')
+    if len(card_number) > MAX_INPUT_LENGTH:
+        return 'unknown'
+    card_number = clean_card_number(card_number)
+    if not card_number.isdigit():
+        return 'unknown'
+    bin_number = int(card_number[:6].ljust(6, '0'))
+    for brand, ranges, _ in BRANDS:
+        if any(low <= bin_number <= high for low, high in ranges):
+            return brand
+    return 'unknown'
+
+
+def validate_cards(card_numbers):
+    """
+    Valida muchos números de tarjeta a la vez
+
+    Los números se cargan en una matriz de N x 19 dígitos (rellena con ceros
+    a la derecha) y Luhn, longitudes y marca se calculan con operaciones de
+    NumPy sobre toda la matriz, sin un ciclo de Python por tarjeta. Da el
+    mismo Luhn que Validator.validate_card_number y la misma marca que
+    detect_brand, también para números de longitud inválida.
+
+    Cada entrada ocupa a lo más MAX_INPUT_LENGTH caracteres en la matriz: las
+    más largas se marcan inválidas (marca unknown) sin copiarse completas,
+    así que la memoria depende solo del número de entradas.
+
+    Args:
+        card_numbers: Secuencia de números (str o int; se ignoran espacios y guiones)
+
+    Returns:
+        dict de arreglos de N elementos:
+            valid: pasa todas las verificaciones
+            digits_valid: solo dígitos, entre 13 y 19
+            luhn_valid: dígito verificador correcto
+            length_valid: longitud permitida para su marca
+            brand: marca detectada (ver BRANDS)
+    """
+    count = len(card_numbers)
+    if count == 0:
+        empty = np.zeros(0, dtype=bool)
+        return {'valid': empty, 'digits_valid': empty, 'luhn_valid': empty, 'length_valid': empty,
+                'brand': np.zeros(0, dtype='<U10')}
+
+    # Matriz de N x ancho con el código de cada carácter (rellena con ceros).
+    # NumPy trunca cada entrada a MAX_INPUT_LENGTH + 1 caracteres: si el
+    # último no es cero la entrada era más larga y se descarta completa
+    strings = np.asarray(card_numbers, dtype=f'<U{MAX_INPUT_LENGTH + 1}').reshape(count)
+    matrix = strings.view(np.uint32).reshape(count, MAX_INPUT_LENGTH + 1)
+    too_long = matrix[:, MAX_INPUT_LENGTH] != 0
+    used = np.flatnonzero(matrix.any(axis=0))
+    width = int(used[-1]) + 1 if used.size else 1
+    matrix = np.where(too_long[:, None], 0, matrix[:, :width])
+
+    # Espacios y guiones se recorren al final de cada fila, fuera de la longitud
+    separators = (matrix == ord(' ')) | (matrix == ord('-'))
+    if separators.any():
+        order = np.argsort(separators, axis=1, kind='stable')
+        matrix = np.take_along_axis(matrix, order, axis=1)
+        separators = np.take_along_axis(separators, order, axis=1)
+    lengths = np.count_nonzero((matrix != 0) & ~separators, axis=1)
+    is_digit = (matrix >= ord('0')) & (matrix <= ord('9'))
+    all_digits = (lengths > 0) & np.all(is_digit | (np.arange(width) >= lengths[:, None]), axis=1)
+    digits_valid = all_digits & (lengths >= MIN_LENGTH) & (lengths <= MAX_LENGTH)
+
+    # Solo caben MAX_LENGTH dígitos; las filas más largas ya son inválidas
+    if width < MAX_LENGTH:
+        matrix = np.pad(matrix, ((0, 0), (0, MAX_LENGTH - width)))
+        is_digit = np.pad(is_digit, ((0, 0), (0, MAX_LENGTH - width)))
+    matrix = matrix[:, :MAX_LENGTH]
+    is_digit = is_digit[:, :MAX_LENGTH]
+
+    positions = np.arange(MAX_LENGTH)
+    inside = positions < lengths[:, None]
+    digits = np.where(inside & is_digit, matrix.astype(np.int16) - ord('0'), 0).astype(np.int16)
+
+    # Luhn: se duplican los dígitos en posición impar contando desde la derecha
+    from_right = lengths[:, None] - 1 - positions
+    doubled = inside & (from_right % 2 == 1)
+    values = np.where(doubled, digits * 2 - 9 * (digits > 4), digits)
+    luhn_valid = digits_valid & (values.sum(axis=1) % 10 == 0)
+
+    # Marca: BIN de 6 dígitos comparado contra los rangos de cada marca. Como
+    # detect_brand, se asigna a cualquier número de solo dígitos aunque su
+    # longitud sea inválida (los de menos de 6 dígitos se rellenan con ceros)
+    bins = digits[:, :6].astype(np.int64) @ (10 ** np.arange(5, -1, -1))
+    brand = np.full(count, 'unknown', dtype='<U10')
+    length_valid = digits_valid.copy()
+    assigned = ~all_digits
+    for name, ranges, allowed in BRANDS:
+        in_range = np.zeros(count, dtype=bool)
+        for low, high in ranges:
+            in_range |= (bins >= low) & (bins <= high)
+        in_range &= ~assigned
+        brand[in_range] = name
+        length_valid[in_range] &= np.isin(lengths[in_range], allowed)
+        assigned |= in_range
+
+    return {
+        'valid': luhn_valid & length_valid,
+        'digits_valid': digits_valid,
+        'luhn_valid': luhn_valid,
+        'length_valid': length_valid,
+        'brand': brand,
+    }
@@ -0,0 +1,26 @@
+#!/usr/bin/env python3
+"""
+Script para compactar el libro de saldos (ledger_entries)
+Pasa a cards.balance los movimientos posteriores al último snapshot de cada
+tarjeta. Los movimientos no se borran; solo se acorta el tramo que hay que
+sumar para obtener el saldo disponible. Pensado para correr periódicamente
+(cron o timer de systemd), p. ej. cada hora
+"""
+
+import sys
+
+from ledger import Ledger
+from models import Database
+
+DB_PATH = 'database/payments.db'
+
+
+def compact_ledger(db_path=DB_PATH):
+    """Compacta los movimientos pendientes de todas las tarjetas"""
+    db = Database(db_path)
+    cards = Ledger().compact_all(db)
+    print(f"✅ Snapshot actualizado para {cards} tarjeta(s)")
+
+
+if __name__ == '__main__':
+    compact_ledger(sys.argv[1] if len(sys.argv) > 1 else DB_PATH)
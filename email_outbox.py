@@ -0,0 +1,221 @@
+import os
+import random
+import smtplib
+import threading
+import time
+
+import metrics
+
+
+class EmailOutbox:
+    """
+    Bandeja de salida persistente para los emails de facturas
+
+    Los mensajes ya armados se guardan en la tabla email_outbox y la
+    petición HTTP regresa de inmediato. Hilos en segundo plano toman los
+    mensajes vencidos, los entregan por SMTP y registran el resultado; los
+    errores temporales se reintentan con backoff exponencial. La toma de un
+    mensaje es un UPDATE ... RETURNING dentro de BEGIN IMMEDIATE, así que
+    varios workers de gunicorn pueden vaciar la misma bandeja sin enviar un
+    mensaje dos veces. La conexión SMTP nunca se abre con la base bloqueada.
+    """
+
+    STATUSES = ('pending', 'sending', 'retry', 'sent', 'failed')
+
+    def __init__(self, db, workers=None, max_attempts=None, retry_base=None, retry_max=None,
+                 poll_interval=1.0, lease_seconds=300):
+        """
+        Args:
+            db: Instancia de Database
+            workers: Hilos de entrega por proceso (EMAIL_WORKERS, por defecto 1; 0 = ninguno)
+            max_attempts: Intentos antes de marcar el mensaje como fallido (EMAIL_MAX_ATTEMPTS, 5)
+            retry_base: Segundos antes del primer reintento (EMAIL_RETRY_BASE, 30)
+            retry_max: Espera máxima entre reintentos (EMAIL_RETRY_MAX, 3600)
+            poll_interval: Segundos entre revisiones de la bandeja sin mensajes nuevos
+            lease_seconds: Tras este tiempo un mensaje en 'sending' se considera abandonado
+        """
+        self.db = db
+        self.workers = workers if workers is not None else int(os.environ.get('EMAIL_WORKERS', 1))
+        self.max_attempts = max_attempts or int(os.environ.get('EMAIL_MAX_ATTEMPTS', 5))
+        self.retry_base = retry_base or float(os.environ.get('EMAIL_RETRY_BASE', 30))
+        self.retry_max = retry_max or float(os.environ.get('EMAIL_RETRY_MAX', 3600))
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+
+        self.deliver = None
+        self._threads = []
+        self._threads_pid = None
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    def start(self, deliver):
+        """
+        Arranca los hilos de entrega de este proceso
+
+        Args:
+            deliver: Función (to_email, message_bytes) que entrega un mensaje
+                y lanza una excepción si falla (ver EmailSender.deliver)
+        """
+        self.deliver = deliver
+        self.ensure_started()
+
+    def ensure_started(self):
+        """Arranca los hilos si aún no corren en este proceso (p. ej. tras un fork)"""
+        if self.deliver is None or self.workers <= 0 or self._threads_pid == os.getpid():
+            return
+        with self._lock:
+            if self._threads_pid == os.getpid():
+                return
+            self._stop.clear()
+            self._threads = [
+                threading.Thread(target=self._run, name=f'email-outbox-{i}', daemon=True)
+                for i in range(self.workers)
+            ]
+            for thread in self._threads:
+                thread.start()
+            self._threads_pid = os.getpid()
+
+    def stop(self, timeout=5.0):
+        """Detiene los hilos de entrega de este proceso"""
+        self._stop.set()
+        self._wake.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+        self._threads_pid = None
+
+    def enqueue(self, to_email, subject, message, user_id=None, transaction_id=None):
+        """
+        Guarda un mensaje en la bandeja para entregarlo en segundo plano
+
+        Args:
+            to_email: Destinatario
+            subject: Asunto (solo para consulta)
+            message: Mensaje MIME completo en bytes
+
+        Returns:
+            int: Id del mensaje en la bandeja
+        """
+        with self.db.transaction() as conn:
+            cursor = conn.execute('''
+                INSERT INTO email_outbox (user_id, transaction_id, to_email, subject, message, next_attempt_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (user_id, transaction_id, to_email, subject, message, time.time()))
+            email_id = cursor.lastrowid
+
+        self.ensure_started()
+        self._wake.set()
+        return email_id
+
+    def _claim(self):
+        """Toma el siguiente mensaje vencido. Retorna (id, to_email, message, attempts) o None"""
+        now = time.time()
+        with self.db.transaction(immediate=True) as conn:
+            rows = conn.execute('''
+                UPDATE email_outbox
+                SET status = 'sending', attempts = attempts + 1, locked_at = ?
+                WHERE id = (
+                    SELECT id FROM email_outbox
+                    WHERE (status IN ('pending', 'retry') AND next_attempt_at <= ?)
+                       OR (status = 'sending' AND locked_at <= ?)
+                    ORDER BY next_attempt_at
+                    LIMIT 1
+                )
+                RETURNING id, to_email, message, attempts
+            ''', (now, now, now - self.lease_seconds)).fetchall()
+        return rows[0] if rows else None
+
+    def process_one(self):
+        """
+        Entrega un mensaje vencido de la bandeja
+
+        Returns:
+            bool: True si había un mensaje (entregado o no)
+        """
+        claimed = self._claim()
+        if claimed is None:
+            return False
+
+        email_id, to_email, message, attempts = claimed
+        try:
+            self.deliver(to_email, message)
+        except Exception as e:
+            self._record_failure(email_id, attempts, e)
+        else:
+            with self.db.transaction() as conn:
+                conn.execute('''
+                    UPDATE email_outbox
+                    SET status = 'sent', sent_at = CURRENT_TIMESTAMP, locked_at = NULL, last_error = NULL
+                    WHERE id = ?
+                ''', (email_id,))
+            metrics.EMAIL_OUTBOX.labels('sent').inc()
+        return True
+
+    def _record_failure(self, email_id, attempts, error):
+        """Programa el reintento con backoff o marca el mensaje como fallido"""
+        # Los rechazos 5xx (destinatario inválido, credenciales) no se arreglan reintentando
+        permanent = (isinstance(error, smtplib.SMTPResponseException) and error.smtp_code >= 500) or \
+            isinstance(error, smtplib.SMTPRecipientsRefused)
+
+        if permanent or attempts >= self.max_attempts:
+            status, next_attempt_at = 'failed', time.time()
+        else:
+            delay = min(self.retry_base * 2 ** (attempts - 1), self.retry_max)
+            status, next_attempt_at = 'retry', time.time() + delay * random.uniform(0.8, 1.2)
+
+        with self.db.transaction() as conn:
+            conn.execute('''
+                UPDATE email_outbox
+                SET status = ?, next_attempt_at = ?, locked_at = NULL, last_error = ?
+                WHERE id = ?
+            ''', (status, next_attempt_at, f'{type(error).__name__}: {error}', email_id))
+        metrics.EMAIL_OUTBOX.labels(status).inc()
+
+    def _run(self):
+        """Ciclo de un hilo de entrega"""
+        while not self._stop.is_set():
+            try:
+                if self.process_one():
+                    continue
+            except Exception as e:
+                # Error de base de datos (p. ej. bloqueada): se reintenta en el siguiente ciclo
+                print(f"[EMAIL] Error al procesar la bandeja de salida: {e}")
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+
+    def status(self, email_id, user_id=None):
+        """
+        Estado de entrega de un mensaje
+
+        Returns:
+            dict o None si no existe (o es de otro usuario)
+        """
+        with self.db.connection() as conn:
+            row = conn.execute('''
+                SELECT id, user_id, transaction_id, to_email, status, attempts,
+                       next_attempt_at, last_error, created_at, sent_at
+                FROM email_outbox WHERE id = ?
+            ''', (email_id,)).fetchone()
+
+        if not row or (user_id is not None and row[1] != user_id):
+            return None
+        return {
+            'id': row[0],
+            'transaction_id': row[2],
+            'to_email': row[3],
+            'status': row[4],
+            'attempts': row[5],
+            'next_attempt_at': row[6] if row[4] == 'retry' else None,
+            'last_error': row[7],
+            'created_at': row[8],
+            'sent_at': row[9],
+        }
+
+    def counts(self):
+        """Mensajes por estado"""
+        with self.db.connection() as conn:
+            rows = conn.execute('SELECT status, COUNT(*) FROM email_outbox GROUP BY status').fetchall()
+        counts = dict.fromkeys(self.STATUSES, 0)
+        counts.update(rows)
+        return counts
@@ -1,15 +1,138 @@
 import smtplib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.base import MIMEBase
 from email import encoders
+import threading
+import time
 import os
 
+import metrics
+
+
+class SMTPConnectionPool:
+    """
+    Pool de conexiones SMTP ya autenticadas
+    
+    Cada conexión paga una sola vez el TCP + STARTTLS + AUTH y se reutiliza
+    para muchos mensajes. Antes de reutilizar una conexión que estuvo
+    inactiva se verifica con NOOP; las conexiones muy viejas o que ya
+    enviaron max_messages se cierran y se reemplazan. Como las conexiones
+    de SQLite, el pool es por proceso: después de un fork se empieza vacío.
+    """
+    
+    # Inactividad tras la cual se verifica la conexión con NOOP antes de usarla
+    CHECK_AFTER = 5.0
+    
+    def __init__(self, connect, size=4, max_idle=60.0, max_messages=100):
+        """
+        Args:
+            connect: Función que abre y autentica una conexión smtplib.SMTP
+            size: Máximo de conexiones abiertas a la vez
+            max_idle: Segundos sin uso tras los cuales una conexión se cierra
+            max_messages: Mensajes por conexión antes de reabrirla
+        """
+        self.connect = connect
+        self.size = size
+        self.max_idle = max_idle
+        self.max_messages = max_messages
+        
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+        self._idle = []
+        self._pid = os.getpid()
+    
+    def _check_pid(self):
+        """Descarta (sin cerrarlas) las conexiones heredadas del proceso padre"""
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._idle = []
+                    self._slots = threading.BoundedSemaphore(self.size)
+                    self._pid = os.getpid()
+    
+    def _take(self):
+        """Retorna una conexión inactiva todavía útil o una nueva"""
+        while True:
+            with self._lock:
+                entry = self._idle.pop() if self._idle else None
+            if entry is None:
+                return [self.connect(), 0, time.monotonic()]
+            
+            server, sent, last_used = entry
+            idle = time.monotonic() - last_used
+            if idle > self.max_idle or sent >= self.max_messages:
+                self._close(server)
+                continue
+            if idle > self.CHECK_AFTER:
+                try:
+                    if server.noop()[0] != 250:
+                        raise smtplib.SMTPServerDisconnected('NOOP rechazado')
+                except (smtplib.SMTPException, OSError):
+                    self._close(server)
+                    continue
+            return entry
+    
+    @contextmanager
+    def connection(self):
+        """
+        Presta una conexión del pool
+        
+        Si el bloque falla por la conexión (desconexión, error de red) se
+        cierra en lugar de regresar al pool. Un rechazo SMTP de un mensaje
+        (p. ej. destinatario inválido) deja la conexión utilizable.
+        """
+        self._check_pid()
+        slots = self._slots
+        slots.acquire()
+        try:
+            entry = self._take()
+            try:
+                yield entry[0]
+            except (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused) as e:
+                # 421: el servidor va a cerrar la conexión
+                if getattr(e, 'smtp_code', None) == 421:
+                    self._close(entry[0])
+                else:
+                    self._give_back(entry)
+                raise
+            except BaseException:
+                self._close(entry[0])
+                raise
+            else:
+                entry[1] += 1
+                self._give_back(entry)
+        finally:
+            slots.release()
+    
+    def _give_back(self, entry):
+        entry[2] = time.monotonic()
+        with self._lock:
+            self._idle.append(entry)
+    
+    @staticmethod
+    def _close(server):
+        try:
+            server.quit()
+        except (smtplib.SMTPException, OSError):
+            server.close()
+    
+    def close_all(self):
+        """Cierra las conexiones inactivas de este proceso"""
+        self._check_pid()
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for server, _, _ in idle:
+            self._close(server)
+
 
 class EmailSender:
     """Servicio para envío de emails con facturas adjuntas"""
     
-    def __init__(self, smtp_host=None, smtp_port=None, smtp_user=None, smtp_password=None):
+    def __init__(self, smtp_host=None, smtp_port=None, smtp_user=None, smtp_password=None,
+                 use_tls=None, simulate=None, timeout=30, outbox=None, pool_size=None):
         """
         Inicializa el servicio de email
         
@@ -18,6 +141,13 @@ class EmailSender:
             smtp_port: Puerto del servidor SMTP
             smtp_user: Usuario para autenticación SMTP
             smtp_password: Contraseña para autenticación SMTP
+            use_tls: Usar STARTTLS (SMTP_USE_TLS, por defecto sí)
+            simulate: Solo imprimir los emails (SMTP_SIMULATE; por defecto sí
+                cuando no hay credenciales SMTP)
+            timeout: Segundos máximos de espera del servidor SMTP
+            outbox: EmailOutbox para enviar en segundo plano (opcional)
+            pool_size: Conexiones SMTP reutilizables (SMTP_POOL_SIZE, por
+                defecto 4; 0 = una conexión nueva por mensaje)
         """
         self.smtp_host = smtp_host or os.environ.get('SMTP_HOST', 'smtp.gmail.com')
         self.smtp_port = smtp_port or int(os.environ.get('SMTP_PORT', 587))
@@ -25,65 +155,180 @@ class EmailSender:
         self.smtp_password = smtp_password or os.environ.get('SMTP_PASSWORD', '')
         self.from_email = os.environ.get('FROM_EMAIL', 'facturacion@mu.com')
         self.from_name = 'MU - Sistema de Facturación'
+        
+        if use_tls is None:
+            use_tls = os.environ.get('SMTP_USE_TLS', '1') == '1'
+        if simulate is None:
+            has_credentials = bool(self.smtp_user and self.smtp_password)
+            simulate = (os.environ.get('SMTP_SIMULATE') or ('0' if has_credentials else '1')) == '1'
+        self.use_tls = use_tls
+        self.simulate = simulate
+        self.timeout = timeout
+        self.outbox = outbox
+        
+        if pool_size is None:
+            pool_size = int(os.environ.get('SMTP_POOL_SIZE', 4))
+        self.pool = SMTPConnectionPool(self._connect, size=pool_size) if pool_size > 0 else None
+    
+    def build_invoice_message(self, to_email, invoice_number, pdf_buffer, transaction_data):
+        """
+        Arma el mensaje con la factura adjunta en PDF
+        
+        Returns:
+            MIMEMultipart listo para enviarse
+        """
+        # Crear mensaje
+        msg = MIMEMultipart()
+        msg['From'] = f"{self.from_name} <{self.from_email}>"
+        msg['To'] = to_email
+        msg['Subject'] = f'Factura MU - {invoice_number}'
+        
+        # Cuerpo del email en HTML
+        html_body = self._create_email_body(invoice_number, transaction_data)
+        msg.attach(MIMEText(html_body, 'html'))
+        
+        # Adjuntar PDF
+        pdf_attachment = MIMEBase('application', 'pdf')
+        pdf_attachment.set_payload(pdf_buffer.read())
+        encoders.encode_base64(pdf_attachment)
+        pdf_attachment.add_header(
+            'Content-Disposition',
+            f'attachment; filename=factura-{invoice_number}.pdf'
+        )
+        msg.attach(pdf_attachment)
+        
+        return msg
+    
+    @staticmethod
+    def message_bytes(msg):
+        """Serializa un mensaje como lo espera SMTP (sendmail no corrige fines de línea en bytes)"""
+        return msg.as_bytes(policy=msg.policy.clone(linesep='\r\n'))
+    
+    def deliver(self, to_email, message):
+        """
+        Entrega un mensaje ya armado al servidor SMTP
+        
+        Args:
+            to_email: Destinatario
+            message: Mensaje MIME en bytes con fines de línea CRLF (ver message_bytes)
+        
+        Raises:
+            smtplib.SMTPException, OSError: Si la entrega falla
+        """
+        start = time.perf_counter()
+        try:
+            self._deliver(to_email, message)
+        except Exception:
+            metrics.EMAIL_SEND.labels('error').observe(time.perf_counter() - start)
+            raise
+        metrics.EMAIL_SEND.labels('ok').observe(time.perf_counter() - start)
+    
+    def _deliver(self, to_email, message):
+        if self.simulate:
+            # Modo simulación (desarrollo)
+            print(f"[MODO DESARROLLO] Email simulado a {to_email} ({len(message)} bytes)")
+            return
+        
+        if self.pool is None:
+            server = self._connect()
+            try:
+                server.sendmail(self.from_email, [to_email], message)
+            finally:
+                SMTPConnectionPool._close(server)
+            return
+        
+        try:
+            with self.pool.connection() as server:
+                server.sendmail(self.from_email, [to_email], message)
+        except (smtplib.SMTPServerDisconnected, ConnectionError):
+            # El servidor cerró una conexión del pool (timeout de inactividad):
+            # se reintenta una vez con una conexión nueva
+            with self.pool.connection() as server:
+                server.sendmail(self.from_email, [to_email], message)
+    
+    def _connect(self):
+        """Abre una conexión SMTP con STARTTLS y autenticación según la configuración"""
+        server = smtplib.SMTP(self.smtp_host, self.smtp_port, timeout=self.timeout)
+        try:
+            if self.use_tls:
+                server.starttls()
+            if self.smtp_user and self.smtp_password:
+                server.login(self.smtp_user, self.smtp_password)
+        except BaseException:
+            server.close()
+            raise
+        return server
+    
+    def send_bulk(self, messages, concurrency=None):
+        """
+        Entrega muchos mensajes ya armados repartidos en varias conexiones
+        
+        Pensado para los envíos de fin de mes: cada hilo toma conexiones del
+        pool, así que miles de mensajes pagan solo unos cuantos handshakes.
+        
+        Args:
+            messages: Iterable de (to_email, message_bytes)
+            concurrency: Envíos simultáneos (por defecto el tamaño del pool)
+        
+        Returns:
+            list: {'to_email', 'success', 'error'} por mensaje, en el mismo orden
+        """
+        concurrency = concurrency or (self.pool.size if self.pool else 1)
+        
+        def send(item):
+            to_email, message = item
+            try:
+                self.deliver(to_email, message)
+                return {'to_email': to_email, 'success': True, 'error': None}
+            except Exception as e:
+                return {'to_email': to_email, 'success': False, 'error': f'{type(e).__name__}: {e}'}
+        
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='smtp-bulk') as executor:
+            return list(executor.map(send, messages))
     
-    def send_invoice_email(self, to_email, invoice_number, pdf_buffer, transaction_data):
+    def send_invoice_email(self, to_email, invoice_number, pdf_buffer, transaction_data, user_id=None):
         """
         Envía un email con la factura adjunta en PDF
         
+        Con una bandeja de salida el mensaje se encola y se entrega en segundo
+        plano; sin ella se entrega en esta misma llamada.
+        
         Args:
             to_email: Email del destinatario
             invoice_number: Número de factura
             pdf_buffer: BytesIO con el contenido del PDF
             transaction_data: Datos de la transacción para personalizar el email
+            user_id: Usuario que solicita el envío (para consultar su estado)
         
         Returns:
-            dict: {'success': bool, 'message': str}
+            dict: {'success': bool, 'message': str} y, si se encoló, 'email_id'
         """
         try:
-            # Crear mensaje
-            msg = MIMEMultipart()
-            msg['From'] = f"{self.from_name} <{self.from_email}>"
-            msg['To'] = to_email
-            msg['Subject'] = f'Factura MU - {invoice_number}'
-            
-            # Cuerpo del email en HTML
-            html_body = self._create_email_body(invoice_number, transaction_data)
-            msg.attach(MIMEText(html_body, 'html'))
-            
-            # Adjuntar PDF
-            pdf_attachment = MIMEBase('application', 'pdf')
-            pdf_attachment.set_payload(pdf_buffer.read())
-            encoders.encode_base64(pdf_attachment)
-            pdf_attachment.add_header(
-                'Content-Disposition',
-                f'attachment; filename=factura-{invoice_number}.pdf'
-            )
-            msg.attach(pdf_attachment)
+            msg = self.build_invoice_message(to_email, invoice_number, pdf_buffer, transaction_data)
             
-            # Enviar email
-            if self.smtp_user and self.smtp_password:
-                # Configuración real de SMTP
-                server = smtplib.SMTP(self.smtp_host, self.smtp_port)
-                server.starttls()
-                server.login(self.smtp_user, self.smtp_password)
-                server.send_message(msg)
-                server.quit()
-                
+            if self.outbox is not None:
+                email_id = self.outbox.enqueue(
+                    to_email, msg['Subject'], self.message_bytes(msg),
+                    user_id=user_id, transaction_id=transaction_data.get('id')
+                )
                 return {
                     'success': True,
-                    'message': f'Factura enviada exitosamente a {to_email}'
+                    'queued': True,
+                    'email_id': email_id,
+                    'message': f'La factura se enviará a {to_email} en unos momentos'
                 }
-            else:
-                # Modo simulación (desarrollo)
-                print(f"[MODO DESARROLLO] Email simulado a {to_email}")
-                print(f"Asunto: {msg['Subject']}")
-                print(f"Adjunto: factura-{invoice_number}.pdf ({len(pdf_buffer.getvalue())} bytes)")
-                
+            
+            self.deliver(to_email, self.message_bytes(msg))
+            if self.simulate:
                 return {
                     'success': True,
                     'message': f'Factura enviada a {to_email} (modo de desarrollo)',
                     'development_mode': True
                 }
+            return {
+                'success': True,
+                'message': f'Factura enviada exitosamente a {to_email}'
+            }
                 
         except smtplib.SMTPAuthenticationError:
             return {
@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+"""
+Worker independiente de la bandeja de salida de emails
+Úsalo con EMAIL_WORKERS=0 para que los workers web no envíen emails
+"""
+
+import os
+import sys
+import time
+
+from email_outbox import EmailOutbox
+from email_sender import EmailSender
+from models import Database
+
+# La misma base de datos que la aplicación (ver Database)
+DB_PATH = os.environ.get('DATABASE_PATH', 'database/payments.db')
+
+
+def run_email_worker(db_path=DB_PATH, threads=2):
+    """Entrega los emails pendientes hasta recibir Ctrl+C"""
+    db = Database(db_path)
+    outbox = EmailOutbox(db, workers=threads)
+    outbox.start(EmailSender().deliver)
+
+    print(f"📬 Worker de emails iniciado con {threads} hilo(s)")
+    try:
+        while True:
+            time.sleep(60)
+            counts = outbox.counts()
+            print(f"   pendientes: {counts['pending'] + counts['retry']}  "
+                  f"enviados: {counts['sent']}  fallidos: {counts['failed']}")
+    except KeyboardInterrupt:
+        outbox.stop()
+        print("👋 Worker de emails detenido")
+
+
+if __name__ == '__main__':
+    db_path = sys.argv[1] if len(sys.argv) > 1 else DB_PATH
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+    run_email_worker(db_path, threads)
@@ -1,9 +1,52 @@
-bind = "127.0.0.1:8000"
-workers = 4
-worker_class = "sync"
-worker_connections = 1000
+import multiprocessing
+import glob
+import os
+
+bind = os.environ.get('GUNICORN_BIND', "127.0.0.1:8000")
+
+# gthread: cada worker atiende varias peticiones a la vez con hilos, así que
+# las rutas que esperan E/S (email, descarga de facturas, SQLite) no limitan
+# la concurrencia al número de procesos. GUNICORN_WORKER_CLASS=sync regresa
+# al modo anterior de un hilo por worker.
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', "gthread")
+
+# Un proceso por CPU para el trabajo de CPU (el GIL no se comparte entre
+# procesos) y varios hilos por proceso para las esperas de E/S
+cpu_count = multiprocessing.cpu_count()
+workers = int(os.environ.get('GUNICORN_WORKERS', max(2, cpu_count)))
+threads = int(os.environ.get('GUNICORN_THREADS', 8 if worker_class == "gthread" else 1))
+
+# Cada hilo usa su propia conexión SQLite: el pool de Database se dimensiona
+# para que no se abran y cierren conexiones en cada petición
+os.environ.setdefault('DB_POOL_SIZE', str(threads + 2))
+
+# Directorio donde cada proceso escribe sus métricas; /metrics suma todos
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', os.path.abspath('database/metrics'))
+
+# Caché de tarjetas compartido por los workers (ver card_cache.py)
+os.environ.setdefault('CARD_CACHE_PATH', os.path.abspath('database/card_cache.bin'))
+
 timeout = 30
 keepalive = 2
 errorlog = "/var/log/gunicorn/error.log"
 accesslog = "/var/log/gunicorn/access.log"
 loglevel = "info"
+
+
+def on_starting(server):
+    """Descarta las métricas y el caché de tarjetas de la ejecución anterior"""
+    metrics_dir = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    os.makedirs(metrics_dir, exist_ok=True)
+    for path in glob.glob(os.path.join(metrics_dir, '*.db')):
+        os.remove(path)
+    
+    # El caché de tarjetas pudo quedar de otra copia de la base de datos
+    try:
+        os.remove(os.environ['CARD_CACHE_PATH'])
+    except FileNotFoundError:
+        pass
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
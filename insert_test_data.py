@@ -8,6 +8,9 @@ import sqlite3
 from datetime import datetime, timedelta
 import random
 
+from ledger import Ledger
+from models import Database
+
 DB_PATH = 'database/payments.db'
 
 def insert_test_transactions():
@@ -111,6 +114,7 @@ def insert_test_transactions():
     ]
     
     inserted = 0
+    ledger = Ledger()
     
     for i, tx in enumerate(test_transactions):
         try:
@@ -141,6 +145,9 @@ def insert_test_transactions():
                     invoice_number,
                     timestamp
                 ))
+                # El cargo en el libro de saldos, como lo registra PaymentRules
+                if card_id:
+                    ledger.record(conn, card_id, 'cargo', -tx['amount'], cursor.lastrowid)
             else:
                 cursor.execute('''
                     INSERT INTO transactions (amount, status, rejection_reason, card_id, user_id, rfc, full_name, timestamp)
@@ -166,6 +173,9 @@ def insert_test_transactions():
     conn.commit()
     conn.close()
     
+    # Las transacciones se insertaron por fuera de la aplicación
+    Database(DB_PATH).rebuild_user_stats()
+    
     print(f"\n✨ ¡Completado! Se insertaron {inserted}/{len(test_transactions)} transacciones de prueba")
     print(f"\n📊 Resumen:")
     print(f"   • Transacciones autorizadas: {sum(1 for tx in test_transactions if tx['status'] == 'autorizado')}")
@@ -0,0 +1,166 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+
+# Archivos cuyo contenido define cómo se ve una factura. Si cambia alguno,
+# cambia la versión de render y las facturas en caché dejan de coincidir.
+RENDER_SOURCES = ('invoice_generator.py',)
+
+
+def render_version(sources=RENDER_SOURCES):
+    """Hash del código que genera las facturas"""
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    digest = hashlib.sha256()
+    for name in sources:
+        with open(os.path.join(base_dir, name), 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+
+class InvoiceCache:
+    """
+    Caché en disco de facturas PDF ya generadas
+
+    Cada archivo se nombra con el id de la transacción y un hash de la
+    versión de render y de los datos de la factura, así que una entrada
+    nunca queda desactualizada: si cambia el generador o los datos, la
+    llave cambia y la entrada vieja termina saliendo por LRU. Las escrituras
+    son atómicas (archivo temporal + os.replace) y el directorio puede
+    compartirse entre workers de gunicorn y procesos del pool de facturas.
+    """
+
+    # Solo se actualiza la fecha de uso de una entrada si es más vieja que esto
+    TOUCH_INTERVAL = 60
+
+    def __init__(self, cache_dir=None, max_bytes=None):
+        """
+        Args:
+            cache_dir: Directorio del caché (INVOICE_CACHE_DIR)
+            max_bytes: Tamaño máximo antes de desalojar (INVOICE_CACHE_MAX_MB, por defecto 256)
+        """
+        self.cache_dir = cache_dir or os.environ.get('INVOICE_CACHE_DIR', 'database/invoice_cache')
+        self.max_bytes = max_bytes or int(os.environ.get('INVOICE_CACHE_MAX_MB', 256)) * 1024 * 1024
+        self.version = render_version()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        # Bytes escritos por este proceso desde el último desalojo
+        self._written = 0
+        self._lock = threading.Lock()
+
+    def key(self, transaction_data):
+        """Llave de la factura: id de la transacción + hash de versión y datos"""
+        payload = json.dumps(transaction_data, sort_keys=True, default=str)
+        digest = hashlib.sha256(f'{self.version}:{payload}'.encode('utf-8')).hexdigest()[:24]
+        return f'{transaction_data["id"]}-{digest}'
+
+    def path_for(self, transaction_data):
+        return os.path.join(self.cache_dir, f'{self.key(transaction_data)}.pdf')
+
+    def get(self, transaction_data):
+        """
+        Busca la factura en el caché
+
+        Returns:
+            str: Ruta del PDF o None si no está en caché
+        """
+        path = self.path_for(transaction_data)
+        try:
+            mtime = os.path.getmtime(path)
+        except FileNotFoundError:
+            return None
+
+        # La fecha de modificación es la fecha de último uso para el LRU
+        if time.time() - mtime > self.TOUCH_INTERVAL:
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                return None
+        return path
+
+    def put(self, transaction_data, pdf_bytes):
+        """
+        Guarda una factura en el caché de forma atómica
+
+        Returns:
+            str: Ruta del PDF
+        """
+        path = self.path_for(transaction_data)
+        write_atomic(path, pdf_bytes)
+        self.record_write(len(pdf_bytes))
+        return path
+
+    def record_write(self, size):
+        """Contabiliza bytes escritos y desaloja cuando se escribió una décima parte del límite"""
+        with self._lock:
+            self._written += size
+            if self._written < self.max_bytes // 10:
+                return
+            self._written = 0
+        self.evict()
+
+    def evict(self):
+        """
+        Elimina las entradas menos usadas hasta bajar al 90% del límite
+
+        Returns:
+            int: Entradas eliminadas
+        """
+        entries = []
+        total = 0
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if not entry.name.endswith('.pdf'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+
+        target = self.max_bytes * 9 // 10
+        if total <= self.max_bytes:
+            return 0
+
+        removed = 0
+        for _, size, path in sorted(entries):
+            if total <= target:
+                break
+            try:
+                # Un archivo ya abierto por send_file se sigue sirviendo completo
+                os.remove(path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+            total -= size
+        return removed
+
+    def stats(self):
+        """Número de entradas y bytes ocupados"""
+        count = 0
+        size = 0
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if entry.name.endswith('.pdf'):
+                    count += 1
+                    size += entry.stat().st_size
+        return {'entries': count, 'bytes': size, 'max_bytes': self.max_bytes, 'version': self.version}
+
+
+def write_atomic(path, data):
+    """Escribe un archivo completo o nada: otro proceso nunca ve un PDF a medias"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
@@ -0,0 +1,71 @@
+import zipfile
+
+
+class _ZipOutput:
+    """
+    Destino de ZipFile que solo acumula bytes hasta que se entregan
+
+    No tiene seek, así que ZipFile escribe cada entrada con descriptor de
+    datos al final y nunca regresa a corregir encabezados ya enviados.
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        """Retorna y descarta los bytes escritos desde la última llamada"""
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def stream_invoice_zip(rendered, rerender):
+    """
+    Arma un ZIP de facturas entregándolo por partes
+
+    Cada PDF se copia al archivo en bloques desde disco y los bytes de la
+    entrada se entregan en cuanto termina, así que en memoria solo vive una
+    entrada a la vez (más el directorio central del ZIP, unos cientos de
+    bytes por factura).
+
+    Args:
+        rendered: Iterable de (datos de la factura, ruta del PDF), p. ej.
+            InvoiceJobQueue.render_many
+        rerender: Función que vuelve a generar una factura y retorna su ruta,
+            para un PDF que salió del caché antes de agregarse
+
+    Yields:
+        bytes: Partes consecutivas del ZIP
+    """
+    output = _ZipOutput()
+    names = set()
+
+    with zipfile.ZipFile(output, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for transaction_data, pdf_path in rendered:
+            name = f'factura-{transaction_data["invoice_number"]}.pdf'
+            if name in names:
+                # Salvaguarda: los folios son únicos, pero una transacción sin
+                # folio se exporta como 'N/A' y dos entradas no deben tener el
+                # mismo nombre dentro del ZIP
+                name = f'factura-{transaction_data["invoice_number"]}-{transaction_data["id"]}.pdf'
+            names.add(name)
+
+            try:
+                archive.write(pdf_path, name)
+            except FileNotFoundError:
+                archive.write(rerender(transaction_data), name)
+            yield output.drain()
+
+    yield output.drain()
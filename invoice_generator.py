@@ -1,22 +1,104 @@
 from reportlab.lib.pagesizes import letter
 from reportlab.lib import colors
 from reportlab.lib.units import inch
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, Image
+from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, Flowable
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.enums import TA_CENTER, TA_RIGHT, TA_LEFT
 from reportlab.pdfgen import canvas
 import qrcode
 from io import BytesIO
 from datetime import datetime
+from functools import lru_cache
+import threading
 import os
 
 
+def qr_runs(data):
+    """
+    Calcula la matriz de un código QR y la reduce a corridas horizontales
+    
+    Returns:
+        tuple: (módulos por lado, ((fila, columna inicial, largo), ...))
+    """
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=qrcode.constants.ERROR_CORRECT_L,
+        box_size=10,
+        border=4,
+    )
+    qr.add_data(data)
+    qr.make(fit=True)
+    
+    matrix = qr.get_matrix()
+    runs = []
+    for row_index, row in enumerate(matrix):
+        start = None
+        for column, dark in enumerate(row + [False]):
+            if dark and start is None:
+                start = column
+            elif not dark and start is not None:
+                runs.append((row_index, start, column - start))
+                start = None
+    return len(matrix), tuple(runs)
+
+
+# Variante memoizada: el mismo folio (descargas repetidas, email tras
+# descarga) no vuelve a calcular la matriz ni el patrón de máscara
+cached_qr_runs = lru_cache(maxsize=1024)(qr_runs)
+
+
+class VectorQRCode(Flowable):
+    """Código QR dibujado como rectángulos vectoriales, sin imagen"""
+    
+    def __init__(self, modules, runs, size):
+        """
+        Args:
+            modules: Módulos por lado (incluye el borde)
+            runs: Corridas de módulos oscuros (ver qr_runs)
+            size: Lado del código en puntos
+        """
+        Flowable.__init__(self)
+        self.modules = modules
+        self.runs = runs
+        self.width = self.height = size
+    
+    def wrap(self, availWidth, availHeight):
+        return self.width, self.height
+    
+    def draw(self):
+        canv = self.canv
+        size = self.width
+        module = size / self.modules
+        
+        canv.saveState()
+        canv.setFillColor(colors.white)
+        canv.rect(0, 0, size, size, stroke=0, fill=1)
+        
+        # Todos los módulos oscuros en un solo trazo
+        path = canv.beginPath()
+        for row, start, length in self.runs:
+            path.rect(start * module, size - (row + 1) * module, length * module, module)
+        canv.setFillColor(colors.black)
+        canv.drawPath(path, stroke=0, fill=1)
+        canv.restoreState()
+
+
 class InvoiceGenerator:
-    """Generador de facturas en PDF con formato profesional"""
+    """
+    Generador de facturas en PDF con formato profesional
+    
+    Una instancia puede compartirse entre hilos: los estilos se crean y se
+    modifican solo en __init__ (cada instancia tiene su propia hoja de
+    estilos) y después únicamente se leen; la plantilla compilada se crea
+    una sola vez bajo un candado.
+    """
     
     def __init__(self):
         self.styles = getSampleStyleSheet()
         self._setup_custom_styles()
+        # Plantilla compilada, se crea con la primera factura
+        self._template = None
+        self._template_lock = threading.Lock()
     
     def _setup_custom_styles(self):
         """Configura estilos personalizados para el documento"""
@@ -57,30 +139,57 @@ class InvoiceGenerator:
             textColor=colors.HexColor('#6c757d')
         ))
     
-    def generate_qr_code(self, data):
-        """Genera un código QR y lo retorna como imagen"""
-        qr = qrcode.QRCode(
-            version=1,
-            error_correction=qrcode.constants.ERROR_CORRECT_L,
-            box_size=10,
-            border=4,
-        )
-        qr.add_data(data)
-        qr.make(fit=True)
-        
-        img = qr.make_image(fill_color="black", back_color="white")
-        
-        # Convertir a BytesIO para usarlo con ReportLab
-        buffer = BytesIO()
-        img.save(buffer, format='PNG')
-        buffer.seek(0)
+    def generate_qr_code(self, data, memoize=True):
+        """
+        Genera un código QR vectorial para el PDF
+        
+        Args:
+            data: Contenido del código
+            memoize: Reutilizar la matriz de un contenido ya calculado
         
-        return Image(buffer, width=1.5*inch, height=1.5*inch)
+        Returns:
+            VectorQRCode de 1.5 x 1.5 pulgadas
+        """
+        modules, runs = cached_qr_runs(data) if memoize else qr_runs(data)
+        return VectorQRCode(modules, runs, 1.5*inch)
     
     def generate_invoice_pdf(self, transaction_data, output_path=None):
         """
         Genera una factura en PDF
         
+        Usa la plantilla compilada (ver CompiledInvoiceTemplate) y recurre al
+        armado completo con platypus cuando algún campo no cabe en su lugar.
+        
+        Args:
+            transaction_data: Diccionario con los datos de la transacción
+            output_path: Ruta donde guardar el PDF (opcional)
+        
+        Returns:
+            BytesIO con el PDF generado
+        """
+        if self._template is None:
+            with self._template_lock:
+                if self._template is None:
+                    try:
+                        self._template = CompiledInvoiceTemplate(self)
+                    except ValueError:
+                        # El layout no se pudo fijar: siempre se usa platypus
+                        self._template = False
+        
+        buffer = self._template.render(transaction_data) if self._template else None
+        if buffer is None:
+            return self.generate_invoice_pdf_platypus(transaction_data, output_path)
+        
+        if output_path:
+            with open(output_path, 'wb') as f:
+                f.write(buffer.getbuffer())
+            return output_path
+        return buffer
+    
+    def generate_invoice_pdf_platypus(self, transaction_data, output_path=None):
+        """
+        Genera una factura en PDF armando todo el documento con platypus
+        
         Args:
             transaction_data: Diccionario con los datos de la transacción
             output_path: Ruta donde guardar el PDF (opcional)
@@ -101,6 +210,60 @@ class InvoiceGenerator:
                                    rightMargin=72, leftMargin=72,
                                    topMargin=72, bottomMargin=72)
         
+        # Construir el PDF
+        doc.build(self.build_elements(self.variable_fields(transaction_data)))
+        
+        # Si se proporcionó output_path, retornar el path, sino retornar el buffer
+        if output_path:
+            return output_path
+        else:
+            buffer.seek(0)
+            return buffer
+    
+    def variable_fields(self, transaction_data):
+        """
+        Construye los elementos de la factura que dependen de la transacción
+        
+        Returns:
+            dict: nombre del campo -> flowable
+        """
+        amount = float(transaction_data.get('amount', 0))
+        commission = amount * 0.029
+        total = amount + commission
+        
+        qr_data = f"MU-{transaction_data.get('invoice_number', 'N/A')}-{transaction_data.get('id', 'N/A')}"
+        
+        return {
+            'invoice_number': Paragraph(f"<b>FACTURA</b><br/>{transaction_data.get('invoice_number', 'N/A')}", 
+                                        self.styles['InvoiceNormal']),
+            'receptor': Paragraph(f"{transaction_data.get('full_name', 'N/A')}<br/>RFC: {transaction_data.get('rfc', 'N/A')}<br/>Fecha: {transaction_data.get('date', 'N/A')}<br/>Hora: {transaction_data.get('time', 'N/A')}", 
+                                  self.styles['InvoiceSmall']),
+            'transaction_id': Paragraph(f"TXN-{transaction_data.get('id', 'N/A')}", self.styles['InvoiceNormal']),
+            'card': Paragraph(f"**** **** **** {transaction_data.get('card_last4', 'N/A')}", self.styles['InvoiceNormal']),
+            'cardholder_name': Paragraph(str(transaction_data.get('cardholder_name', 'N/A')), self.styles['InvoiceNormal']),
+            'status': Paragraph(str(transaction_data.get('status', 'N/A')), self.styles['InvoiceNormal']),
+            'amount': Paragraph(f"${amount:.2f}", self.styles['InvoiceNormal']),
+            'commission': Paragraph(f"${commission:.2f}", self.styles['InvoiceNormal']),
+            'total': Paragraph(f"${total:.2f}", self.styles['InvoiceNormal']),
+            # Generar código QR con información de verificación
+            'qr_image': self.generate_qr_code(qr_data),
+            'qr_info': Paragraph("<b>Código QR de Verificación</b><br/><br/>Escanea este código para verificar la autenticidad de la factura.<br/><br/><b>Sello Digital:</b> XXX1234567890<br/><b>Cadena Original:</b> ||1.0|PSE123456ABC|...<br/><b>UUID:</b> " + qr_data, 
+                                 self.styles['InvoiceSmall']),
+            # Pie de página
+            'footer': Paragraph(f"<i>Esta factura es un comprobante de pago generado por MU.<br/>Para dudas o aclaraciones, contacte a facturacion@mu.com<br/>Documento generado el {transaction_data.get('timestamp', 'N/A')} - MU S.A. de C.V.</i>", 
+                                self.styles['InvoiceSmall']),
+        }
+    
+    def build_elements(self, fields):
+        """
+        Arma el layout de la factura alrededor de los campos variables
+        
+        Args:
+            fields: dict de variable_fields (o de marcadores, al compilar la plantilla)
+        
+        Returns:
+            list: Flowables del documento
+        """
         # Contenedor para los elementos del documento
         elements = []
         
@@ -111,8 +274,7 @@ class InvoiceGenerator:
         # Información de la empresa y número de factura
         company_data = [
             [Paragraph("<b>MU S.A. de C.V.</b>", self.styles['InvoiceNormal']),
-             Paragraph(f"<b>FACTURA</b><br/>{transaction_data.get('invoice_number', 'N/A')}", 
-                      self.styles['InvoiceNormal'])]
+             fields['invoice_number']]
         ]
         company_table = Table(company_data, colWidths=[4*inch, 2.5*inch])
         company_table.setStyle(TableStyle([
@@ -130,8 +292,7 @@ class InvoiceGenerator:
              Paragraph("<b>RECEPTOR</b>", self.styles['InvoiceSubtitle'])],
             [Paragraph("MU S.A. de C.V.<br/>Av. Tecnología #123, Col. Digital<br/>Ciudad de México, CDMX 06600<br/>RFC: PSE123456ABC<br/>Tel: +52 55 1234 5678<br/>Email: facturacion@mu.com", 
                       self.styles['InvoiceSmall']),
-             Paragraph(f"{transaction_data.get('full_name', 'N/A')}<br/>RFC: {transaction_data.get('rfc', 'N/A')}<br/>Fecha: {transaction_data.get('date', 'N/A')}<br/>Hora: {transaction_data.get('time', 'N/A')}", 
-                      self.styles['InvoiceSmall'])]
+             fields['receptor']]
         ]
         info_table = Table(info_data, colWidths=[3.25*inch, 3.25*inch])
         info_table.setStyle(TableStyle([
@@ -150,15 +311,14 @@ class InvoiceGenerator:
         elements.append(Spacer(1, 0.1*inch))
         
         transaction_details = [
-            ['ID de Transacción:', f"TXN-{transaction_data.get('id', 'N/A')}"],
-            ['Método de Pago:', 'Tarjeta de Crédito/Débito'],
-            ['Tarjeta:', f"**** **** **** {transaction_data.get('card_last4', 'N/A')}"],
-            ['Titular:', transaction_data.get('cardholder_name', 'N/A')],
-            ['Estado:', transaction_data.get('status', 'N/A')],
+            ['ID de Transacción:', fields['transaction_id']],
+            ['Método de Pago:', Paragraph('Tarjeta de Crédito/Débito', self.styles['InvoiceNormal'])],
+            ['Tarjeta:', fields['card']],
+            ['Titular:', fields['cardholder_name']],
+            ['Estado:', fields['status']],
         ]
         
-        transaction_table_data = [[Paragraph(key, self.styles['InvoiceNormal']),
-                                  Paragraph(str(value), self.styles['InvoiceNormal'])] 
+        transaction_table_data = [[Paragraph(key, self.styles['InvoiceNormal']), value] 
                                  for key, value in transaction_details]
         
         transaction_table = Table(transaction_table_data, colWidths=[2.5*inch, 4*inch])
@@ -178,19 +338,14 @@ class InvoiceGenerator:
         elements.append(Paragraph("DESGLOSE DE MONTOS", self.styles['InvoiceSubtitle']))
         elements.append(Spacer(1, 0.1*inch))
         
-        amount = float(transaction_data.get('amount', 0))
-        commission = amount * 0.029
-        total = amount + commission
-        
         amounts_data = [
-            ['Concepto', 'Monto'],
-            ['Monto del Pago:', f"${amount:.2f}"],
-            ['Comisión (2.9%):', f"${commission:.2f}"],
-            ['TOTAL:', f"${total:.2f}"],
+            ['Concepto', Paragraph('Monto', self.styles['InvoiceNormal'])],
+            ['Monto del Pago:', fields['amount']],
+            ['Comisión (2.9%):', fields['commission']],
+            ['TOTAL:', fields['total']],
         ]
         
-        amounts_table_data = [[Paragraph(str(item[0]), self.styles['InvoiceNormal']),
-                              Paragraph(str(item[1]), self.styles['InvoiceNormal'])] 
+        amounts_table_data = [[Paragraph(str(item[0]), self.styles['InvoiceNormal']), item[1]] 
                              for item in amounts_data]
         
         amounts_table = Table(amounts_table_data, colWidths=[4.5*inch, 2*inch])
@@ -232,15 +387,9 @@ class InvoiceGenerator:
         elements.append(fiscal_table)
         elements.append(Spacer(1, 0.3*inch))
         
-        # Generar código QR con información de verificación
-        qr_data = f"MU-{transaction_data.get('invoice_number', 'N/A')}-{transaction_data.get('id', 'N/A')}"
-        qr_image = self.generate_qr_code(qr_data)
-        
         # Tabla con QR y información del sello
         qr_info_data = [
-            [qr_image, 
-             Paragraph("<b>Código QR de Verificación</b><br/><br/>Escanea este código para verificar la autenticidad de la factura.<br/><br/><b>Sello Digital:</b> XXX1234567890<br/><b>Cadena Original:</b> ||1.0|PSE123456ABC|...<br/><b>UUID:</b> " + qr_data, 
-                      self.styles['InvoiceSmall'])]
+            [fields['qr_image'], fields['qr_info']]
         ]
         
         qr_table = Table(qr_info_data, colWidths=[2*inch, 4.5*inch])
@@ -255,16 +404,164 @@ class InvoiceGenerator:
         elements.append(qr_table)
         elements.append(Spacer(1, 0.4*inch))
         
-        # Pie de página
-        footer_text = f"<i>Esta factura es un comprobante de pago generado por MU.<br/>Para dudas o aclaraciones, contacte a facturacion@mu.com<br/>Documento generado el {transaction_data.get('timestamp', 'N/A')} - MU S.A. de C.V.</i>"
-        elements.append(Paragraph(footer_text, self.styles['InvoiceSmall']))
+        elements.append(fields['footer'])
         
-        # Construir el PDF
-        doc.build(elements)
+        return elements
+
+
+class _FieldSlot(Flowable):
+    """
+    Marcador de un campo variable al compilar la plantilla
+    
+    Ocupa exactamente lo mismo que el flowable de ejemplo que envuelve y, al
+    dibujarse, solo registra la posición absoluta donde quedó en la página.
+    """
+    
+    def __init__(self, sample):
+        Flowable.__init__(self)
+        self.sample = sample
+        self.avail = None
+        self.size = None
+        self.position = None
+    
+    def wrap(self, availWidth, availHeight):
+        self.avail = (availWidth, availHeight)
+        self.size = self.sample.wrap(availWidth, availHeight)
+        self.width, self.height = self.size
+        return self.size
+    
+    def draw(self):
+        if self.position is None:
+            # translate() de drawOn ya dejó el origen del campo en la matriz actual
+            matrix = self.canv._currentMatrix
+            self.position = (self.canv.getPageNumber(), matrix[4], matrix[5])
+
+
+class CompiledInvoiceTemplate:
+    """
+    Plantilla de factura con el layout resuelto una sola vez por proceso
+    
+    Al compilarse arma el documento con datos de ejemplo (con el mismo
+    SimpleDocTemplate, así que los saltos de página son los mismos) y
+    registra la página y la posición de cada elemento y de cada campo
+    variable. Después dibuja una vez las partes fijas (tablas, fondos,
+    bordes y textos) y guarda los operadores PDF de cada página.
+    
+    Por factura solo se construyen los campos variables (nombre, RFC, montos,
+    folio, QR): se copian los operadores fijos de cada página al canvas y los
+    campos se dibujan encima en sus posiciones. Una vez compilada, la
+    plantilla solo se lee, así que puede compartirse entre hilos.
+    
+    Si un campo ocupa un tamaño distinto al del ejemplo (p. ej. un nombre que
+    necesita dos líneas), el layout cambiaría: render() retorna None y el
+    generador usa el armado completo con platypus.
+    """
+    
+    # Datos de ejemplo: cada campo ocupa las mismas líneas que un valor típico
+    SAMPLE_DATA = {
+        'id': 1,
+        'amount': 100.0,
+        'status': 'Autorizado',
+        'timestamp': '2000-01-01 00:00:00',
+        'date': '2000-01-01',
+        'time': '00:00:00',
+        'card_last4': '0000',
+        'cardholder_name': 'N/A',
+        'rfc': 'N/A',
+        'full_name': 'N/A',
+        'invoice_number': 'F0',
+    }
+    
+    def __init__(self, generator, pagesize=letter, margin=72):
+        self.generator = generator
+        self.pagesize = pagesize
         
-        # Si se proporcionó output_path, retornar el path, sino retornar el buffer
-        if output_path:
-            return output_path
-        else:
-            buffer.seek(0)
-            return buffer
+        self.slots = {name: _FieldSlot(sample)
+                      for name, sample in generator.variable_fields(self.SAMPLE_DATA).items()}
+        elements = generator.build_elements(self.slots)
+        
+        # (página, elemento, x, y, _sW) de cada elemento fijo de primer nivel
+        placed = []
+        for element in elements:
+            element.drawOn = self._recorder(element, placed)
+        
+        doc = SimpleDocTemplate(BytesIO(), pagesize=pagesize,
+                                rightMargin=margin, leftMargin=margin,
+                                topMargin=margin, bottomMargin=margin)
+        # build consume la lista que recibe
+        doc.build(list(elements))
+        
+        for element in elements:
+            del element.drawOn
+        
+        # Un elemento partido entre páginas se dibuja con otros objetos: no se puede fijar
+        drawn = {id(element) for _, element, _, _, _ in placed}
+        if any(id(element) not in drawn for element in elements
+               if not isinstance(element, (Spacer, _FieldSlot))):
+            raise ValueError('La plantilla de factura tiene elementos partidos entre páginas')
+        
+        missing = [name for name, slot in self.slots.items() if slot.position is None]
+        if missing:
+            raise ValueError(f'Campos sin posición en la plantilla: {", ".join(missing)}')
+        
+        self.pages, self.fonts = self._compile_pages(placed, doc.page)
+    
+    @staticmethod
+    def _recorder(element, placed):
+        """Sustituye drawOn del elemento para registrar dónde lo dibuja el documento"""
+        def record(canvas_, x, y, _sW=0):
+            if not isinstance(element, (Spacer, _FieldSlot)):
+                placed.append((canvas_.getPageNumber(), element, x, y, _sW))
+            type(element).drawOn(element, canvas_, x, y, _sW)
+        return record
+    
+    def _compile_pages(self, placed, page_count):
+        """
+        Dibuja las partes fijas una vez y guarda sus operadores PDF
+        
+        Returns:
+            tuple: (operadores de cada página, fuentes en orden de registro)
+        """
+        canv = canvas.Canvas(BytesIO(), pagesize=self.pagesize)
+        pages = []
+        for page in range(1, page_count + 1):
+            for element_page, element, x, y, _sW in placed:
+                if element_page == page:
+                    element.drawOn(canv, x, y, _sW)
+            pages.append('\n'.join(canv._code))
+            canv.showPage()
+        
+        # Los operadores guardados usan los nombres internos (/F1, /F2...) que el
+        # documento asignó a cada fuente; se registran en el mismo orden al dibujar
+        fonts = sorted(canv._doc.fontMapping, key=lambda name: int(canv._doc.fontMapping[name][2:]))
+        return pages, fonts
+    
+    def render(self, transaction_data):
+        """
+        Dibuja una factura con el layout compilado
+        
+        Returns:
+            BytesIO con el PDF o None si algún campo no cabe en su lugar
+        """
+        fields = self.generator.variable_fields(transaction_data)
+        for name, field in fields.items():
+            slot = self.slots[name]
+            if field.wrap(*slot.avail) != slot.size:
+                return None
+        
+        buffer = BytesIO()
+        canv = canvas.Canvas(buffer, pagesize=self.pagesize)
+        for font in self.fonts:
+            canv._doc.getInternalFontName(font)
+        
+        for page, operators in enumerate(self.pages, start=1):
+            canv.addLiteral(operators)
+            for name, field in fields.items():
+                field_page, x, y = self.slots[name].position
+                if field_page == page:
+                    field.drawOn(canv, x, y)
+            canv.showPage()
+        
+        canv.save()
+        buffer.seek(0)
+        return buffer
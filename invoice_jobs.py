@@ -0,0 +1,371 @@
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from collections import deque
+import multiprocessing
+import threading
+import json
+import time
+import uuid
+import os
+import re
+
+import metrics
+from invoice_cache import write_atomic
+from invoice_generator import InvoiceGenerator
+
+
+# Generador precargado de cada proceso del pool (ver _init_worker)
+_generator = None
+
+
+def _init_worker():
+    """Inicializa un proceso del pool con su propio InvoiceGenerator"""
+    global _generator
+    _generator = InvoiceGenerator()
+
+
+def _write_json(path, data):
+    """Escribe un archivo JSON de forma atómica (otro worker nunca ve un archivo a medias)"""
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def _render_job(pdf_path, transaction_data):
+    """
+    Renderiza una factura dentro de un proceso del pool y la escribe en pdf_path
+
+    El PDF no regresa por el pipe del pool: el worker HTTP lo sirve desde disco.
+
+    Returns:
+        tuple: (ruta, tamaño en bytes)
+    """
+    with metrics.INVOICE_RENDER.time():
+        pdf_buffer = _generator.generate_invoice_pdf(transaction_data)
+    write_atomic(pdf_path, pdf_buffer.getbuffer())
+    return pdf_path, pdf_buffer.getbuffer().nbytes
+
+
+class QueueFullError(Exception):
+    """La cola de trabajos de facturas alcanzó su límite"""
+
+
+class InvoiceJobQueue:
+    """
+    Cola de trabajos para generar facturas PDF fuera de los workers HTTP
+
+    Los PDF se generan en un pool de procesos que conservan un
+    InvoiceGenerator ya inicializado (ReportLab, estilos y fuentes cargados).
+    El estado de cada trabajo y su resultado se guardan en job_dir, de modo
+    que cualquier worker de gunicorn puede consultar un trabajo enviado por
+    otro. Cada worker limita cuántos trabajos tiene pendientes a la vez.
+
+    Con un InvoiceCache los PDF se escriben directamente en el caché y una
+    factura ya generada no vuelve a pasar por el pool.
+    """
+
+    JOB_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+    def __init__(self, job_dir=None, max_workers=None, max_pending=None, job_ttl=3600, cache=None):
+        """
+        Args:
+            job_dir: Directorio para estados y PDFs (INVOICE_JOB_DIR)
+            max_workers: Procesos del pool (INVOICE_WORKERS, por defecto 2)
+            max_pending: Trabajos pendientes por worker (INVOICE_MAX_PENDING, por defecto 32)
+            job_ttl: Segundos que se conservan los trabajos terminados
+            cache: InvoiceCache opcional donde se guardan los PDF generados
+        """
+        self.job_dir = job_dir or os.environ.get('INVOICE_JOB_DIR', 'database/invoice_jobs')
+        self.max_workers = max_workers or int(os.environ.get('INVOICE_WORKERS', 2))
+        self.max_pending = max_pending or int(os.environ.get('INVOICE_MAX_PENDING', 32))
+        self.job_ttl = job_ttl
+        self.cache = cache
+        os.makedirs(self.job_dir, exist_ok=True)
+
+        self._executor = None
+        self._executor_pid = None
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._last_cleanup = 0.0
+
+    def _get_executor(self):
+        """Crea el pool en el proceso que lo usa (nunca se hereda a través de un fork)"""
+        pid = os.getpid()
+        if self._executor_pid != pid:
+            # Pool y trabajos pendientes del proceso padre
+            self._executor = None
+            self._executor_pid = pid
+            self._pending = 0
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker
+            )
+        return self._executor
+
+    def _replace_executor(self, broken):
+        """
+        Descarta un pool roto y retorna uno nuevo
+
+        Si un proceso del pool muere (segfault, OOM) el pool deja de aceptar
+        trabajos para siempre; sin reemplazarlo, ninguna factura se volvería
+        a generar en este worker.
+        """
+        with self._lock:
+            if self._executor is broken:
+                self._executor = None
+            executor = self._get_executor()
+        broken.shutdown(wait=False)
+        return executor
+
+    def _status_path(self, job_id):
+        return os.path.join(self.job_dir, f'{job_id}.json')
+
+    def _output_path(self, job_id, transaction_data):
+        """Ruta donde el pool escribe el PDF: el caché si existe, si no job_dir"""
+        if self.cache is not None:
+            return self.cache.path_for(transaction_data)
+        return os.path.join(self.job_dir, f'{job_id}.pdf')
+
+    def cached(self, transaction_data):
+        """Ruta del PDF de la factura si ya está en el caché, si no None"""
+        if self.cache is None:
+            return None
+        path = self.cache.get(transaction_data)
+        metrics.INVOICE_CACHE.labels('hit' if path else 'miss').inc()
+        return path
+
+    def submit(self, transaction_data, owner_id=None, on_done=None):
+        """
+        Encola la generación de una factura
+
+        Args:
+            transaction_data: Datos de la factura (ver InvoiceGenerator.generate_invoice_pdf)
+            owner_id: Usuario dueño del trabajo; solo él puede consultarlo
+            on_done: Función opcional que recibe la ruta del PDF al terminar; si
+                retorna un dict se agrega al estado del trabajo y si lanza una
+                excepción el trabajo queda como fallido
+
+        Returns:
+            str: Identificador del trabajo
+
+        Raises:
+            QueueFullError: Si este worker ya tiene max_pending trabajos en curso
+        """
+        self._maybe_cleanup()
+        job_id = uuid.uuid4().hex
+        status = {
+            'job_id': job_id,
+            'status': 'pending',
+            'owner_id': owner_id,
+            'transaction_id': transaction_data.get('id'),
+            'invoice_number': transaction_data.get('invoice_number'),
+            'created_at': time.time()
+        }
+
+        cached_path = self.cached(transaction_data)
+        if cached_path:
+            self._complete(status, cached_path, on_done)
+            return job_id
+
+        executor = self._reserve()
+        _write_json(self._status_path(job_id), status)
+
+        future = self._submit(executor, _render_job, self._output_path(job_id, transaction_data),
+                              transaction_data)
+        future.add_done_callback(lambda f: self._finish(status, f, on_done))
+        return job_id
+
+    def prewarm(self, transaction_data):
+        """
+        Genera una factura en el caché sin que nadie la haya pedido todavía
+
+        Solo usa la mitad de la cola del worker para no retrasar las descargas
+        que sí se están esperando.
+
+        Returns:
+            bool: True si se encoló la generación
+        """
+        if self.cache is None or self.cached(transaction_data):
+            return False
+
+        with self._lock:
+            executor = self._get_executor()
+            if self._pending >= self.max_pending // 2:
+                return False
+            self._pending += 1
+
+        future = self._submit(executor, _render_job, self.cache.path_for(transaction_data),
+                              transaction_data)
+        future.add_done_callback(self._record_write)
+        return True
+
+    def _reserve(self):
+        """Reserva un lugar en la cola de este worker y retorna el pool"""
+        with self._lock:
+            executor = self._get_executor()
+            if self._pending >= self.max_pending:
+                raise QueueFullError('Demasiadas facturas en proceso. Intenta de nuevo en unos segundos')
+            self._pending += 1
+            return executor
+
+    def _release(self, future=None):
+        with self._lock:
+            self._pending -= 1
+
+    def _record_write(self, future):
+        """Contabiliza en el caché un PDF recién generado"""
+        if self.cache is not None and future.exception() is None:
+            self.cache.record_write(future.result()[1])
+
+    def _submit(self, executor, fn, *args):
+        """Envía una tarea ya reservada; el lugar se libera al terminar"""
+        try:
+            try:
+                future = executor.submit(fn, *args)
+            except BrokenProcessPool:
+                # Un proceso del pool murió: se reintenta una vez en un pool nuevo
+                future = self._replace_executor(executor).submit(fn, *args)
+        except Exception:
+            self._release()
+            raise
+        future.add_done_callback(self._release)
+        return future
+
+    def _finish(self, status, future, on_done=None):
+        """Registra el resultado de un trabajo al terminar"""
+        error = future.exception()
+        if error is None:
+            self._record_write(future)
+            self._complete(status, future.result()[0], on_done)
+        else:
+            status = dict(status, status='failed', error=str(error), finished_at=time.time())
+            _write_json(self._status_path(status['job_id']), status)
+
+    def _complete(self, status, pdf_path, on_done=None):
+        """Marca un trabajo como terminado después de ejecutar su on_done"""
+        status = dict(status, status='done', path=pdf_path)
+        if on_done is not None:
+            try:
+                status.update(on_done(pdf_path) or {})
+            except Exception as e:
+                status.update(status='failed', error=str(e))
+        status['finished_at'] = time.time()
+        _write_json(self._status_path(status['job_id']), status)
+
+    def status(self, job_id, owner_id=None):
+        """
+        Retorna el estado de un trabajo o None si no existe (o es de otro usuario)
+        """
+        if not self.JOB_ID_PATTERN.match(job_id):
+            return None
+        try:
+            with open(self._status_path(job_id), encoding='utf-8') as f:
+                status = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        if owner_id is not None and status.get('owner_id') != owner_id:
+            return None
+        return status
+
+    def render(self, transaction_data, timeout=30.0):
+        """
+        Genera una factura en el pool (o la toma del caché) y espera el resultado
+
+        Para flujos que necesitan el PDF en la misma petición; el trabajo de
+        CPU ocurre en el pool, no en el worker HTTP.
+
+        Returns:
+            str: Ruta del PDF
+        """
+        cached_path = self.cached(transaction_data)
+        if cached_path:
+            return cached_path
+
+        executor = self._reserve()
+        pdf_path = self._output_path(uuid.uuid4().hex, transaction_data)
+        future = self._submit(executor, _render_job, pdf_path, transaction_data)
+        future.add_done_callback(self._record_write)
+        return future.result(timeout=timeout)[0]
+
+    def render_many(self, transactions, window=None, timeout=60.0):
+        """
+        Genera muchas facturas en paralelo con una ventana acotada
+        
+        Nunca hay más de window facturas en curso (ni más de la mitad de la
+        cola del worker), así que la memoria no depende de cuántas facturas
+        se pidan. Los resultados se entregan en el orden de transactions.
+        
+        Args:
+            transactions: Iterable de datos de facturas (puede ser un generador)
+            window: Facturas en curso a la vez (por defecto 4 por proceso del pool)
+            timeout: Segundos máximos de espera por factura
+        
+        Yields:
+            tuple: (datos de la factura, ruta del PDF)
+        """
+        window = max(1, min(window or self.max_workers * 4, self.max_pending // 2))
+        in_flight = deque()
+        
+        for transaction_data in transactions:
+            if len(in_flight) >= window:
+                yield self._collect(*in_flight.popleft(), timeout)
+            in_flight.append((transaction_data, self._render_future(transaction_data)))
+        
+        while in_flight:
+            yield self._collect(*in_flight.popleft(), timeout)
+    
+    def _render_future(self, transaction_data):
+        """Future con (ruta, tamaño) de la factura; None si la cola está llena"""
+        cached_path = self.cached(transaction_data)
+        if cached_path:
+            future = Future()
+            future.set_result((cached_path, None))
+            return future
+        
+        try:
+            executor = self._reserve()
+        except QueueFullError:
+            return None
+        
+        future = self._submit(executor, _render_job, self._output_path(uuid.uuid4().hex, transaction_data),
+                              transaction_data)
+        future.add_done_callback(self._record_write)
+        return future
+    
+    def _collect(self, transaction_data, future, timeout):
+        """Espera una factura de render_many; las que no alcanzaron lugar se generan ahora"""
+        if future is not None:
+            return transaction_data, future.result(timeout=timeout)[0]
+        
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                return transaction_data, self.render(transaction_data, timeout)
+            except QueueFullError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+    
+    def _maybe_cleanup(self, interval=300):
+        """Elimina trabajos más viejos que job_ttl, como máximo cada interval segundos"""
+        now = time.time()
+        if now - self._last_cleanup < interval:
+            return
+        self._last_cleanup = now
+
+        for name in os.listdir(self.job_dir):
+            path = os.path.join(self.job_dir, name)
+            try:
+                if now - os.path.getmtime(path) > self.job_ttl:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def shutdown(self, wait=True):
+        if self._executor is not None and self._executor_pid == os.getpid():
+            self._executor.shutdown(wait=wait)
+            self._executor = None
+            self._executor_pid = None
@@ -0,0 +1,92 @@
+import os
+import threading
+from datetime import datetime
+
+
+class InvoiceNumberAllocator:
+    """
+    Folios de factura sin repetir, asignados en memoria por bloques
+
+    Cada serie (una por año: F2026, F2027...) tiene un contador en la tabla
+    invoice_sequences. Un proceso reserva de un solo golpe block_size folios
+    incrementando el contador y después los entrega desde memoria, así que
+    solo uno de cada block_size pagos hace una escritura para su folio.
+
+    Garantías:
+    - Ningún folio se entrega dos veces: cada bloque se reserva en su propia
+      transacción confirmada antes de usarse, y el contador solo crece.
+    - Dentro de un proceso los folios de una serie son crecientes; los de
+      distintos workers se intercalan (cada uno avanza en su propio bloque).
+    - Al reiniciar, el resto de los bloques reservados se pierde: puede
+      haber huecos en la numeración, nunca folios repetidos ni que retrocedan.
+
+    Los bloques no se heredan en un fork: cada worker reserva los suyos.
+    """
+
+    def __init__(self, db, block_size=None):
+        """
+        Args:
+            db: Database con la tabla invoice_sequences
+            block_size: Folios por reserva (INVOICE_BLOCK_SIZE, por defecto 100)
+        """
+        self.db = db
+        self.block_size = block_size or int(os.environ.get('INVOICE_BLOCK_SIZE', 100))
+        self._blocks = {}
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def series(now=None):
+        """Serie de los folios emitidos en la fecha now (por defecto hoy)"""
+        return f'F{(now or datetime.now()).year}'
+
+    @staticmethod
+    def format(series, value):
+        """Folio de factura: serie y número con 8 dígitos (p. ej. F202600000042)"""
+        return f'{series}{value:08d}'
+
+    def next(self, now=None):
+        """Siguiente folio de la serie actual"""
+        return self.take(1, now)[0]
+
+    def take(self, count, now=None):
+        """
+        Reserva count folios consecutivos dentro de este proceso
+
+        No debe llamarse con una transacción de escritura abierta: si el
+        bloque actual se agota se reserva otro con BEGIN IMMEDIATE en una
+        conexión aparte, que esperaría al candado de la propia petición.
+
+        Returns:
+            list: Folios en orden creciente
+        """
+        series = self.series(now)
+        numbers = []
+        with self._lock:
+            pid = os.getpid()
+            if self._pid != pid:
+                # Bloques de otro proceso (heredados en el fork): no se usan
+                self._blocks = {}
+                self._pid = pid
+            while len(numbers) < count:
+                start, end = self._blocks.get(series) or self._reserve(series)
+                taken = min(end - start, count - len(numbers))
+                numbers.extend(self.format(series, value) for value in range(start, start + taken))
+                self._blocks[series] = (start + taken, end) if start + taken < end else None
+        return numbers
+
+    def _reserve(self, series):
+        """
+        Incrementa el contador de la serie en block_size
+
+        Returns:
+            tuple: (primer folio, fin exclusivo) del bloque reservado
+        """
+        with self.db.transaction(immediate=True) as conn:
+            rows = conn.execute('''
+                INSERT INTO invoice_sequences (series, next_value) VALUES (?, 1 + ?)
+                ON CONFLICT (series) DO UPDATE SET next_value = next_value + ?
+                RETURNING next_value
+            ''', (series, self.block_size, self.block_size)).fetchall()
+        end = rows[0][0]
+        return end - self.block_size, end
@@ -0,0 +1,157 @@
+import os
+
+
+class Ledger:
+    """
+    Libro mayor de saldos de las tarjetas (ledger_entries)
+
+    Cada movimiento de saldo es una fila nueva en ledger_entries: la
+    apertura de la tarjeta (el saldo con el que se creó, o el que tenía al
+    introducir el libro), un cargo por cada pago autorizado y los ajustes.
+    Las filas nunca se modifican ni se borran.
+
+    cards.balance es un snapshot: la suma de los movimientos hasta
+    cards.ledger_snapshot_id. El saldo disponible es el snapshot más los
+    movimientos posteriores, así que autorizar un pago solo agrega una fila
+    en lugar de reescribir la fila de la tarjeta. compact() pasa los
+    movimientos pendientes al snapshot y reconcile() verifica que snapshot,
+    movimientos y transacciones coincidan.
+
+    Cualquier par (balance, ledger_snapshot_id) que se haya confirmado da el
+    mismo saldo disponible, de modo que una copia vieja de la tarjeta (p. ej.
+    del caché de tarjetas) no altera la regla de fondos.
+    """
+
+    # Diferencia máxima entre sumas de REAL que se considera igual
+    TOLERANCE = 0.005
+
+    def __init__(self, compact_batch=None):
+        """
+        Args:
+            compact_batch: Tarjetas por transacción al compactar (LEDGER_COMPACT_BATCH, por defecto 500)
+        """
+        self.compact_batch = compact_batch or int(os.environ.get('LEDGER_COMPACT_BATCH', 500))
+
+    def pending(self, conn, card):
+        """Suma de los movimientos de la tarjeta posteriores a su snapshot"""
+        return conn.execute(
+            'SELECT COALESCE(SUM(amount), 0) FROM ledger_entries WHERE card_id = ? AND id > ?',
+            (card['id'], card['ledger_snapshot_id'])
+        ).fetchone()[0]
+
+    def available(self, conn, card):
+        """Saldo disponible: snapshot + movimientos pendientes"""
+        return card['balance'] + self.pending(conn, card)
+
+    def record(self, conn, card_id, kind, amount, transaction_id=None):
+        """
+        Agrega un movimiento dentro de la transacción abierta en conn
+
+        Args:
+            kind: 'cargo' (amount negativo) o 'ajuste'
+            transaction_id: Transacción que originó el movimiento
+
+        Returns:
+            int: id del movimiento
+        """
+        cursor = conn.execute('''
+            INSERT INTO ledger_entries (card_id, kind, amount, transaction_id)
+            VALUES (?, ?, ?, ?)
+        ''', (card_id, kind, amount, transaction_id))
+        return cursor.lastrowid
+
+    def compact(self, conn, limit=None):
+        """
+        Pasa al snapshot los movimientos pendientes de hasta limit tarjetas
+
+        Solo actualiza tarjetas con movimientos posteriores a su snapshot.
+        Incrementa version, así que las copias en caché se vuelven a leer.
+
+        Returns:
+            int: Tarjetas compactadas
+        """
+        rows = conn.execute('''
+            SELECT l.card_id, SUM(l.amount), MAX(l.id)
+            FROM cards c
+            JOIN ledger_entries l ON l.card_id = c.id AND l.id > c.ledger_snapshot_id
+            GROUP BY l.card_id
+            LIMIT ?
+        ''', (limit or self.compact_batch,)).fetchall()
+        conn.executemany('''
+            UPDATE cards
+            SET balance = balance + ?, ledger_snapshot_id = ?, version = version + 1
+            WHERE id = ?
+        ''', ((total, last_id, card_id) for card_id, total, last_id in rows))
+        return len(rows)
+
+    def compact_all(self, db):
+        """
+        Compacta todas las tarjetas en transacciones de compact_batch tarjetas
+
+        Cada lote toma el candado de escritura por poco tiempo para no
+        detener los pagos mientras se compacta.
+
+        Returns:
+            int: Tarjetas compactadas
+        """
+        total = 0
+        while True:
+            with db.transaction(immediate=True) as conn:
+                compacted = self.compact(conn)
+            total += compacted
+            if compacted < self.compact_batch:
+                return total
+
+    def reconcile(self, conn):
+        """
+        Verifica snapshots, movimientos y transacciones entre sí
+
+        - cards.balance es igual a la suma de los movimientos hasta
+          ledger_snapshot_id y la tarjeta tiene su apertura
+        - cada pago autorizado posterior a la apertura de su tarjeta tiene
+          exactamente un cargo por el mismo monto, y cada cargo corresponde
+          a un pago autorizado
+
+        Returns:
+            list: Problemas encontrados (tuplas (card_id, descripción))
+        """
+        problems = []
+
+        for card_id, balance, snapshot, openings, settled in conn.execute('''
+            SELECT c.id, c.balance, c.ledger_snapshot_id,
+                   (SELECT COUNT(*) FROM ledger_entries l
+                    WHERE l.card_id = c.id AND l.kind = 'apertura'),
+                   (SELECT COALESCE(SUM(l.amount), 0) FROM ledger_entries l
+                    WHERE l.card_id = c.id AND l.id <= c.ledger_snapshot_id)
+            FROM cards c
+            ORDER BY c.id
+        ''').fetchall():
+            if openings != 1:
+                problems.append((card_id, f'{openings} movimientos de apertura'))
+            if abs(balance - settled) > self.TOLERANCE:
+                problems.append((card_id, f'snapshot {balance:.2f} distinto de la suma de movimientos '
+                                          f'hasta #{snapshot} ({settled:.2f})'))
+
+        # En la apertura, transaction_id es la última transacción ya incluida en el saldo
+        for transaction_id, card_id, amount, charges, charged in conn.execute('''
+            SELECT t.id, t.card_id, t.amount, COUNT(l.id), COALESCE(SUM(l.amount), 0)
+            FROM transactions t
+            JOIN ledger_entries o ON o.card_id = t.card_id AND o.kind = 'apertura'
+            LEFT JOIN ledger_entries l ON l.transaction_id = t.id AND l.kind = 'cargo'
+            WHERE t.status = 'autorizado' AND t.id > COALESCE(o.transaction_id, 0)
+            GROUP BY t.id
+            HAVING COUNT(l.id) != 1 OR ABS(COALESCE(SUM(l.amount), 0) + t.amount) > ?
+        ''', (self.TOLERANCE,)).fetchall():
+            problems.append((card_id, f'transacción #{transaction_id} por {amount:.2f} con {charges} '
+                                      f'cargo(s) que suman {charged:.2f}'))
+
+        for entry_id, card_id, transaction_id in conn.execute('''
+            SELECT l.id, l.card_id, l.transaction_id
+            FROM ledger_entries l
+            LEFT JOIN transactions t ON t.id = l.transaction_id
+            WHERE l.kind = 'cargo'
+              AND (t.id IS NULL OR t.status != 'autorizado' OR t.card_id IS NOT l.card_id)
+        ''').fetchall():
+            problems.append((card_id, f'cargo #{entry_id} sin pago autorizado (transacción {transaction_id})'))
+
+        return problems
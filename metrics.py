@@ -0,0 +1,122 @@
+"""
+Métricas de la aplicación en formato Prometheus
+
+Con gunicorn cada worker (y cada proceso del pool de facturas) escribe sus
+valores en PROMETHEUS_MULTIPROC_DIR y /metrics los suma al responder, así
+que cualquier worker reporta el total de todos. La variable debe definirse
+antes de que los procesos importen este módulo (gunicorn_config.py lo hace).
+Sin la variable (p. ej. python app.py) se usa el registro del proceso.
+"""
+
+import os
+import threading
+import time
+
+from prometheus_client import CollectorRegistry, Counter, Histogram, CONTENT_TYPE_LATEST, generate_latest
+from prometheus_client import REGISTRY, multiprocess
+
+MULTIPROC_DIR = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+
+HTTP_REQUESTS = Counter(
+    'mu_http_requests_total', 'Peticiones HTTP atendidas',
+    ['endpoint', 'method', 'status'])
+HTTP_LATENCY = Histogram(
+    'mu_http_request_duration_seconds', 'Tiempo de respuesta por endpoint',
+    ['endpoint', 'method'],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+
+SQL_STATEMENTS = Counter(
+    'mu_sql_statements_total', 'Sentencias SQL ejecutadas', ['endpoint'])
+SQL_SECONDS = Counter(
+    'mu_sql_seconds_total', 'Tiempo total en SQLite', ['endpoint'])
+REQUEST_SQL_STATEMENTS = Histogram(
+    'mu_request_sql_statements', 'Sentencias SQL por petición', ['endpoint'],
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100, 500))
+REQUEST_SQL_SECONDS = Histogram(
+    'mu_request_sql_seconds', 'Tiempo en SQLite por petición', ['endpoint'],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1))
+
+INVOICE_RENDER = Histogram(
+    'mu_invoice_render_seconds', 'Tiempo de generación de una factura PDF',
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5))
+INVOICE_CACHE = Counter(
+    'mu_invoice_cache_requests_total', 'Búsquedas en el caché de facturas', ['result'])
+
+EMAIL_SEND = Histogram(
+    'mu_email_send_seconds', 'Tiempo de entrega de un email por SMTP', ['result'],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+EMAIL_OUTBOX = Counter(
+    'mu_email_outbox_total', 'Resultados de los intentos de entrega de la bandeja de salida', ['status'])
+
+CARD_CACHE = Counter(
+    'mu_card_cache_requests_total',
+    'Búsquedas en el caché de tarjetas (stale = la copia ya tenía otra versión)', ['result'])
+
+PAYMENTS = Counter(
+    'mu_payments_total', 'Pagos procesados por resultado y regla que rechazó', ['outcome', 'rule'])
+
+# Sentencias SQL de la petición en curso en este hilo
+_request = threading.local()
+
+
+def start_request():
+    """Empieza a medir una petición (before_request)"""
+    _request.start = time.perf_counter()
+    _request.statements = 0
+    _request.sql_seconds = 0.0
+
+
+def finish_request(endpoint, method, status):
+    """Registra la petición en curso (after_request)"""
+    start = getattr(_request, 'start', None)
+    if start is None:
+        return
+    _request.start = None
+
+    endpoint = endpoint or 'none'
+    HTTP_REQUESTS.labels(endpoint, method, str(status)).inc()
+    HTTP_LATENCY.labels(endpoint, method).observe(time.perf_counter() - start)
+    REQUEST_SQL_STATEMENTS.labels(endpoint).observe(_request.statements)
+    REQUEST_SQL_SECONDS.labels(endpoint).observe(_request.sql_seconds)
+    if _request.statements:
+        SQL_STATEMENTS.labels(endpoint).inc(_request.statements)
+        SQL_SECONDS.labels(endpoint).inc(_request.sql_seconds)
+
+
+def observe_sql(seconds, statements, sql=None, parameters=None):
+    """
+    Observador de Database: suma una sentencia a la petición en curso
+
+    Fuera de una petición (hilos de la bandeja de salida, scripts) se cuenta
+    directamente con endpoint="background".
+    """
+    if getattr(_request, 'start', None) is not None:
+        _request.statements += statements
+        _request.sql_seconds += seconds
+    else:
+        if statements:
+            SQL_STATEMENTS.labels('background').inc(statements)
+        SQL_SECONDS.labels('background').inc(seconds)
+
+
+def record_payment(result):
+    """Cuenta un resultado de PaymentRules.process_payment"""
+    if result['authorized']:
+        PAYMENTS.labels('autorizado', '').inc()
+    else:
+        PAYMENTS.labels('rechazado', result.get('rule') or 'desconocida').inc()
+
+
+def render():
+    """
+    Métricas en formato de texto de Prometheus
+
+    Returns:
+        tuple: (contenido, content type)
+    """
+    if MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
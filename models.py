@@ -1,77 +1,634 @@
-from datetime import datetime, timedelta
+from datetime import datetime
 from werkzeug.security import generate_password_hash, check_password_hash
+from contextlib import contextmanager
 import sqlite3
+import threading
+import queue
+import time
+import os
 import re
 
+from velocity import VelocityLimiter
+from ledger import Ledger
+from rule_engine import RuleEngine, COST_MEMORY, COST_DATABASE, load_rule_config
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor que reporta el tiempo de cada sentencia a su TimedConnection"""
+    
+    sql = None
+    
+    def execute(self, sql, parameters=()):
+        self.sql = sql
+        return self.connection._timed(1, sql, parameters, super().execute, sql, parameters)
+    
+    def executemany(self, sql, seq_of_parameters):
+        self.sql = sql
+        return self.connection._timed(1, sql, None, super().executemany, sql, seq_of_parameters)
+    
+    def fetchone(self):
+        return self.connection._timed(0, self.sql, None, super().fetchone)
+    
+    def fetchmany(self, size=None):
+        return self.connection._timed(0, self.sql, None, super().fetchmany,
+                                      size if size is not None else self.arraysize)
+    
+    def fetchall(self):
+        return self.connection._timed(0, self.sql, None, super().fetchall)
+
+
+class TimedConnection(sqlite3.Connection):
+    """
+    Conexión que mide sus sentencias
+    
+    Cada observador de observers recibe (segundos, sentencias, sql,
+    parámetros) por cada execute, cada fetch (SQLite avanza la consulta al
+    leer las filas; llega con sentencias=0 y sin parámetros) y cada commit.
+    Sin observadores no se mide nada.
+    
+    after_commit registra funciones que se ejecutan solo si la transacción
+    en curso se confirma (p. ej. actualizar el caché de tarjetas).
+    """
+    
+    observers = ()
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._after_commit = []
+    
+    def after_commit(self, callback):
+        """Ejecuta callback después del siguiente commit; se descarta si hay rollback"""
+        self._after_commit.append(callback)
+    
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+    
+    def _timed(self, statements, sql, parameters, method, *args):
+        observers = self.observers
+        if not observers:
+            return method(*args)
+        start = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            elapsed = time.perf_counter() - start
+            for observer in observers:
+                observer(elapsed, statements, sql, parameters)
+    
+    # Connection.execute no pasa por cursor(): se crea el cursor medido explícitamente
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+    
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+    
+    def commit(self):
+        # El commit escribe el WAL y puede ser la parte más lenta de un pago
+        self._timed(1, 'COMMIT', None, super().commit)
+        callbacks, self._after_commit = self._after_commit, []
+        for callback in callbacks:
+            callback()
+    
+    def rollback(self):
+        self._after_commit = []
+        return super().rollback()
+
+
 class Database:
-    def __init__(self, db_path='database/payments.db'):
-        self.db_path = db_path
+    # PRAGMAs aplicados una sola vez al abrir cada conexión del pool
+    CONNECTION_PRAGMAS = (
+        'PRAGMA journal_mode = WAL',
+        'PRAGMA synchronous = NORMAL',
+        'PRAGMA cache_size = -16000',        # ~16 MB de caché de páginas
+        'PRAGMA mmap_size = 268435456',      # 256 MB mapeados en memoria
+        'PRAGMA temp_store = MEMORY',
+    )
+    
+    def __init__(self, db_path=None, pool_size=None, busy_timeout=None):
+        self.db_path = db_path or os.environ.get('DATABASE_PATH', 'database/payments.db')
+        self.pool_size = pool_size or int(os.environ.get('DB_POOL_SIZE', 8))
+        self.busy_timeout = busy_timeout or float(os.environ.get('DB_BUSY_TIMEOUT', 5.0))
+        self._pool = None
+        self._pool_pid = None
+        self._pool_lock = threading.Lock()
+        # Funciones (segundos, sentencias, sql, parámetros) que reciben cada
+        # sentencia SQL (ver TimedConnection)
+        self.statement_observers = []
+        # Funciones que reciben cada conexión nueva del pool
+        self.connection_hooks = []
         self.init_db()
     
-    def init_db(self):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+    def _create_connection(self):
+        """Abre una conexión nueva y aplica los PRAGMAs de rendimiento"""
+        conn = sqlite3.connect(self.db_path, timeout=self.busy_timeout,
+                               check_same_thread=False, factory=TimedConnection)
+        for pragma in self.CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        for hook in self.connection_hooks:
+            hook(conn)
+        return conn
+    
+    def _get_pool(self):
+        """
+        Retorna el pool del proceso actual.
         
-        # Tabla de usuarios
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE NOT NULL,
-                email TEXT UNIQUE NOT NULL,
-                password_hash TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Tabla de tarjetas
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS cards (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                card_number TEXT UNIQUE NOT NULL,
-                cardholder_name TEXT NOT NULL,
-                expiry_date TEXT NOT NULL,
-                cvv TEXT NOT NULL,
-                balance REAL NOT NULL DEFAULT 0.0,
-                is_verified BOOLEAN DEFAULT TRUE,
-                attempts_count INTEGER DEFAULT 0,
-                last_attempt TIMESTAMP,
-                is_blocked BOOLEAN DEFAULT FALSE,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Tabla de transacciones
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS transactions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                amount REAL NOT NULL,
-                status TEXT NOT NULL,
-                rejection_reason TEXT,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                card_id INTEGER,
-                user_id INTEGER,
-                rfc TEXT,
-                full_name TEXT,
-                invoice_number TEXT,
-                FOREIGN KEY (card_id) REFERENCES cards (id),
-                FOREIGN KEY (user_id) REFERENCES users (id)
+        Las conexiones SQLite no deben cruzar un fork: si el pool fue creado
+        por otro proceso (p. ej. el master de gunicorn con preload_app), se
+        descarta sin cerrar sus conexiones y se crea uno nuevo para este worker.
+        """
+        pid = os.getpid()
+        if self._pool_pid != pid:
+            with self._pool_lock:
+                if self._pool_pid != pid:
+                    if self._pool is not None:
+                        # Mantener la referencia evita que el GC cierre en el
+                        # hijo conexiones que pertenecen al proceso padre
+                        self._inherited_pool = self._pool
+                    self._pool = queue.LifoQueue(maxsize=self.pool_size)
+                    self._pool_pid = pid
+        return self._pool
+    
+    @contextmanager
+    def connection(self):
+        """
+        Presta una conexión del pool y la devuelve al terminar.
+        
+        Si el bloque termina con una transacción abierta (por error o porque
+        no se hizo commit) se revierte antes de regresar la conexión al pool.
+        
+        Es seguro llamarlo desde varios hilos (workers gthread, hilos de la
+        bandeja de salida): el pool es una cola sincronizada y una conexión
+        prestada solo la usa el hilo que la tomó hasta que la devuelve.
+        """
+        pool = self._get_pool()
+        try:
+            conn = pool.get_nowait()
+        except queue.Empty:
+            conn = self._create_connection()
+        conn.observers = self.statement_observers
+        
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            conn._after_commit = []
+            try:
+                pool.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+    
+    @contextmanager
+    def transaction(self, immediate=False):
+        """
+        Ejecuta el bloque dentro de una transacción y hace commit al salir.
+        
+        Args:
+            immediate: Si es True usa BEGIN IMMEDIATE para tomar el candado de
+                escritura desde el inicio y evitar 'database is locked' al
+                promover una lectura a escritura
+        """
+        with self.connection() as conn:
+            conn.execute('BEGIN IMMEDIATE' if immediate else 'BEGIN')
+            try:
+                yield conn
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+    
+    def close_all(self):
+        """Cierra las conexiones inactivas del pool del proceso actual"""
+        pool = self._get_pool()
+        while True:
+            try:
+                pool.get_nowait().close()
+            except queue.Empty:
+                break
+    
+    # Recalcula user_stats desde cero a partir de transactions
+    USER_STATS_REBUILD_SQL = '''
+        INSERT OR REPLACE INTO user_stats
+            (user_id, authorized_count, authorized_total, rejected_count, last_transaction_at)
+        SELECT user_id,
+               SUM(status = 'autorizado'),
+               COALESCE(SUM(CASE WHEN status = 'autorizado' THEN amount END), 0),
+               SUM(status = 'rechazado'),
+               MAX(timestamp)
+        FROM transactions
+        WHERE user_id IS NOT NULL
+        GROUP BY user_id
+    '''
+    
+    # Migraciones del esquema en orden: (versión, descripción, pasos).
+    # Cada paso es una sentencia SQL o una función que recibe la conexión.
+    # Nunca se modifica una migración ya publicada: se agrega una nueva.
+    MIGRATIONS = [
+        (1, 'Índices para las consultas frecuentes de transacciones', [
+            # dashboard / history: WHERE user_id = ? ORDER BY timestamp DESC
+            '''CREATE INDEX IF NOT EXISTS idx_transactions_user_timestamp
+               ON transactions (user_id, timestamp DESC)''',
+            # estadísticas del dashboard: COUNT/SUM por usuario y estado (índice cubriente)
+            '''CREATE INDEX IF NOT EXISTS idx_transactions_user_status_amount
+               ON transactions (user_id, status, amount)''',
+            # regla de velocidad: WHERE card_id = ? AND status = ? AND timestamp > ?
+            '''CREATE INDEX IF NOT EXISTS idx_transactions_card_status_timestamp
+               ON transactions (card_id, status, timestamp)''',
+            # búsqueda de facturas por folio
+            '''CREATE INDEX IF NOT EXISTS idx_transactions_invoice_number
+               ON transactions (invoice_number)''',
+        ]),
+        (2, 'Índice para paginación por cursor (timestamp, id) del historial', [
+            '''CREATE INDEX IF NOT EXISTS idx_transactions_user_timestamp_id
+               ON transactions (user_id, timestamp DESC, id DESC)''',
+            # El índice nuevo cubre el mismo prefijo (user_id, timestamp DESC)
+            'DROP INDEX IF EXISTS idx_transactions_user_timestamp',
+        ]),
+        (3, 'Resumen por usuario mantenido en cada pago (user_stats)', [
+            '''CREATE TABLE IF NOT EXISTS user_stats (
+                   user_id INTEGER PRIMARY KEY,
+                   authorized_count INTEGER NOT NULL DEFAULT 0,
+                   authorized_total REAL NOT NULL DEFAULT 0,
+                   rejected_count INTEGER NOT NULL DEFAULT 0,
+                   last_transaction_at TIMESTAMP,
+                   FOREIGN KEY (user_id) REFERENCES users (id)
+               )''',
+            USER_STATS_REBUILD_SQL,
+            # El dashboard ya no agrega sobre transactions
+            'DROP INDEX IF EXISTS idx_transactions_user_status_amount',
+        ]),
+        (4, 'Contadores de velocidad por tarjeta en buckets de un minuto', [
+            '''CREATE TABLE IF NOT EXISTS card_velocity (
+                   card_id INTEGER NOT NULL,
+                   bucket INTEGER NOT NULL,
+                   count INTEGER NOT NULL,
+                   PRIMARY KEY (card_id, bucket)
+               ) WITHOUT ROWID''',
+            # Cargar las últimas 24 horas de autorizaciones (bucket = minutos desde epoch, UTC)
+            '''INSERT OR REPLACE INTO card_velocity (card_id, bucket, count)
+               SELECT card_id, CAST(strftime('%s', timestamp) AS INTEGER) / 60, COUNT(*)
+               FROM transactions
+               WHERE status = 'autorizado' AND card_id IS NOT NULL
+                 AND timestamp >= datetime('now', '-1 day')
+               GROUP BY 1, 2''',
+            # La regla de velocidad ya no consulta transactions
+            'DROP INDEX IF EXISTS idx_transactions_card_status_timestamp',
+        ]),
+        (5, 'Índices de búsqueda de tarjetas: FTS5 por titular y últimos 4 dígitos', [
+            # Índice de texto completo sin acentos sobre cards.cardholder_name,
+            # con índices de prefijo de 2 y 3 caracteres para el autocompletado
+            '''CREATE VIRTUAL TABLE IF NOT EXISTS cards_fts USING fts5(
+                   cardholder_name,
+                   content = 'cards',
+                   content_rowid = 'id',
+                   tokenize = 'unicode61 remove_diacritics 2',
+                   prefix = '2 3'
+               )''',
+            '''CREATE TRIGGER IF NOT EXISTS cards_fts_insert AFTER INSERT ON cards BEGIN
+                   INSERT INTO cards_fts (rowid, cardholder_name) VALUES (new.id, new.cardholder_name);
+               END''',
+            '''CREATE TRIGGER IF NOT EXISTS cards_fts_delete AFTER DELETE ON cards BEGIN
+                   INSERT INTO cards_fts (cards_fts, rowid, cardholder_name)
+                   VALUES ('delete', old.id, old.cardholder_name);
+               END''',
+            '''CREATE TRIGGER IF NOT EXISTS cards_fts_update AFTER UPDATE OF cardholder_name ON cards BEGIN
+                   INSERT INTO cards_fts (cards_fts, rowid, cardholder_name)
+                   VALUES ('delete', old.id, old.cardholder_name);
+                   INSERT INTO cards_fts (rowid, cardholder_name) VALUES (new.id, new.cardholder_name);
+               END''',
+            "INSERT INTO cards_fts (cards_fts) VALUES ('rebuild')",
+            # Últimos 4 dígitos; el BIN usa un rango sobre el índice UNIQUE de card_number
+            '''CREATE INDEX IF NOT EXISTS idx_cards_last4
+               ON cards (substr(card_number, -4))''',
+        ]),
+        (6, 'Bandeja de salida de emails con reintentos', [
+            '''CREATE TABLE IF NOT EXISTS email_outbox (
+                   id INTEGER PRIMARY KEY AUTOINCREMENT,
+                   user_id INTEGER,
+                   transaction_id INTEGER,
+                   to_email TEXT NOT NULL,
+                   subject TEXT NOT NULL,
+                   message BLOB NOT NULL,
+                   status TEXT NOT NULL DEFAULT 'pending',
+                   attempts INTEGER NOT NULL DEFAULT 0,
+                   next_attempt_at REAL NOT NULL,
+                   locked_at REAL,
+                   last_error TEXT,
+                   created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                   sent_at TIMESTAMP,
+                   FOREIGN KEY (user_id) REFERENCES users (id),
+                   FOREIGN KEY (transaction_id) REFERENCES transactions (id)
+               )''',
+            # Los workers buscan el siguiente mensaje vencido por estado y fecha
+            '''CREATE INDEX IF NOT EXISTS idx_email_outbox_status_next
+               ON email_outbox (status, next_attempt_at)''',
+        ]),
+        (7, 'Versión de fila en cards para el caché de tarjetas', [
+            'ALTER TABLE cards ADD COLUMN version INTEGER NOT NULL DEFAULT 0',
+            # PaymentRules incrementa version en sus propios UPDATE; cualquier
+            # otro UPDATE (scripts, consola) la incrementa aquí, así que una
+            # copia de la fila con la misma versión siempre tiene el mismo estado
+            '''CREATE TRIGGER IF NOT EXISTS cards_version_update AFTER UPDATE ON cards
+               WHEN NEW.version = OLD.version BEGIN
+                   UPDATE cards SET version = OLD.version + 1 WHERE id = NEW.id;
+               END''',
+        ]),
+        (8, 'Libro mayor de saldos (ledger_entries) con cards.balance como snapshot', [
+            '''CREATE TABLE IF NOT EXISTS ledger_entries (
+                   id INTEGER PRIMARY KEY AUTOINCREMENT,
+                   card_id INTEGER NOT NULL,
+                   kind TEXT NOT NULL,
+                   amount REAL NOT NULL,
+                   transaction_id INTEGER,
+                   created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                   FOREIGN KEY (card_id) REFERENCES cards (id),
+                   FOREIGN KEY (transaction_id) REFERENCES transactions (id)
+               )''',
+            # Saldo disponible: movimientos de una tarjeta posteriores a su snapshot
+            '''CREATE INDEX IF NOT EXISTS idx_ledger_entries_card_id
+               ON ledger_entries (card_id, id)''',
+            # Último movimiento incluido en cards.balance
+            'ALTER TABLE cards ADD COLUMN ledger_snapshot_id INTEGER NOT NULL DEFAULT 0',
+            # Apertura con el saldo actual; transaction_id marca la última
+            # transacción que ese saldo ya incluye (ver Ledger.reconcile)
+            '''INSERT INTO ledger_entries (card_id, kind, amount, transaction_id)
+               SELECT id, 'apertura', balance, (SELECT MAX(id) FROM transactions)
+               FROM cards ORDER BY id''',
+            '''UPDATE cards SET ledger_snapshot_id = (
+                   SELECT id FROM ledger_entries l WHERE l.card_id = cards.id AND l.kind = 'apertura'
+               )''',
+            # Las tarjetas nuevas abren el libro con su saldo inicial
+            '''CREATE TRIGGER IF NOT EXISTS cards_ledger_opening AFTER INSERT ON cards BEGIN
+                   INSERT INTO ledger_entries (card_id, kind, amount, transaction_id)
+                   VALUES (NEW.id, 'apertura', NEW.balance, (SELECT MAX(id) FROM transactions));
+                   UPDATE cards SET ledger_snapshot_id = last_insert_rowid() WHERE id = NEW.id;
+               END''',
+        ]),
+        (9, 'Folios de factura por series con contador (invoice_sequences) y sin duplicados', [
+            # Siguiente folio sin reservar de cada serie (ver InvoiceNumberAllocator)
+            '''CREATE TABLE IF NOT EXISTS invoice_sequences (
+                   series TEXT PRIMARY KEY,
+                   next_value INTEGER NOT NULL
+               )''',
+            # Los folios anteriores (F + fecha al segundo + usuario) se repetían
+            # con dos pagos del mismo usuario en el mismo segundo: se conserva
+            # el primero y los demás reciben el sufijo -R<id de la transacción>
+            '''UPDATE transactions SET invoice_number = invoice_number || '-R' || id
+               WHERE invoice_number IS NOT NULL
+                 AND id > (SELECT MIN(t.id) FROM transactions t
+                           WHERE t.invoice_number = transactions.invoice_number)''',
+            'DROP INDEX IF EXISTS idx_transactions_invoice_number',
+            '''CREATE UNIQUE INDEX IF NOT EXISTS idx_transactions_invoice_number
+               ON transactions (invoice_number)''',
+        ]),
+    ]
+    
+    CARD_COLUMNS = ('id', 'card_number', 'cardholder_name', 'expiry_date', 'cvv',
+                    'balance', 'is_verified', 'attempts_count', 'last_attempt', 'is_blocked',
+                    'version', 'ledger_snapshot_id')
+    
+    def get_card(self, conn, card_number):
+        """
+        Lee una tarjeta por número usando la conexión recibida
+        
+        balance es el snapshot del saldo (ver Ledger): el saldo disponible
+        también suma los movimientos posteriores a ledger_snapshot_id.
+        
+        Returns:
+            dict con las columnas de CARD_COLUMNS o None si no existe
+        """
+        cursor = conn.execute(
+            f'SELECT {", ".join(self.CARD_COLUMNS)} FROM cards WHERE card_number = ?',
+            (card_number,)
+        )
+        card = cursor.fetchone()
+        if not card:
+            return None
+        return dict(zip(self.CARD_COLUMNS, card))
+    
+    def migrate(self):
+        """
+        Aplica en orden las migraciones pendientes de MIGRATIONS
+        
+        Corre dentro de una transacción BEGIN IMMEDIATE, así que varios
+        workers que arrancan a la vez se serializan y solo uno aplica cada
+        versión. Si se aplicó alguna migración se ejecuta ANALYZE para que
+        el planificador conozca los índices nuevos.
+        
+        Returns:
+            list: Versiones aplicadas en esta llamada
+        """
+        applied = []
+        with self.transaction(immediate=True) as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INTEGER PRIMARY KEY,
+                    description TEXT NOT NULL,
+                    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            current = conn.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version').fetchone()[0]
+            
+            for version, description, steps in self.MIGRATIONS:
+                if version <= current:
+                    continue
+                for step in steps:
+                    if callable(step):
+                        step(conn)
+                    else:
+                        conn.execute(step)
+                conn.execute('INSERT INTO schema_version (version, description) VALUES (?, ?)',
+                             (version, description))
+                applied.append(version)
+            
+            if applied:
+                conn.execute('ANALYZE')
+        return applied
+    
+    def schema_version(self):
+        """Retorna la versión actual del esquema"""
+        with self.connection() as conn:
+            return conn.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version').fetchone()[0]
+    
+    def update_user_stats(self, conn, user_id, authorized, amount):
+        """
+        Suma una transacción al resumen del usuario
+        
+        Debe llamarse en la misma transacción que inserta en transactions
+        para que user_stats nunca diverja del historial.
+        """
+        conn.execute('''
+            INSERT INTO user_stats
+                (user_id, authorized_count, authorized_total, rejected_count, last_transaction_at)
+            VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT (user_id) DO UPDATE SET
+                authorized_count = authorized_count + excluded.authorized_count,
+                authorized_total = authorized_total + excluded.authorized_total,
+                rejected_count = rejected_count + excluded.rejected_count,
+                last_transaction_at = excluded.last_transaction_at
+        ''', (
+            user_id,
+            1 if authorized else 0,
+            float(amount) if authorized else 0.0,
+            0 if authorized else 1
+        ))
+    
+    def get_user_stats(self, conn, user_id):
+        """
+        Retorna el resumen del usuario
+        
+        Returns:
+            tuple: (autorizadas, monto autorizado, rechazadas, última transacción)
+        """
+        cursor = conn.execute('''
+            SELECT authorized_count, authorized_total, rejected_count, last_transaction_at
+            FROM user_stats WHERE user_id = ?
+        ''', (user_id,))
+        return cursor.fetchone() or (0, 0.0, 0, None)
+    
+    def rebuild_user_stats(self):
+        """
+        Recalcula user_stats a partir de todo el historial
+        
+        Útil después de cargar transacciones fuera de la aplicación
+        (p. ej. insert_test_data.py).
+        
+        Returns:
+            int: Número de usuarios con resumen
+        """
+        with self.transaction(immediate=True) as conn:
+            conn.execute('DELETE FROM user_stats')
+            conn.execute(self.USER_STATS_REBUILD_SQL)
+            return conn.execute('SELECT COUNT(*) FROM user_stats').fetchone()[0]
+    
+    @staticmethod
+    def explain_query_plan(conn, sql, params=()):
+        """Retorna las líneas de EXPLAIN QUERY PLAN de una consulta"""
+        cursor = conn.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+        return [row[3] for row in cursor.fetchall()]
+    
+    # balance: saldo disponible (snapshot + movimientos pendientes del libro)
+    CARD_SEARCH_COLUMNS = '''c.card_number, c.cardholder_name, c.expiry_date,
+        c.balance + COALESCE((SELECT SUM(l.amount) FROM ledger_entries l
+                              WHERE l.card_id = c.id AND l.id > c.ledger_snapshot_id), 0),
+        c.is_verified, c.is_blocked'''
+    
+    def search_cards(self, conn, query, limit=10):
+        """
+        Busca tarjetas para el autocompletado usando solo búsquedas indexadas
+        
+        - Texto: prefijo de cada palabra del titular en cards_fts, sin
+          distinguir acentos ni mayúsculas ("jua per" encuentra "Juan Pérez")
+        - 4 dígitos: coincidencia con los últimos 4 dígitos o con el inicio
+        - Otros dígitos: prefijo del número (BIN) por rango sobre el índice UNIQUE
+        
+        Returns:
+            list: Filas (card_number, cardholder_name, expiry_date, balance,
+                  is_verified, is_blocked)
+        """
+        query = query.strip()
+        digits = query.replace(' ', '').replace('-', '')
+        
+        if not query:
+            cursor = conn.execute(
+                f'SELECT {self.CARD_SEARCH_COLUMNS} FROM cards c ORDER BY c.id LIMIT ?', (limit,)
             )
-        ''')
+        elif digits.isdigit():
+            # ':' es el carácter siguiente a '9', así el rango cubre todo el prefijo
+            prefix_sql = f'''
+                SELECT {self.CARD_SEARCH_COLUMNS} FROM cards c
+                WHERE c.card_number >= ? AND c.card_number < ?
+            '''
+            params = [digits, digits + ':']
+            if len(digits) == 4:
+                prefix_sql = f'''
+                    SELECT {self.CARD_SEARCH_COLUMNS} FROM cards c
+                    WHERE substr(c.card_number, -4) = ?
+                    UNION
+                ''' + prefix_sql
+                params.insert(0, digits)
+            cursor = conn.execute(prefix_sql + ' LIMIT ?', params + [limit])
+        else:
+            terms = [re.sub(r'[^\w]', '', word) for word in query.split()]
+            match = ' '.join(f'"{term}"*' for term in terms if term)
+            if not match:
+                return []
+            cursor = conn.execute(f'''
+                SELECT {self.CARD_SEARCH_COLUMNS}
+                FROM cards_fts f
+                JOIN cards c ON c.id = f.rowid
+                WHERE cards_fts MATCH ?
+                ORDER BY f.rank
+                LIMIT ?
+            ''', (match, limit))
+        
+        return cursor.fetchall()
+    
+    def init_db(self):
+        with self.transaction(immediate=True) as conn:
+            cursor = conn.cursor()
+        
+            # Tabla de usuarios
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS users (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    username TEXT UNIQUE NOT NULL,
+                    email TEXT UNIQUE NOT NULL,
+                    password_hash TEXT NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
         
-        conn.commit()
-        conn.close()
+            # Tabla de tarjetas
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS cards (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    card_number TEXT UNIQUE NOT NULL,
+                    cardholder_name TEXT NOT NULL,
+                    expiry_date TEXT NOT NULL,
+                    cvv TEXT NOT NULL,
+                    balance REAL NOT NULL DEFAULT 0.0,
+                    is_verified BOOLEAN DEFAULT TRUE,
+                    attempts_count INTEGER DEFAULT 0,
+                    last_attempt TIMESTAMP,
+                    is_blocked BOOLEAN DEFAULT FALSE,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+        
+            # Tabla de transacciones
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS transactions (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    amount REAL NOT NULL,
+                    status TEXT NOT NULL,
+                    rejection_reason TEXT,
+                    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    card_id INTEGER,
+                    user_id INTEGER,
+                    rfc TEXT,
+                    full_name TEXT,
+                    invoice_number TEXT,
+                    FOREIGN KEY (card_id) REFERENCES cards (id),
+                    FOREIGN KEY (user_id) REFERENCES users (id)
+                )
+            ''')
+        
+        # Aplicar migraciones pendientes (índices, tablas nuevas)
+        self.migrate()
         
         # Insertar tarjetas de prueba
         self.insert_test_cards()
     
     def insert_test_cards(self):
-        conn = sqlite3.connect(self.db_path)
+        with self.transaction(immediate=True) as conn:
+            self._insert_test_cards(conn)
+    
+    def _insert_test_cards(self, conn):
         cursor = conn.cursor()
         
         # Verificar si ya existen tarjetas
         cursor.execute('SELECT COUNT(*) FROM cards')
         if cursor.fetchone()[0] > 0:
-            conn.close()
             return
         
         # Tarjetas de prueba (números válidos usando algoritmo de Luhn)
@@ -193,9 +750,6 @@ class Database:
                 card['attempts_count'],
                 card['is_blocked']
             ))
-        
-        conn.commit()
-        conn.close()
 
 class Validator:
     @staticmethod
@@ -290,67 +844,207 @@ class Validator:
         return bool(re.match(name_pattern, name)) and len(name) >= 3
 
 class PaymentRules:
-    def __init__(self, db):
+    def __init__(self, db, config=None, velocity=None, card_cache=None, ledger=None):
+        """
+        Args:
+            db: Database
+            config: Límites de las reglas (por defecto load_rule_config())
+            velocity: VelocityLimiter (por defecto con los límites de config)
+            card_cache: CardCache compartido entre workers (opcional, ver load_card)
+            ledger: Ledger de saldos (por defecto Ledger())
+        """
         self.db = db
+        self.card_cache = card_cache
+        self.ledger = ledger or Ledger()
         self.validator = Validator()
+        self.config = config or load_rule_config()
+        self.velocity = velocity or VelocityLimiter(self.config['velocity'])
+        self.engine = RuleEngine()
+        self._register_rules()
     
-    def check_authorization(self, card_number, expiry_date, cvv, amount, rfc=""):
-        """Aplica todas las reglas de autorización"""
-        # Buscar tarjeta en la base de datos
-        conn = sqlite3.connect(self.db.db_path)
-        cursor = conn.cursor()
+    def _register_rules(self):
+        """Registra las reglas de autorización en el motor con su clase de costo"""
+        register = self.engine.register
+        register('tarjeta_verificada', lambda ctx: self._check_card_verified(ctx['card']),
+                 COST_MEMORY, 'Regla 1: Tarjeta verificada')
+        register('fecha_expiracion', lambda ctx: self._check_expiry_date(ctx['expiry_date']),
+                 COST_MEMORY, 'Regla 2: Fecha de expiración válida')
+        register('cvv', lambda ctx: self._check_cvv(ctx['cvv'], ctx['card']),
+                 COST_MEMORY, 'Regla 3: CVV correcto')
+        register('intentos', lambda ctx: self._check_attempts(ctx['card']),
+                 COST_MEMORY, 'Regla 4: Intentos no excedidos')
+        register('fondos', lambda ctx: self._check_balance(ctx['conn'], ctx['card'], ctx['amount']),
+                 COST_DATABASE, 'Regla 5: Fondos suficientes')
+        register('limite_transaccion', lambda ctx: self._check_transaction_limit(ctx['amount']),
+                 COST_MEMORY, 'Regla 6: Límite de transacción')
+        register('velocidad', lambda ctx: self._check_velocity(ctx['conn'], ctx['card']),
+                 COST_DATABASE, 'Regla 7: Verificación de velocidad')
+    
+    def load_card(self, conn, card_number):
+        """
+        Lee la tarjeta a autorizar, del caché compartido si está disponible
         
-        cursor.execute('SELECT * FROM cards WHERE card_number = ?', (card_number,))
-        card = cursor.fetchone()
+        La copia del caché puede estar desactualizada: process_payment y
+        check_authorization solo escriben sobre la tarjeta si su versión
+        sigue siendo la misma y, si no, la vuelven a leer de conn. Al
+        confirmarse la transacción el caché recibe el estado final.
         
-        if not card:
-            conn.close()
-            return {
-                'authorized': False,
-                'reason': 'Tarjeta no verificada o no existe en el sistema'
-            }
+        Returns:
+            dict de la tarjeta (ver Database.get_card) o None si no existe
+        """
+        card = self.card_cache.get(card_number) if self.card_cache else None
+        if card is None:
+            card = self.db.get_card(conn, card_number)
+        if card is not None and self.card_cache:
+            conn.after_commit(lambda: self.card_cache.put(card))
+        return card
+    
+    def _reload_card(self, conn, card):
+        """Reemplaza en sitio una tarjeta cuya versión ya no coincide con la base de datos"""
+        if self.card_cache:
+            self.card_cache.mark_stale(card['card_number'])
+        current = self.db.get_card(conn, card['card_number'])
+        if current is None:
+            raise sqlite3.IntegrityError(f"La tarjeta {card['id']} ya no existe")
+        card.update(current)
+    
+    def check_authorization(self, conn, card, expiry_date, cvv, amount):
+        """
+        Aplica todas las reglas de autorización a una tarjeta ya leída
         
-        card_dict = {
-            'id': card[0],
-            'card_number': card[1],
-            'cardholder_name': card[2],
-            'expiry_date': card[3],
-            'cvv': card[4],
-            'balance': card[5],
-            'is_verified': card[6],
-            'attempts_count': card[7],
-            'last_attempt': card[8],
-            'is_blocked': card[9]
+        Debe llamarse dentro de una transacción abierta en conn; si alguna
+        regla rechaza, el incremento de intentos fallidos se escribe en la
+        misma transacción. Si la tarjeta cambió desde que se leyó (otra
+        versión, p. ej. una copia vieja del caché) se lee de nuevo y se
+        vuelven a aplicar las reglas.
+        
+        Args:
+            conn: Conexión con la transacción en curso
+            card: dict de la tarjeta (ver Database.get_card)
+        """
+        while True:
+            result = self.engine.evaluate({
+                'conn': conn,
+                'card': card,
+                'expiry_date': expiry_date,
+                'cvv': cvv,
+                'amount': amount
+            })
+            
+            if result['authorized'] or self._register_failed_attempt(conn, card):
+                return result
+            self._reload_card(conn, card)
+    
+    def process_payment(self, conn, card, user_id, full_name, rfc, expiry_date, cvv, amount,
+                        invoice_number):
+        """
+        Autoriza y registra un pago dentro de la transacción abierta en conn
+        
+        El cargo se agrega al libro de saldos (ver Ledger) sin reescribir la
+        fila de la tarjeta. Antes se confirma que la tarjeta sigue en la
+        versión que se evaluó (card['version']), de modo que una copia vieja
+        del caché no puede autorizar: si la versión cambió, la tarjeta se
+        vuelve a leer y se evalúan de nuevo las reglas. SQLite serializa las
+        transacciones, así que el saldo que leyó la regla de fondos no puede
+        cambiar antes de que se escriba el cargo. El dict card se actualiza
+        en sitio para reflejar el nuevo estado.
+        
+        Args:
+            conn: Conexión con una transacción BEGIN IMMEDIATE en curso
+            card: dict de la tarjeta o None para tarjetas virtuales
+            invoice_number: Número de factura a usar si se autoriza
+        
+        Returns:
+            dict: {'authorized', 'reason', 'rule', 'transaction_id', 'invoice_number'}
+        """
+        amount = float(amount)
+        
+        if card:
+            while True:
+                # Verificar reglas de autorización
+                result = self.check_authorization(conn, card, expiry_date, cvv, amount)
+                if not result['authorized']:
+                    break
+                if self._confirm_card(conn, card):
+                    self.velocity.record(conn, card['id'])
+                    break
+                # La tarjeta cambió desde la lectura: evaluar de nuevo con la fila
+                # actual, que ya no puede cambiar dentro de esta transacción
+                self._reload_card(conn, card)
+        else:
+            # Para tarjetas nuevas/inventadas, autorizar automáticamente
+            result = {'authorized': True, 'reason': None}
+        
+        card_id = card['id'] if card else None
+        
+        if result['authorized']:
+            cursor = conn.execute('''
+                INSERT INTO transactions (amount, status, card_id, user_id, rfc, full_name, invoice_number)
+                VALUES (?, 'autorizado', ?, ?, ?, ?, ?)
+            ''', (amount, card_id, user_id, rfc, full_name, invoice_number))
+            if card:
+                self.ledger.record(conn, card_id, 'cargo', -amount, cursor.lastrowid)
+        else:
+            invoice_number = None
+            cursor = conn.execute('''
+                INSERT INTO transactions (amount, status, rejection_reason, card_id, user_id, rfc, full_name)
+                VALUES (?, 'rechazado', ?, ?, ?, ?, ?)
+            ''', (amount, result['reason'], card_id, user_id, rfc, full_name))
+        transaction_id = cursor.lastrowid
+        
+        self.db.update_user_stats(conn, user_id, result['authorized'], amount)
+        
+        return {
+            'authorized': result['authorized'],
+            'reason': result.get('reason'),
+            'rule': result.get('rule'),
+            'transaction_id': transaction_id,
+            'invoice_number': invoice_number
         }
+    
+    def _confirm_card(self, conn, card):
+        """
+        Confirma que card sigue en su versión y reinicia los intentos fallidos
         
-        # Aplicar reglas de autorización
-        rules = [
-            (self._check_card_verified, card_dict),
-            (self._check_expiry_date, expiry_date),
-            (self._check_cvv, cvv, card_dict),
-            (self._check_attempts, card_dict),
-            (self._check_balance, card_dict, amount),
-            (self._check_transaction_limit, amount),
-            (self._check_velocity, card_dict)
-        ]
+        Solo escribe en la fila si había intentos fallidos; si no, basta con
+        leer su versión por llave primaria.
         
-        for rule in rules:
-            result = rule[0](*rule[1:])
-            if not result['authorized']:
-                # Incrementar intentos fallidos
-                cursor.execute('''
-                    UPDATE cards 
-                    SET attempts_count = attempts_count + 1, 
-                        last_attempt = CURRENT_TIMESTAMP
-                    WHERE id = ?
-                ''', (card_dict['id'],))
-                conn.commit()
-                conn.close()
-                return result
+        Returns:
+            bool: False si la versión de card ya no es la de la base de datos
+        """
+        if not card['attempts_count']:
+            return conn.execute(
+                'SELECT 1 FROM cards WHERE id = ? AND version = ?', (card['id'], card['version'])
+            ).fetchone() is not None
+        rows = conn.execute('''
+            UPDATE cards SET attempts_count = 0, version = version + 1
+            WHERE id = ? AND version = ?
+            RETURNING attempts_count, version
+        ''', (card['id'], card['version'])).fetchall()
+        if not rows:
+            return False
+        card['attempts_count'], card['version'] = rows[0]
+        return True
+    
+    def _register_failed_attempt(self, conn, card):
+        """
+        Incrementa los intentos fallidos de la tarjeta
         
-        # Si pasa todas las reglas, autorizar
-        conn.close()
-        return {'authorized': True, 'reason': None}
+        Returns:
+            bool: False si la versión de card ya no es la de la base de datos
+        """
+        rows = conn.execute('''
+            UPDATE cards 
+            SET attempts_count = attempts_count + 1, 
+                last_attempt = CURRENT_TIMESTAMP,
+                version = version + 1
+            WHERE id = ? AND version = ?
+            RETURNING attempts_count, last_attempt, version
+        ''', (card['id'], card['version'])).fetchall()
+        if not rows:
+            return False
+        card['attempts_count'], card['last_attempt'], card['version'] = rows[0]
+        return True
     
     def _check_card_verified(self, card):
         """Regla 1: Tarjeta verificada"""
@@ -381,48 +1075,35 @@ class PaymentRules:
     
     def _check_attempts(self, card):
         """Regla 4: Intentos no excedidos"""
-        if card['attempts_count'] >= 3:
+        if card['attempts_count'] >= self.config['max_attempts']:
             return {
                 'authorized': False,
                 'reason': 'Límite de intentos excedido. Tarjeta bloqueada temporalmente'
             }
         return {'authorized': True}
     
-    def _check_balance(self, card, amount):
-        """Regla 5: Fondos suficientes"""
-        if card['balance'] < float(amount):
+    def _check_balance(self, conn, card, amount):
+        """Regla 5: Fondos suficientes (snapshot + movimientos pendientes del libro)"""
+        available = self.ledger.available(conn, card)
+        if available < float(amount):
             return {
                 'authorized': False,
-                'reason': f'Fondos insuficientes. Balance disponible: ${card["balance"]:.2f}'
+                'reason': f'Fondos insuficientes. Balance disponible: ${available:.2f}'
             }
         return {'authorized': True}
     
     def _check_transaction_limit(self, amount):
         """Regla 6: Límite de transacción"""
-        if float(amount) > 10000:
+        limit = self.config['max_transaction_amount']
+        if float(amount) > limit:
+            # 10000 o 10000.0 (JSON) se muestran igual: $10,000
+            shown = f'{limit:,.0f}' if float(limit).is_integer() else f'{limit:,.2f}'
             return {
                 'authorized': False,
-                'reason': 'Monto excede el límite máximo de transacción ($10,000)'
+                'reason': f'Monto excede el límite máximo de transacción (${shown})'
             }
         return {'authorized': True}
     
-    def _check_velocity(self, card):
-        """Regla 7: Verificación de velocidad (máximo 5 transacciones por hora)"""
-        conn = sqlite3.connect(self.db.db_path)
-        cursor = conn.cursor()
-        
-        one_hour_ago = datetime.now() - timedelta(hours=1)
-        cursor.execute('''
-            SELECT COUNT(*) FROM transactions 
-            WHERE card_id = ? AND timestamp > ? AND status = 'autorizado'
-        ''', (card['id'], one_hour_ago.isoformat()))
-        
-        transaction_count = cursor.fetchone()[0]
-        conn.close()
-        
-        if transaction_count >= 5:
-            return {
-                'authorized': False,
-                'reason': 'Límite de transacciones por hora excedido (máximo 5)'
-            }
-        return {'authorized': True}
\ No newline at end of file
+    def _check_velocity(self, conn, card):
+        """Regla 7: Verificación de velocidad (por defecto máximo 5 transacciones por hora)"""
+        return self.velocity.check(conn, card['id'])
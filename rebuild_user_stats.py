@@ -0,0 +1,22 @@
+#!/usr/bin/env python3
+"""
+Script para recalcular el resumen por usuario (user_stats)
+Úsalo después de insertar transacciones fuera de la aplicación
+"""
+
+import sys
+
+from models import Database
+
+DB_PATH = 'database/payments.db'
+
+
+def rebuild_user_stats(db_path=DB_PATH):
+    """Recalcula user_stats desde el historial completo de transacciones"""
+    db = Database(db_path)
+    users = db.rebuild_user_stats()
+    print(f"✅ Resumen recalculado para {users} usuario(s)")
+
+
+if __name__ == '__main__':
+    rebuild_user_stats(sys.argv[1] if len(sys.argv) > 1 else DB_PATH)
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+"""
+Script de conciliación del libro de saldos
+Verifica que cada snapshot (cards.balance) sea la suma de sus movimientos y
+que cada pago autorizado tenga exactamente un cargo en ledger_entries.
+Sale con código 1 si encuentra diferencias
+"""
+
+import sys
+
+from ledger import Ledger
+from models import Database
+
+DB_PATH = 'database/payments.db'
+
+
+def reconcile_ledger(db_path=DB_PATH):
+    """Concilia el libro de saldos. Retorna True si no hay diferencias"""
+    db = Database(db_path)
+
+    print("=" * 60)
+    print("CONCILIACIÓN DEL LIBRO DE SALDOS")
+    print("=" * 60)
+
+    with db.connection() as conn:
+        cards, entries, pending = conn.execute('''
+            SELECT (SELECT COUNT(*) FROM cards),
+                   (SELECT COUNT(*) FROM ledger_entries),
+                   (SELECT COUNT(*) FROM cards c JOIN ledger_entries l
+                    ON l.card_id = c.id AND l.id > c.ledger_snapshot_id)
+        ''').fetchone()
+        print(f"\n💳 Tarjetas: {cards}")
+        print(f"📒 Movimientos: {entries} ({pending} pendientes de compactar)")
+
+        problems = Ledger().reconcile(conn)
+
+    if problems:
+        print(f"\n❌ {len(problems)} diferencia(s):")
+        for card_id, problem in problems:
+            print(f"   - Tarjeta {card_id}: {problem}")
+    else:
+        print("\n✅ Snapshots, movimientos y transacciones coinciden")
+    print("=" * 60 + "\n")
+
+    return not problems
+
+
+if __name__ == '__main__':
+    db_path = sys.argv[1] if len(sys.argv) > 1 else DB_PATH
+    sys.exit(0 if reconcile_ledger(db_path) else 1)
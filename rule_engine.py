@@ -0,0 +1,174 @@
+import bisect
+import json
+import os
+import threading
+import time
+
+
+# Clases de costo: las reglas se evalúan de la más barata a la más cara
+COST_MEMORY = 0      # Solo usan datos ya cargados en memoria
+COST_DATABASE = 1    # Consultan la base de datos
+
+# Límites por defecto de las reglas de autorización
+DEFAULT_RULE_CONFIG = {
+    'max_attempts': 3,
+    'max_transaction_amount': 10000,
+    # ventana -> máximo de transacciones autorizadas (None = sin límite)
+    'velocity': {
+        'minute': None,
+        'hour': 5,
+        'day': None,
+    },
+}
+
+
+def load_rule_config(path=None):
+    """
+    Carga los límites de las reglas de autorización
+
+    Parte de DEFAULT_RULE_CONFIG y aplica encima el archivo JSON indicado
+    (o el de la variable de entorno RULES_CONFIG). Los límites de velocidad
+    también pueden ajustarse con VELOCITY_LIMIT_PER_MINUTE/HOUR/DAY.
+
+    Returns:
+        dict: Configuración completa
+    """
+    config = json.loads(json.dumps(DEFAULT_RULE_CONFIG))
+
+    path = path or os.environ.get('RULES_CONFIG')
+    if path:
+        with open(path, encoding='utf-8') as f:
+            overrides = json.load(f)
+        velocity = overrides.pop('velocity', {})
+        config.update(overrides)
+        config['velocity'].update(velocity)
+
+    for window in config['velocity']:
+        value = os.environ.get(f'VELOCITY_LIMIT_PER_{window.upper()}')
+        if value is not None:
+            config['velocity'][window] = int(value) if value.strip() else None
+
+    return config
+
+
+class Rule:
+    """Regla de autorización registrada en el motor"""
+
+    def __init__(self, name, check, cost, description=''):
+        """
+        Args:
+            name: Identificador de la regla (se usa en las métricas)
+            check: Función que recibe el contexto y retorna {'authorized', 'reason'}
+            cost: Clase de costo (COST_MEMORY, COST_DATABASE)
+            description: Descripción legible
+        """
+        self.name = name
+        self.check = check
+        self.cost = cost
+        self.description = description
+
+
+class RuleStats:
+    """Contadores y histograma de latencia de una regla"""
+
+    # Límites superiores de los buckets del histograma, en segundos
+    LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+                       0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1)
+
+    def __init__(self):
+        self.invocations = 0
+        self.rejections = 0
+        self.total_seconds = 0.0
+        # Un bucket por límite más uno para valores mayores (+Inf)
+        self.buckets = [0] * (len(self.LATENCY_BUCKETS) + 1)
+
+    def observe(self, seconds, rejected):
+        self.invocations += 1
+        if rejected:
+            self.rejections += 1
+        self.total_seconds += seconds
+        self.buckets[bisect.bisect_left(self.LATENCY_BUCKETS, seconds)] += 1
+
+    def to_dict(self):
+        histogram = {}
+        cumulative = 0
+        for bound, count in zip(self.LATENCY_BUCKETS + ('+Inf',), self.buckets):
+            cumulative += count
+            histogram[str(bound)] = cumulative
+        return {
+            'invocations': self.invocations,
+            'rejections': self.rejections,
+            'total_seconds': self.total_seconds,
+            'avg_seconds': self.total_seconds / self.invocations if self.invocations else 0.0,
+            'latency_histogram': histogram,
+        }
+
+
+class RuleEngine:
+    """
+    Motor de reglas de autorización
+
+    Las reglas se evalúan en orden de costo (y, dentro de la misma clase,
+    en orden de registro) y la evaluación se detiene en el primer rechazo,
+    así que las consultas a la base de datos solo se hacen cuando todas las
+    reglas en memoria ya pasaron. Cada regla lleva sus propias métricas de
+    invocaciones, rechazos y latencia.
+    """
+
+    def __init__(self):
+        self._rules = []
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def register(self, name, check, cost=COST_MEMORY, description=''):
+        """Registra una regla. Los nombres deben ser únicos"""
+        if name in self._stats:
+            raise ValueError(f'La regla {name} ya está registrada')
+
+        self._rules.append(Rule(name, check, cost, description))
+        # sort es estable: dentro de la misma clase se respeta el orden de registro
+        self._rules.sort(key=lambda rule: rule.cost)
+        self._stats[name] = RuleStats()
+
+    @property
+    def rules(self):
+        """Reglas en el orden en que se evalúan"""
+        return list(self._rules)
+
+    def evaluate(self, context):
+        """
+        Evalúa las reglas sobre el contexto hasta el primer rechazo
+
+        Args:
+            context: dict con los datos que necesitan las reglas
+
+        Returns:
+            dict: {'authorized': bool, 'reason': str|None, 'rule': str|None}
+        """
+        for rule in self._rules:
+            start = time.perf_counter()
+            result = rule.check(context)
+            elapsed = time.perf_counter() - start
+
+            rejected = not result['authorized']
+            with self._lock:
+                self._stats[rule.name].observe(elapsed, rejected)
+
+            if rejected:
+                return {'authorized': False, 'reason': result.get('reason'), 'rule': rule.name}
+
+        return {'authorized': True, 'reason': None, 'rule': None}
+
+    def stats(self):
+        """Métricas por regla en orden de evaluación"""
+        with self._lock:
+            return [
+                dict(name=rule.name, cost=rule.cost, description=rule.description,
+                     **self._stats[rule.name].to_dict())
+                for rule in self._rules
+            ]
+
+    def reset_stats(self):
+        with self._lock:
+            for name in self._stats:
+                self._stats[name] = RuleStats()
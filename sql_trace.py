@@ -0,0 +1,258 @@
+import collections
+import json
+import logging
+import logging.handlers
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from flask import has_request_context, request
+
+
+# Sentencias a las que se les puede pedir EXPLAIN QUERY PLAN
+EXPLAINABLE = re.compile(r'^\s*(SELECT|INSERT|UPDATE|DELETE|WITH|REPLACE)\b', re.IGNORECASE)
+# Literales en el SQL expandido de set_trace_callback (nunca se escriben valores al log)
+LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+
+def normalize_sql(sql):
+    """SQL en una línea con las listas IN (?, ?, ...) colapsadas: llave de agregación"""
+    sql = ' '.join(sql.split())
+    return re.sub(r'\(\?(?:\s*,\s*\?)+\)', '(?, ...)', sql)
+
+
+def parameter_shape(parameters):
+    """Tipos de los parámetros sin sus valores, p. ej. (int, str, float)"""
+    if parameters is None:
+        return None
+    if isinstance(parameters, dict):
+        return {name: type(value).__name__ for name, value in parameters.items()}
+    return [type(value).__name__ for value in parameters]
+
+
+class StatementStats:
+    """Tiempo acumulado de una sentencia normalizada"""
+
+    __slots__ = ('sql', 'executions', 'total_seconds', 'max_seconds', 'slow', 'routes')
+
+    def __init__(self, sql):
+        self.sql = sql
+        self.executions = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.slow = 0
+        self.routes = collections.Counter()
+
+
+class SQLTracer:
+    """
+    Rastreo opcional de consultas lentas sobre Database (SQL_TRACE=1)
+
+    Se registra como observador de las conexiones del pool (ver
+    TimedConnection): cada execute, fetch y commit suma su tiempo a la
+    sentencia normalizada y, si la llamada supera threshold_ms, se escribe
+    una línea JSON con el SQL, la forma de los parámetros (solo tipos, nunca
+    valores: hay números de tarjeta y CVV), la ruta que la ejecutó, su
+    EXPLAIN QUERY PLAN y lo que SQLite ejecutó durante la llamada según
+    set_trace_callback (triggers, BEGIN implícitos) con los literales
+    ocultos. Cada report_interval segundos se escribe el top-N de sentencias
+    por tiempo total.
+
+    El plan se pide la primera vez que se ve cada sentencia, con los
+    parámetros de esa ejecución, y solo se conserva el plan: los valores
+    nunca se guardan en memoria.
+
+    Los archivos rotan por tamaño y llevan el pid en el nombre: la rotación
+    de logging no es segura entre procesos.
+    """
+
+    def __init__(self, db, trace_dir=None, threshold_ms=None, top_n=None, report_interval=None,
+                 max_bytes=None, backup_count=5):
+        """
+        Args:
+            db: Database a rastrear
+            trace_dir: Directorio de los archivos (SQL_TRACE_DIR, database/sql_trace)
+            threshold_ms: Umbral de consulta lenta (SQL_SLOW_MS, por defecto 50)
+            top_n: Sentencias en cada reporte (SQL_TRACE_TOP, por defecto 20)
+            report_interval: Segundos entre reportes (SQL_TRACE_REPORT_INTERVAL, 300)
+            max_bytes: Tamaño antes de rotar (SQL_TRACE_MAX_MB, por defecto 10)
+        """
+        self.db = db
+        self.trace_dir = trace_dir or os.environ.get('SQL_TRACE_DIR', 'database/sql_trace')
+        self.threshold = (threshold_ms or float(os.environ.get('SQL_SLOW_MS', 50))) / 1000
+        self.top_n = top_n or int(os.environ.get('SQL_TRACE_TOP', 20))
+        self.report_interval = report_interval or float(os.environ.get('SQL_TRACE_REPORT_INTERVAL', 300))
+        self.max_bytes = max_bytes or int(os.environ.get('SQL_TRACE_MAX_MB', 10)) * 1024 * 1024
+        self.backup_count = backup_count
+
+        self._stats = {}
+        self._plans = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._explain_conn = None
+        self._explain_lock = threading.Lock()
+        self._loggers_pid = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._dirty = False
+
+    def install(self):
+        """Empieza a rastrear las conexiones del pool"""
+        self.db.connection_hooks.append(self._attach)
+        self.db.statement_observers.append(self.observe)
+        # Las conexiones ya abiertas no tienen el trace callback: se reabren
+        self.db.close_all()
+        return self
+
+    def _attach(self, conn):
+        conn.set_trace_callback(self._traced)
+
+    def _traced(self, statement):
+        executed = getattr(self._local, 'executed', None)
+        if executed is None:
+            executed = self._local.executed = collections.deque(maxlen=20)
+        executed.append(statement)
+
+    def _ensure_started(self):
+        """Abre los archivos y arranca el hilo de reportes en este proceso (también tras un fork)"""
+        pid = os.getpid()
+        if self._loggers_pid == pid:
+            return
+        with self._lock:
+            if self._loggers_pid == pid:
+                return
+            os.makedirs(self.trace_dir, exist_ok=True)
+            self.slow_log = self._logger('slow', pid)
+            self.report_log = self._logger('top', pid)
+            self._explain_conn = None
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='sql-trace-report', daemon=True)
+            self._thread.start()
+            self._loggers_pid = pid
+
+    def _logger(self, kind, pid):
+        logger = logging.getLogger(f'mu.sql_trace.{kind}.{pid}')
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+        if not logger.handlers:
+            handler = logging.handlers.RotatingFileHandler(
+                os.path.join(self.trace_dir, f'{kind}-{pid}.log'),
+                maxBytes=self.max_bytes, backupCount=self.backup_count, encoding='utf-8')
+            logger.addHandler(handler)
+        return logger
+
+    def _route(self):
+        if has_request_context():
+            return f'{request.method} {request.endpoint}'
+        return threading.current_thread().name
+
+    def observe(self, seconds, statements, sql, parameters):
+        """Observador de Database (ver TimedConnection)"""
+        executed = getattr(self._local, 'executed', None)
+        if not sql:
+            return
+        self._ensure_started()
+
+        key = normalize_sql(sql)
+        route = self._route()
+        slow = seconds >= self.threshold
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                stats = self._stats[key] = StatementStats(key)
+            stats.executions += statements
+            stats.total_seconds += seconds
+            stats.max_seconds = max(stats.max_seconds, seconds)
+            stats.routes[route] += 1
+            if slow:
+                stats.slow += 1
+            self._dirty = True
+
+        if parameters is not None and key not in self._plans:
+            self.plan(key, sql, parameters)
+
+        if slow:
+            self.slow_log.info(json.dumps({
+                'ts': time.strftime('%Y-%m-%d %H:%M:%S'),
+                'pid': os.getpid(),
+                'route': route,
+                'ms': round(seconds * 1000, 3),
+                'phase': 'execute' if statements else 'fetch',
+                'sql': key,
+                'params': parameter_shape(parameters),
+                'plan': self._plans.get(key),
+                'executed': [LITERALS.sub('?', statement) for statement in executed or ()],
+            }, ensure_ascii=False))
+        if executed:
+            executed.clear()
+
+    def plan(self, key, sql, parameters):
+        """EXPLAIN QUERY PLAN de la sentencia (una vez por sentencia normalizada)"""
+        if key in self._plans:
+            return self._plans[key]
+        if not EXPLAINABLE.match(sql):
+            self._plans[key] = None
+            return None
+
+        with self._explain_lock:
+            try:
+                # Conexión propia y sin observadores: el plan no se rastrea a sí mismo
+                if self._explain_conn is None:
+                    self._explain_conn = sqlite3.connect(self.db.db_path, check_same_thread=False)
+                plan = [row[3] for row in self._explain_conn.execute(f'EXPLAIN QUERY PLAN {sql}', parameters)]
+            except sqlite3.Error as e:
+                plan = [f'error: {e}']
+        self._plans[key] = plan
+        return plan
+
+    def top(self, n=None):
+        """Sentencias con más tiempo total, con su plan"""
+        with self._lock:
+            stats = sorted(self._stats.values(), key=lambda s: s.total_seconds, reverse=True)[:n or self.top_n]
+            return [{
+                'sql': s.sql,
+                'executions': s.executions,
+                'total_ms': s.total_seconds * 1000,
+                'avg_ms': s.total_seconds * 1000 / s.executions if s.executions else 0.0,
+                'max_ms': s.max_seconds * 1000,
+                'slow': s.slow,
+                'routes': dict(s.routes.most_common(3)),
+                'plan': self._plans.get(s.sql),
+            } for s in stats]
+
+    def report(self):
+        """Top-N de sentencias por tiempo total en texto"""
+        lines = [f"=== SQL top {self.top_n} por tiempo total - pid {os.getpid()} - "
+                 f"{time.strftime('%Y-%m-%d %H:%M:%S')} ==="]
+        lines.append(f"{'#':>3} {'total ms':>11} {'ejec.':>8} {'prom. ms':>9} {'máx. ms':>9} {'lentas':>7}  sql")
+        for rank, s in enumerate(self.top(), start=1):
+            lines.append(f"{rank:>3} {s['total_ms']:>11.1f} {s['executions']:>8} {s['avg_ms']:>9.3f} "
+                         f"{s['max_ms']:>9.2f} {s['slow']:>7}  {s['sql'][:200]}")
+            routes = ', '.join(f'{route} ({count})' for route, count in s['routes'].items())
+            lines.append(f"{'':>52}rutas: {routes}")
+            if s['plan']:
+                lines.append(f"{'':>52}plan: {' | '.join(s['plan'])}")
+        return '\n'.join(lines)
+
+    def write_report(self):
+        """Escribe el reporte en el archivo rotativo si hubo sentencias nuevas"""
+        if not self._dirty:
+            return False
+        self._dirty = False
+        self.report_log.info(self.report())
+        return True
+
+    def _run(self):
+        while not self._stop.wait(self.report_interval):
+            try:
+                self.write_report()
+            except Exception as e:
+                print(f"[SQL] Error al escribir el reporte de consultas: {e}")
+
+    def stop(self):
+        """Escribe el último reporte y detiene el hilo de reportes"""
+        self._stop.set()
+        if self._loggers_pid == os.getpid():
+            self.write_report()
@@ -476,12 +476,49 @@ function copyToClipboard(text) {
     });
 }
 
+// Generate an invoice PDF in the background job queue and fetch it when ready
+async function fetchInvoicePdf(transactionId, { interval = 500, timeout = 60000 } = {}) {
+    const submit = await fetch(`/api/invoice/${transactionId}/render`, { method: 'POST' });
+    if (!submit.ok) {
+        return submit;
+    }
+    
+    const job = await submit.json();
+    const deadline = Date.now() + timeout;
+    
+    while (Date.now() < deadline) {
+        const statusResponse = await fetch(job.status_url);
+        if (!statusResponse.ok) {
+            return statusResponse;
+        }
+        
+        const status = await statusResponse.json();
+        if (status.status === 'done') {
+            return fetch(status.result_url);
+        }
+        if (status.status === 'failed') {
+            return new Response(JSON.stringify({ error: status.error || 'No se pudo generar el PDF' }), {
+                status: 500,
+                headers: { 'Content-Type': 'application/json' }
+            });
+        }
+        
+        await new Promise(resolve => setTimeout(resolve, interval));
+    }
+    
+    return new Response(JSON.stringify({ error: 'La generación del PDF tardó demasiado' }), {
+        status: 504,
+        headers: { 'Content-Type': 'application/json' }
+    });
+}
+
 // Export functions for global use
 window.PaySecure = {
     showNotification,
     formatCurrency,
     formatDate,
     apiRequest,
+    fetchInvoicePdf,
     copyToClipboard,
     validateField,
     validateForm
@@ -0,0 +1,172 @@
+"""
+Entrega de la bandeja de salida contra un servidor SMTP local (aiosmtpd)
+
+Uso:
+    python -m unittest discover tests
+
+Requiere: pip install aiosmtpd
+"""
+
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import time
+import unittest
+from email.mime.text import MIMEText
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    from aiosmtpd.controller import Controller
+except ImportError:
+    Controller = None
+
+from email_outbox import EmailOutbox
+from email_sender import EmailSender
+from models import Database
+
+HOST = '127.0.0.1'
+REJECTED = 'rechazado@example.com'
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind((HOST, 0))
+        return sock.getsockname()[1]
+
+
+class FlakyHandler:
+    """
+    Servidor que rechaza temporalmente (451) las primeras failures entregas
+
+    Los destinatarios REJECTED se rechazan siempre con 550.
+    """
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.received = []
+
+    async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+        if address == REJECTED:
+            return '550 5.1.1 Usuario desconocido'
+        envelope.rcpt_tos.append(address)
+        return '250 OK'
+
+    async def handle_DATA(self, server, session, envelope):
+        if self.failures > 0:
+            self.failures -= 1
+            return '451 4.3.0 Intenta más tarde'
+        self.received.append((envelope.rcpt_tos, envelope.content))
+        return '250 Mensaje aceptado'
+
+
+@unittest.skipIf(Controller is None, 'requiere aiosmtpd')
+class EmailOutboxSMTPTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db = Database(os.path.join(self.tmp_dir, 'payments.db'))
+        self.handler = FlakyHandler()
+        self.port = free_port()
+        self.controller = Controller(self.handler, hostname=HOST, port=self.port)
+        self.controller.start()
+        self.sender = EmailSender(smtp_host=HOST, smtp_port=self.port, use_tls=False,
+                                  simulate=False, timeout=5)
+        self.outbox = EmailOutbox(self.db, workers=0, retry_base=0.05, max_attempts=3,
+                                  poll_interval=0.05)
+        self.outbox.deliver = self.sender.deliver
+
+    def tearDown(self):
+        self.outbox.stop()
+        if self.sender.pool is not None:
+            self.sender.pool.close_all()
+        self.controller.stop()
+        self.db.close_all()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def enqueue(self, to_email='cliente@example.com'):
+        msg = MIMEText('Factura de prueba')
+        msg['From'] = self.sender.from_email
+        msg['To'] = to_email
+        msg['Subject'] = 'Factura MU - F202600000001'
+        return self.outbox.enqueue(to_email, msg['Subject'], EmailSender.message_bytes(msg))
+
+    def wait_until_due(self, email_id, timeout=5.0):
+        """Espera a que venza el reintento programado del mensaje"""
+        status = self.outbox.status(email_id)
+        self.assertLess(status['next_attempt_at'] - time.time(), timeout)
+        time.sleep(max(0.0, status['next_attempt_at'] - time.time()) + 0.01)
+
+    def test_temporary_failure_is_retried(self):
+        self.handler.failures = 1
+        email_id = self.enqueue()
+
+        self.assertTrue(self.outbox.process_one())
+        status = self.outbox.status(email_id)
+        self.assertEqual(status['status'], 'retry')
+        self.assertEqual(status['attempts'], 1)
+        self.assertIn('451', status['last_error'])
+        self.assertEqual(self.handler.received, [])
+
+        # El reintento no se toma antes de tiempo
+        self.assertFalse(self.outbox.process_one())
+
+        self.wait_until_due(email_id)
+        self.assertTrue(self.outbox.process_one())
+        status = self.outbox.status(email_id)
+        self.assertEqual(status['status'], 'sent')
+        self.assertEqual(status['attempts'], 2)
+        self.assertIsNone(status['last_error'])
+        self.assertEqual(len(self.handler.received), 1)
+        self.assertEqual(self.handler.received[0][0], ['cliente@example.com'])
+
+    def test_backoff_grows_until_max_attempts(self):
+        self.handler.failures = 3
+        email_id = self.enqueue()
+
+        delays = []
+        for attempt in range(1, 4):
+            if attempt > 1:
+                self.wait_until_due(email_id)
+            before = time.time()
+            self.assertTrue(self.outbox.process_one())
+            status = self.outbox.status(email_id)
+            self.assertEqual(status['attempts'], attempt)
+            if attempt < 3:
+                self.assertEqual(status['status'], 'retry')
+                delays.append(status['next_attempt_at'] - before)
+
+        # retry_base * 2 ** (intento - 1) con ±20 % de variación
+        self.assertGreater(delays[1], delays[0])
+        self.assertEqual(self.outbox.status(email_id)['status'], 'failed')
+        self.assertEqual(self.handler.received, [])
+
+    def test_permanent_failure_is_not_retried(self):
+        email_id = self.enqueue(REJECTED)
+
+        self.assertTrue(self.outbox.process_one())
+        status = self.outbox.status(email_id)
+        self.assertEqual(status['status'], 'failed')
+        self.assertEqual(status['attempts'], 1)
+        self.assertIn('550', status['last_error'])
+
+    def test_background_threads_deliver_after_retry(self):
+        self.handler.failures = 1
+        self.outbox.workers = 1
+        self.outbox.start(self.sender.deliver)
+        email_id = self.enqueue()
+
+        deadline = time.time() + 10
+        while self.outbox.status(email_id)['status'] != 'sent' and time.time() < deadline:
+            time.sleep(0.05)
+
+        status = self.outbox.status(email_id)
+        self.assertEqual(status['status'], 'sent')
+        self.assertEqual(status['attempts'], 2)
+        self.assertEqual(len(self.handler.received), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
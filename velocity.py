@@ -0,0 +1,96 @@
+import time
+
+
+class VelocityLimiter:
+    """
+    Límites de velocidad por tarjeta con contadores en buckets de un minuto
+
+    Los contadores viven en la tabla card_velocity de la base de datos
+    compartida, así que todos los workers de gunicorn ven los mismos valores
+    y se actualizan dentro de la transacción del pago. Cada verificación es
+    una sola búsqueda por llave primaria (card_id, bucket) que evalúa todas
+    las ventanas a la vez; como una tarjeta nunca supera su límite diario,
+    el número de buckets leídos está acotado por ese límite.
+    """
+
+    # Ventanas soportadas: nombre -> (minutos, descripción para el mensaje)
+    WINDOWS = {
+        'minute': (1, 'por minuto'),
+        'hour': (60, 'por hora'),
+        'day': (1440, 'por día'),
+    }
+
+    def __init__(self, limits):
+        """
+        Inicializa el limitador
+
+        Args:
+            limits: dict ventana -> máximo de transacciones autorizadas
+                (None = ventana sin límite). Los valores por defecto y las
+                variables VELOCITY_LIMIT_PER_* se resuelven en
+                rule_engine.load_rule_config
+        """
+        unknown = set(limits) - set(self.WINDOWS)
+        if unknown:
+            raise ValueError(f'Ventanas de velocidad desconocidas: {", ".join(sorted(unknown))}')
+
+        self.limits = {window: limit for window, limit in limits.items() if limit is not None}
+        self.max_window = max((self.WINDOWS[w][0] for w in self.limits), default=0)
+
+    @staticmethod
+    def current_bucket(now=None):
+        """Bucket (minutos desde epoch, UTC) al que pertenece el instante dado"""
+        return int(now if now is not None else time.time()) // 60
+
+    def counts(self, conn, card_id, now=None):
+        """
+        Cuenta las transacciones autorizadas de la tarjeta en cada ventana
+
+        Returns:
+            dict: ventana -> transacciones en la ventana deslizante
+        """
+        if not self.limits:
+            return {}
+
+        bucket = self.current_bucket(now)
+        windows = list(self.limits)
+        sums = ', '.join(
+            f'COALESCE(SUM(CASE WHEN bucket > {bucket - self.WINDOWS[w][0]} THEN count END), 0)'
+            for w in windows
+        )
+        row = conn.execute(
+            f'SELECT {sums} FROM card_velocity WHERE card_id = ? AND bucket > ?',
+            (card_id, bucket - self.max_window)
+        ).fetchone()
+        return dict(zip(windows, row))
+
+    def check(self, conn, card_id, now=None):
+        """
+        Verifica todas las ventanas configuradas
+
+        Returns:
+            dict: {'authorized': bool, 'reason': str} con la primera ventana excedida
+        """
+        counts = self.counts(conn, card_id, now)
+        for window, limit in self.limits.items():
+            if counts[window] >= limit:
+                return {
+                    'authorized': False,
+                    'reason': f'Límite de transacciones {self.WINDOWS[window][1]} excedido (máximo {limit})'
+                }
+        return {'authorized': True}
+
+    def record(self, conn, card_id, now=None):
+        """
+        Suma una transacción autorizada al bucket actual de la tarjeta
+
+        Debe llamarse en la transacción que registra el pago. De paso se
+        eliminan los buckets de la tarjeta que ya salieron de todas las ventanas.
+        """
+        bucket = self.current_bucket(now)
+        conn.execute('''
+            INSERT INTO card_velocity (card_id, bucket, count) VALUES (?, ?, 1)
+            ON CONFLICT (card_id, bucket) DO UPDATE SET count = count + 1
+        ''', (card_id, bucket))
+        conn.execute('DELETE FROM card_velocity WHERE card_id = ? AND bucket <= ?',
+                     (card_id, bucket - self.WINDOWS['day'][0]))
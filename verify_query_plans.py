@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""
+Script de verificación de planes de consulta
+Comprueba que las consultas frecuentes de la aplicación usan los índices
+creados por las migraciones en lugar de recorrer tablas completas
+"""
+
+import sys
+
+from models import Database
+
+DB_PATH = 'database/payments.db'
+
+# Consultas frecuentes: nombre -> (sql, parámetros, índice esperado)
+HOT_QUERIES = {
+    'dashboard_estadisticas': (
+        '''
+        SELECT authorized_count, authorized_total, rejected_count, last_transaction_at
+        FROM user_stats WHERE user_id = ?
+        ''',
+        (1,),
+        'INTEGER PRIMARY KEY'
+    ),
+    'dashboard_recientes': (
+        '''
+        SELECT t.*, c.card_number, c.cardholder_name
+        FROM transactions t
+        LEFT JOIN cards c ON t.card_id = c.id
+        WHERE t.user_id = ?
+        ORDER BY t.timestamp DESC
+        LIMIT 10
+        ''',
+        (1,),
+        'idx_transactions_user_timestamp_id'
+    ),
+    'historial_pagina': (
+        '''
+        SELECT t.*, c.card_number, c.cardholder_name
+        FROM transactions t
+        LEFT JOIN cards c ON t.card_id = c.id
+        WHERE t.user_id = ? AND (t.timestamp, t.id) < (?, ?)
+        ORDER BY t.timestamp DESC, t.id DESC
+        LIMIT ?
+        ''',
+        (1, '2100-01-01 00:00:00', 1000000, 26),
+        'idx_transactions_user_timestamp_id'
+    ),
+    'regla_velocidad': (
+        '''
+        SELECT COALESCE(SUM(CASE WHEN bucket > 1000 THEN count END), 0)
+        FROM card_velocity WHERE card_id = ? AND bucket > ?
+        ''',
+        (1, 0),
+        'PRIMARY KEY'
+    ),
+    'factura_por_folio': (
+        'SELECT id FROM transactions WHERE invoice_number = ?',
+        ('F0',),
+        'idx_transactions_invoice_number'
+    ),
+    'factura_por_id': (
+        '''
+        SELECT t.*, c.card_number, c.cardholder_name
+        FROM transactions t
+        LEFT JOIN cards c ON t.card_id = c.id
+        WHERE t.id = ? AND t.user_id = ? AND t.status = 'autorizado'
+        ''',
+        (1, 1),
+        'INTEGER PRIMARY KEY'
+    ),
+    'busqueda_titular': (
+        '''
+        SELECT c.card_number, c.cardholder_name
+        FROM cards_fts f
+        JOIN cards c ON c.id = f.rowid
+        WHERE cards_fts MATCH ?
+        ORDER BY f.rank
+        LIMIT 10
+        ''',
+        ('"jua"*',),
+        'VIRTUAL TABLE INDEX'
+    ),
+    'busqueda_ultimos4': (
+        'SELECT card_number FROM cards WHERE substr(card_number, -4) = ? LIMIT 10',
+        ('0366',),
+        'idx_cards_last4'
+    ),
+    'busqueda_bin': (
+        'SELECT card_number FROM cards WHERE card_number >= ? AND card_number < ? LIMIT 10',
+        ('453201', '453201:'),
+        'sqlite_autoindex_cards_1'
+    ),
+    'saldo_pendiente': (
+        'SELECT COALESCE(SUM(amount), 0) FROM ledger_entries WHERE card_id = ? AND id > ?',
+        (1, 0),
+        'idx_ledger_entries_card_id'
+    ),
+    'tarjeta_por_numero': (
+        'SELECT * FROM cards WHERE card_number = ?',
+        ('4532015112830366',),
+        'sqlite_autoindex_cards_1'
+    ),
+}
+
+
+def check_plan(plan, expected_index):
+    """Retorna la lista de problemas encontrados en un plan de consulta"""
+    problems = []
+    if not any(expected_index in line for line in plan):
+        problems.append(f'no usa {expected_index}')
+    for line in plan:
+        if line.startswith('SCAN t') or line == 'SCAN transactions' or line == 'SCAN cards':
+            problems.append(f'recorrido completo: {line}')
+        if 'USE TEMP B-TREE' in line:
+            problems.append(f'ordenamiento en memoria: {line}')
+    return problems
+
+
+def verify_query_plans(db_path=DB_PATH):
+    """Verifica el plan de cada consulta frecuente. Retorna True si todas pasan"""
+    db = Database(db_path)
+
+    print("=" * 60)
+    print(f"VERIFICACIÓN DE PLANES DE CONSULTA (esquema v{db.schema_version()})")
+    print("=" * 60)
+
+    failures = 0
+    with db.connection() as conn:
+        for name, (sql, params, expected_index) in HOT_QUERIES.items():
+            plan = db.explain_query_plan(conn, sql, params)
+            problems = check_plan(plan, expected_index)
+
+            if problems:
+                failures += 1
+                print(f"\n❌ {name}")
+                for problem in problems:
+                    print(f"   - {problem}")
+            else:
+                print(f"\n✓ {name}")
+            for line in plan:
+                print(f"     {line}")
+
+    print("\n" + "=" * 60)
+    if failures:
+        print(f"{failures} CONSULTA(S) SIN EL PLAN ESPERADO")
+    else:
+        print("TODAS LAS CONSULTAS USAN SUS ÍNDICES")
+    print("=" * 60 + "\n")
+
+    return failures == 0
+
+
+if __name__ == '__main__':
+    db_path = sys.argv[1] if len(sys.argv) > 1 else DB_PATH
+    sys.exit(0 if verify_query_plans(db_path) else 1)